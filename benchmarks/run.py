@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Benchmark Runner
+Microbenchmark dei percorsi per richiesta del bot su dati sintetici, confrontati con una baseline JSON
+
+    python -m benchmarks.run                    # esegue e confronta con benchmarks/baseline.json
+    python -m benchmarks.run --update-baseline  # registra la nuova baseline
+    python -m benchmarks.run --only premium --quick
+
+Gira offline: nessun token, nessuna chiamata a Telegram, OpenAI o Stripe. Il
+bot viene importato in una directory temporanea con uno state store vuoto.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "benchmarks", "baseline.json")
+
+# Dimensioni dei dati sintetici (--quick usa solo la prima di ognuna)
+SIZES = {
+    "users": (1_000, 10_000),
+    "leads": (1_000, 10_000),
+    "articles": (200, 2_000),
+}
+
+OFFLINE_ENV = ("OPENAI_API_KEY", "TELEGRAM_TOKEN", "STRIPE_SECRET_KEY", "STRIPE_PUBLISHABLE_KEY", "STRIPE_WEBHOOK_SECRET")
+
+def load_bot(workdir):
+    """Importa il bot isolato in ``workdir`` (store, log e file legacy lì dentro)"""
+    for name in OFFLINE_ENV:
+        os.environ.pop(name, None)
+    os.environ["TAXAMI_DB_PATH"] = os.path.join(workdir, "bench_state.db")
+    os.environ["TAXAMI_METRICS_PORT"] = "0"
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    logging.disable(logging.CRITICAL)  # i log per chiamata non fanno parte della misura
+    import taxami_bot_premium
+    return taxami_bot_premium
+
+def measure(func, repeat=5):
+    """Secondi per chiamata: il migliore di ``repeat`` giri calibrati con autorange"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+def _cycle(items):
+    state = {"i": 0}
+    size = len(items)
+
+    def _next():
+        state["i"] = (state["i"] + 1) % size
+        return items[state["i"]]
+    return _next
+
+# Casi: (nome, dimensione) -> callable da misurare, preparati con dati sintetici
+def case_search(bot, workdir, articles):
+    from benchmarks.synthetic import QUERIES, make_knowledge, write_knowledge
+    from services.knowledge_base import FiscalKnowledgeBase
+    path = write_knowledge(os.path.join(workdir, f"kb_{articles}"), make_knowledge(articles))
+    bot.fiscal_kb = FiscalKnowledgeBase(path, check_interval=3600)
+    bot._fiscal_index = None
+    bot.get_fiscal_index()
+    query = _cycle(QUERIES)
+    return lambda: bot.search_fiscal_content_robust(query())
+
+def case_file_read(bot, workdir, leads):
+    from benchmarks.synthetic import make_users
+    path = os.path.join(workdir, f"leads_{leads}.json")
+    bot.safe_file_operation(path, 'write', {str(u["id"]): u for u in make_users(leads)})
+    return lambda: bot.safe_file_operation(path, 'read')
+
+def case_file_write(bot, workdir, leads):
+    from benchmarks.synthetic import make_users
+    path = os.path.join(workdir, f"leads_write_{leads}.json")
+    data = {str(u["id"]): u for u in make_users(leads)}
+    return lambda: bot.safe_file_operation(path, 'write', data)
+
+def _usage_counters(bot, workdir, users):
+    from benchmarks.synthetic import make_users
+    from services.state_store import StateStore
+    from services.usage_counters import DailyUsageCounters
+    counters = DailyUsageCounters(StateStore(os.path.join(workdir, f"usage_{users}.db")))
+    ids = [u["id"] for u in make_users(users)]
+    for user_id in ids:
+        counters.increment(user_id)
+    counters.flush()
+    bot.usage_counters = counters
+    return _cycle(ids)
+
+def case_check_limits(bot, workdir, users):
+    user_id = _usage_counters(bot, workdir, users)
+    return lambda: bot.check_user_limits_robust(user_id())
+
+def case_increment_usage(bot, workdir, users):
+    user_id = _usage_counters(bot, workdir, users)
+    return lambda: bot.increment_user_usage_robust(user_id())
+
+def case_save_lead(bot, workdir, leads):
+    from benchmarks.synthetic import make_users
+    from services.lead_registry import LeadRegistry
+    from services.state_store import StateStore
+    store = StateStore(os.path.join(workdir, f"leads_{leads}.db"))
+    users = make_users(leads)
+    for user in users:
+        store.append_lead_event(user, datetime.now().isoformat())
+    store.compact_lead_events()
+    bot.lead_registry = LeadRegistry(store, compact_threshold=10 ** 9)
+    user = _cycle(users)
+    return lambda: bot.save_lead_robust(user())
+
+def case_main_menu(bot, workdir, premium):
+    return lambda: bot.create_main_menu_robust(bool(premium))
+
+def case_is_premium(bot, workdir, users):
+    from benchmarks.synthetic import make_premium_users
+    from premium_system import PremiumManager
+    from services.state_store import StateStore
+    store = StateStore(os.path.join(workdir, f"premium_{users}.db"))
+    premium_users = make_premium_users(users)
+    store.save_premium_users(premium_users)
+    manager = PremiumManager(store)
+    # Metà delle verifiche su utenti non premium
+    user_id = _cycle([int(u) for u in premium_users] + list(range(1, users + 1)))
+    return lambda: manager.is_premium_user(user_id())
+
+CASES = [
+    ("search_fiscal_content_robust", "articles", case_search),
+    ("safe_file_operation_read", "leads", case_file_read),
+    ("safe_file_operation_write", "leads", case_file_write),
+    ("check_user_limits_robust", "users", case_check_limits),
+    ("increment_user_usage_robust", "users", case_increment_usage),
+    ("save_lead_robust", "leads", case_save_lead),
+    ("create_main_menu_robust", "premium", case_main_menu),
+    ("PremiumManager.is_premium_user", "users", case_is_premium),
+]
+
+def run(bot, workdir, only=None, quick=False):
+    """{"nome[param=valore]": microsecondi per chiamata}"""
+    results = {}
+    for name, param, setup in CASES:
+        if only and not any(o.lower() in name.lower() for o in only):
+            continue
+        sizes = (0, 1) if param == "premium" else SIZES[param]
+        for size in sizes[:1] if quick else sizes:
+            key = f"{name}[{param}={size}]"
+            func = setup(bot, workdir, size)
+            results[key] = round(measure(func) * 1e6, 3)
+            print(f"  {key:<55} {results[key]:>12.2f} µs", flush=True)
+    return results
+
+def compare(results, baseline, tolerance, min_delta):
+    """Lista di (chiave, attuale, baseline, rapporto) oltre la tolleranza"""
+    regressions = []
+    for key, current in results.items():
+        reference = baseline.get(key)
+        if not reference:
+            continue
+        ratio = current / reference
+        if ratio > 1 + tolerance and current - reference > min_delta:
+            regressions.append((key, current, reference, ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmark dei percorsi per richiesta del bot")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="File JSON della baseline")
+    parser.add_argument("--update-baseline", action="store_true", help="Salva i risultati come nuova baseline")
+    parser.add_argument("--tolerance", type=float, default=0.50,
+                        help="Rallentamento ammesso rispetto alla baseline (0.50 = +50%%)")
+    parser.add_argument("--min-delta", type=float, default=1.0,
+                        help="Differenza minima in µs per segnalare una regressione (rumore)")
+    parser.add_argument("--only", action="append", help="Esegue solo i casi che contengono questo testo")
+    parser.add_argument("--quick", action="store_true", help="Solo la dimensione più piccola dei dati")
+    parser.add_argument("--output", help="Scrive anche i risultati in questo file JSON")
+    args = parser.parse_args(argv)
+
+    baseline_path = os.path.abspath(args.baseline)
+    output_path = os.path.abspath(args.output) if args.output else None
+    with tempfile.TemporaryDirectory(prefix="taxami-bench-") as workdir:
+        cwd = os.getcwd()
+        bot = load_bot(workdir)
+        print(f"Benchmark ({platform.python_implementation()} {platform.python_version()}, {platform.machine()})")
+        try:
+            results = run(bot, workdir, args.only, args.quick)
+        finally:
+            bot.shutdown_services()
+            os.chdir(cwd)
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "unit": "microseconds per call",
+        "results": results,
+    }
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        previous = {}
+        if os.path.exists(baseline_path):
+            with open(baseline_path, encoding="utf-8") as f:
+                previous = json.load(f).get("results", {})
+        report["results"] = {**previous, **results}
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline aggiornata: {baseline_path}")
+        return 0
+
+    if not os.path.exists(baseline_path):
+        print(f"Nessuna baseline in {baseline_path}: esegui con --update-baseline")
+        return 0
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f).get("results", {})
+
+    regressions = compare(results, baseline, args.tolerance, args.min_delta)
+    for key, current, reference, ratio in regressions:
+        print(f"REGRESSIONE {key}: {current:.2f} µs contro {reference:.2f} µs (x{ratio:.2f})")
+    if regressions:
+        return 1
+    print(f"OK: {len(results)} casi entro +{args.tolerance:.0%} dalla baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+Synthetic Data
+Generatori deterministici di utenti, lead, utenti premium e knowledge base per i benchmark
+"""
+
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+FIRST_NAMES = ["Marco", "Giulia", "Luca", "Francesca", "Andrea", "Chiara", "Paolo", "Sara", "Davide", "Elena"]
+LAST_NAMES = ["Rossi", "Bianchi", "Colombo", "Ferrari", "Esposito", "Romano", "Ricci", "Marino", "Greco", "Bruno"]
+
+# Lessico fiscale per titoli e testi degli articoli (e per le query)
+FISCAL_TERMS = [
+    "partita", "iva", "regime", "forfettario", "ordinario", "detrazioni", "deduzioni", "spese",
+    "mediche", "dichiarazione", "redditi", "scadenze", "acconto", "saldo", "imposta", "irpef",
+    "ires", "irap", "società", "srl", "snc", "sas", "ditta", "individuale", "contributi", "inps",
+    "fattura", "elettronica", "corrispettivi", "ravvedimento", "operoso", "sanzioni", "accertamento",
+    "controlli", "crediti", "compensazione", "f24", "bonus", "ristrutturazione", "superbonus",
+    "cedolare", "secca", "locazioni", "successione", "donazione", "plusvalenze", "dividendi",
+    "transfer", "pricing", "concordato", "preventivo", "crisi", "impresa", "isa", "affidabilità",
+]
+
+QUERIES = [
+    "Come aprire la partita IVA in regime forfettario?",
+    "Quali spese mediche posso detrarre nella dichiarazione dei redditi?",
+    "Scadenze acconto e saldo IRPEF",
+    "Conviene una SRL o una ditta individuale?",
+    "Ravvedimento operoso sulle sanzioni per F24 non pagato",
+    "Cedolare secca sulle locazioni brevi",
+]
+
+def make_users(count, seed=1, start_id=100000):
+    """Utenti Telegram (dict come ``message['from']``)"""
+    rng = random.Random(seed)
+    return [
+        {
+            "id": start_id + i,
+            "first_name": rng.choice(FIRST_NAMES),
+            "last_name": rng.choice(LAST_NAMES),
+            "username": f"user_{start_id + i}",
+        }
+        for i in range(count)
+    ]
+
+def make_premium_users(count, seed=2, start_id=100000, active_ratio=0.8):
+    """{user_id: dati} nel formato di PremiumManager (una parte scaduti o cancellati)"""
+    rng = random.Random(seed)
+    now = datetime.now()
+    users = {}
+    for i in range(count):
+        user_id = start_id + i
+        active = rng.random() < active_ratio
+        expires = now + timedelta(days=rng.randint(1, 30)) if active else now - timedelta(days=rng.randint(1, 90))
+        users[str(user_id)] = {
+            "user_id": user_id,
+            "subscription_id": f"sub_{user_id}",
+            "activated_at": (expires - timedelta(days=30)).isoformat(),
+            "expires_at": expires.isoformat(),
+            "status": "active" if active else rng.choice(["cancelled", "active"]),
+        }
+    return users
+
+def make_knowledge(articles, sections=10, seed=3, words=60):
+    """{sezione: [articoli]} con ``articles`` articoli distribuiti sulle sezioni"""
+    rng = random.Random(seed)
+    knowledge = {f"sezione_{s}": [] for s in range(sections)}
+    for i in range(articles):
+        title = " ".join(rng.sample(FISCAL_TERMS, 4)).capitalize()
+        content = " ".join(rng.choice(FISCAL_TERMS) for _ in range(words))
+        knowledge[f"sezione_{i % sections}"].append({"title": f"{title} ({i})", "content": content})
+    return knowledge
+
+def write_knowledge(path, knowledge):
+    """Scrive la knowledge base come file ``<sezione>.json`` (formato di FiscalKnowledgeBase)"""
+    os.makedirs(path, exist_ok=True)
+    for section, articles in knowledge.items():
+        with open(os.path.join(path, f"{section}.json"), "w", encoding="utf-8") as f:
+            json.dump(articles, f, ensure_ascii=False)
+    return path
@@ -0,0 +1,342 @@
+"""
+Fake Servers
+Stand-in locali di Telegram Bot API, OpenAI chat completions e Stripe per i test di carico
+"""
+
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Testi del bot che non chiudono un'interazione (seguirà una modifica del messaggio)
+PENDING_MARKERS = ("Sto preparando il link di pagamento",)
+
+class LatencyDistribution:
+    """Latenza lognormale definita da mediana e p95 in secondi (``fixed`` se coincidono)"""
+
+    def __init__(self, median, p95=None, seed=None):
+        self.median = median
+        self.p95 = p95 if p95 is not None else median
+        # p95 = mediana * e^(1.645 sigma)
+        self.sigma = math.log(self.p95 / self.median) / 1.645 if self.median > 0 and self.p95 > self.median else 0.0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec):
+        """``"2"`` (fissa) o ``"2:6"`` (mediana:p95)"""
+        median, _, p95 = spec.partition(":")
+        return cls(float(median), float(p95) if p95 else None)
+
+    def sample(self):
+        if self.median <= 0:
+            return 0.0
+        with self._lock:
+            return self.median * math.exp(self._rng.gauss(0, self.sigma)) if self.sigma else self.median
+
+    def __repr__(self):
+        return f"{self.median:g}s" if not self.sigma else f"{self.median:g}s/p95 {self.p95:g}s"
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _reply(self, payload, status=200):
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class FakeServer:
+    """ThreadingHTTPServer su una porta libera di 127.0.0.1, servito da un thread daemon"""
+
+    handler = _Handler
+
+    def __init__(self):
+        handler = type(self.handler.__name__, (self.handler,), {"fake": self})
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+        self.calls = defaultdict(int)
+        self._calls_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def count(self, name):
+        with self._calls_lock:
+            self.calls[name] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class _TelegramHandler(_Handler):
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        method = self.path.rstrip("/").rsplit("/", 1)[-1].split("?", 1)[0]
+        body = self._body()
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            payload = {}  # multipart (sendDocument)
+        payload.update({k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()})
+        self._reply(self.fake.handle(method, payload))
+
+class FakeTelegram(FakeServer):
+    """Bot API finta: ``getUpdates`` serve gli update iniettati, gli invii vengono registrati.
+
+    ``inject`` accoda un update e restituisce un ``Reply`` che si completa al
+    primo messaggio (o modifica) verso quella chat con una tastiera inline e
+    senza testo provvisorio: è la risposta finale che vede l'utente.
+    """
+
+    handler = _TelegramHandler
+
+    def __init__(self, latency=None):
+        super().__init__()
+        self.latency = latency or LatencyDistribution(0)
+        self._updates = deque()
+        self._cond = threading.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        self._waiting = {}
+        self._waiting_lock = threading.Lock()
+
+    def inject(self, update):
+        reply = Reply()
+        chat_id = _chat_of(update)
+        with self._waiting_lock:
+            self._waiting[chat_id] = reply
+        with self._cond:
+            update["update_id"] = next(self._update_ids)
+            self._updates.append(update)
+            self._cond.notify_all()
+        return reply
+
+    def cancel(self, chat_id):
+        with self._waiting_lock:
+            self._waiting.pop(chat_id, None)
+
+    def pending(self):
+        with self._cond:
+            return len(self._updates)
+
+    def handle(self, method, payload):
+        self.count(method)
+        if method == "getUpdates":
+            return {"ok": True, "result": self._get_updates(payload)}
+        delay = self.latency.sample()
+        if delay:
+            time.sleep(delay)
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(payload.get("chat_id", 0))
+            text = payload.get("text", "")
+            if payload.get("reply_markup") and not any(marker in text for marker in PENDING_MARKERS):
+                with self._waiting_lock:
+                    reply = self._waiting.pop(chat_id, None)
+                if reply:
+                    reply.set(method, text)
+            message_id = payload.get("message_id") or next(self._message_ids)
+            return {"ok": True, "result": {"message_id": message_id, "chat": {"id": chat_id}, "date": int(time.time()), "text": text}}
+        return {"ok": True, "result": True}
+
+    def _get_updates(self, payload):
+        offset = int(payload.get("offset") or 0)
+        limit = int(payload.get("limit") or 100)
+        deadline = time.monotonic() + float(payload.get("timeout") or 0)
+        with self._cond:
+            # L'offset conferma gli update già consegnati
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+            return list(itertools.islice(self._updates, limit))
+
+class Reply:
+    """Risposta attesa da una chat: ``wait`` restituisce i secondi dall'invio dell'update"""
+
+    def __init__(self):
+        self.sent_at = time.monotonic()
+        self.elapsed = None
+        self.method = None
+        self.text = None
+        self._event = threading.Event()
+
+    def set(self, method, text):
+        self.elapsed = time.monotonic() - self.sent_at
+        self.method = method
+        self.text = text
+        self._event.set()
+
+    def wait(self, timeout):
+        return self.elapsed if self._event.wait(timeout) else None
+
+def _chat_of(update):
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return update["message"]["chat"]["id"]
+
+ANSWER = (
+    "## Risposta\n\nIn base alla normativa vigente, **il regime forfettario** si applica a chi "
+    "rispetta i limiti di ricavi previsti. Ecco i punti principali:\n\n"
+    "- requisiti di accesso e cause di esclusione\n- aliquota sostitutiva al 15% (5% per le nuove attività)\n"
+    "- contributi INPS e scadenze dei versamenti\n\nPer il tuo caso specifico è consigliabile una verifica con lo studio."
+)
+
+class _OpenAIHandler(_Handler):
+    def do_GET(self):
+        self.fake.count("models")
+        self._reply({"object": "list", "data": [{"id": m, "object": "model", "owned_by": "fake"} for m in self.fake.latency]})
+
+    def do_POST(self):
+        request = json.loads(self._body() or b"{}")
+        model = request.get("model", "")
+        self.fake.count(model)
+        delay = self.fake.latency_for(model).sample()
+        if self.fake.fail():
+            time.sleep(min(delay, 1.0))
+            self._reply({"error": {"message": "fake overload", "type": "server_error", "code": None}}, status=503)
+            return
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in request.get("messages", [])) // 4
+        words = ANSWER.split(" ")
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+        if request.get("stream"):
+            include_usage = (request.get("stream_options") or {}).get("include_usage")
+            self._stream(model, words, delay, usage if include_usage else None)
+            return
+        time.sleep(delay)
+        self._reply({
+            "id": f"chatcmpl-{self.fake.next_id()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": ANSWER}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    def _stream(self, model, words, delay, usage):
+        """Server-sent events: primo token dopo il 20% della latenza, il resto distribuito sul tempo rimanente"""
+        completion_id = f"chatcmpl-{self.fake.next_id()}"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(choices, **extra):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": choices, **extra}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.flush()
+
+        time.sleep(delay * 0.2)
+        step = delay * 0.8 / max(1, len(words) // 5)
+        for i in range(0, len(words), 5):
+            text = " ".join(words[i:i + 5]) + (" " if i + 5 < len(words) else "")
+            event([{"index": 0, "delta": {"content": text}, "finish_reason": None}])
+            time.sleep(step)
+        event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if usage:
+            event([], usage=usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+class FakeOpenAI(FakeServer):
+    """``/v1/chat/completions`` con latenza per modello (anche in streaming) e tasso d'errore"""
+
+    handler = _OpenAIHandler
+
+    def __init__(self, latency=None, default=None, error_rate=0.0, seed=None):
+        super().__init__()
+        self.latency = latency or {}
+        self.default = default or LatencyDistribution(1.0, 3.0)
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return super().url + "/v1"
+
+    def latency_for(self, model):
+        return self.latency.get(model, self.default)
+
+    def fail(self):
+        with self._lock:
+            return self.error_rate > 0 and self._rng.random() < self.error_rate
+
+    def next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+class _StripeHandler(_Handler):
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.fake.count(f"GET {path}")
+        if path == "/v1/products":
+            self._reply({"object": "list", "url": path, "has_more": False,
+                         "data": [{"id": "prod_load", "object": "product", "name": self.fake.product_name}]})
+        elif path == "/v1/prices":
+            self._reply({"object": "list", "url": path, "has_more": False, "data": [self.fake.price]})
+        else:
+            self._reply({"error": {"type": "invalid_request_error", "message": f"Unrecognized request URL ({path})"}}, 404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        self._body()
+        self.fake.count(f"POST {path}")
+        time.sleep(self.fake.latency.sample())
+        if path == "/v1/checkout/sessions":
+            session_id = f"cs_test_{self.fake.next_id()}"
+            self._reply({"id": session_id, "object": "checkout.session", "url": f"https://checkout.stripe.test/{session_id}",
+                         "expires_at": int(time.time()) + 24 * 3600})
+        elif path == "/v1/products":
+            self._reply({"id": "prod_load", "object": "product", "name": self.fake.product_name})
+        elif path == "/v1/prices":
+            self._reply(self.fake.price)
+        else:
+            self._reply({"error": {"type": "invalid_request_error", "message": f"Unrecognized request URL ({path})"}}, 404)
+
+class FakeStripe(FakeServer):
+    """Endpoint usati da ``create_payment_link``: prodotti, prezzi e sessioni di checkout"""
+
+    handler = _StripeHandler
+
+    def __init__(self, latency=None, product_name="Taxami Premium", unit_amount=999, currency="eur", interval="month"):
+        super().__init__()
+        self.latency = latency or LatencyDistribution(0.3, 0.8)
+        self.product_name = product_name
+        self.price = {"id": "price_load", "object": "price", "product": "prod_load", "unit_amount": unit_amount,
+                      "currency": currency, "recurring": {"interval": interval}}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            return next(self._ids)
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Load Test Runner
+Test di carico end-to-end di ``main_loop`` contro Telegram, OpenAI e Stripe finti in locale
+
+    python -m loadtest.run                                  # livelli 5,10,20,40 utenti, 60 s ciascuno
+    python -m loadtest.run --levels 10,20,40,80 --slo 15
+    python -m loadtest.run --openai-latency gpt-4=6:20 --env TAXAMI_MAX_CONCURRENCY=16 --output load.json
+
+Il bot gira come processo separato (``main.py --mode polling``) in una
+directory temporanea, con TELEGRAM_API_BASE, OPENAI_BASE_URL e
+STRIPE_API_BASE puntati ai server finti. Ogni utente virtuale apre una
+sessione con /start, poi alterna tap sul menu e domande libere aspettando la
+risposta finale prima dell'azione successiva; la latenza è misurata
+dall'update accodato per getUpdates fino al messaggio con la tastiera.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from loadtest.fakes import FakeOpenAI, FakeStripe, FakeTelegram, LatencyDistribution
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Domande dei menu (chiavi di DOMANDE_FREE e DOMANDE_PREMIUM)
+FREE_QUESTIONS = [str(i) for i in range(1, 8)]
+PREMIUM_QUESTIONS = [str(i) for i in range(101, 109)]
+
+DEFAULT_MIX = "tap=50,text=35,menu=10,upsell=5"
+DEFAULT_OPENAI_LATENCY = {"gpt-4": "4:12", "gpt-3.5-turbo": "1.5:4"}
+
+FREE_USERS_START = 100_000
+PREMIUM_USERS_START = 900_000
+PREMIUM_POOL = 2_000
+
+KINDS = ("start", "tap", "text", "menu", "upsell")
+
+def percentile(values, q):
+    """Percentile ``q`` (0-100) per rango più vicino; None senza valori"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+def parse_mix(spec):
+    """``"tap=50,text=35"`` -> {tipo: peso}"""
+    mix = {}
+    for item in spec.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS or kind == "start":
+            raise argparse.ArgumentTypeError(f"azione sconosciuta nel mix: {kind} (ammesse: tap, text, menu, upsell)")
+        mix[kind] = float(weight or 1)
+    return mix
+
+class Scenario:
+    """Script degli utenti virtuali: identità, sessioni e update Telegram"""
+
+    def __init__(self, mix, premium_ratio=0.3, session_actions=5, unique_text=0.5, debounce=2.0, seed=1):
+        from benchmarks.synthetic import FIRST_NAMES, FISCAL_TERMS, QUERIES
+        self.kinds = list(mix)
+        self.weights = [mix[k] for k in self.kinds]
+        self.premium_ratio = premium_ratio
+        self.session_actions = session_actions
+        self.unique_text = unique_text
+        self.debounce = debounce
+        self.names = FIRST_NAMES
+        self.terms = FISCAL_TERMS
+        self.queries = QUERIES
+        self._seed = seed
+        self._free_ids = itertools.count(FREE_USERS_START)
+        self._premium_ids = itertools.cycle(range(PREMIUM_USERS_START, PREMIUM_USERS_START + PREMIUM_POOL))
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def rng(self, index):
+        return random.Random(self._seed * 1_000_003 + index)
+
+    def new_user(self, rng):
+        """Nuova identità: i free cambiano utente a ogni sessione (limite giornaliero), i premium ruotano sul pool"""
+        premium = rng.random() < self.premium_ratio
+        with self._lock:
+            user_id = next(self._premium_ids) if premium else next(self._free_ids)
+        return {"id": user_id, "first_name": rng.choice(self.names), "username": f"load_{user_id}"}, premium
+
+    def session(self, rng, premium):
+        """Sequenza di azioni di una sessione: /start e poi ``session_actions`` azioni dal mix"""
+        actions = ["start"]
+        for _ in range(self.session_actions):
+            kind = rng.choices(self.kinds, self.weights)[0]
+            actions.append("tap" if kind == "upsell" and premium else kind)
+        return actions
+
+    def update(self, kind, user, rng, taps):
+        """Update Telegram per l'azione ``kind``; ``taps`` ({callback_data: istante}) è lo storico dei tap dell'utente"""
+        with self._lock:
+            n = next(self._ids)
+        chat = {"id": user["id"], "type": "private"}
+        if kind == "start":
+            return {"message": {"message_id": n, "date": int(time.time()), "chat": chat, "from": user, "text": "/start"}}
+        if kind == "text":
+            text = rng.choice(self.queries)
+            if rng.random() < self.unique_text:
+                text = f"{text} {' '.join(rng.sample(self.terms, 3))}"
+            return {"message": {"message_id": n, "date": int(time.time()), "chat": chat, "from": user, "text": text}}
+        if kind == "menu":
+            choices = ["main_menu", "contacts"]
+        elif kind == "upsell":
+            choices = [f"question_{q}" for q in PREMIUM_QUESTIONS]
+        elif user["id"] >= PREMIUM_USERS_START:
+            choices = [f"question_{q}" for q in FREE_QUESTIONS + PREMIUM_QUESTIONS]
+        else:
+            choices = [f"question_{q}" for q in FREE_QUESTIONS]
+        # Lo stesso bottone ripetuto entro la finestra di debounce verrebbe scartato dal bot
+        now = time.monotonic()
+        data = rng.choice([c for c in choices if now - taps.get(c, -self.debounce) >= self.debounce] or choices)
+        wait = taps.get(data, -self.debounce) + self.debounce - now
+        if wait > 0:
+            time.sleep(wait)
+        taps[data] = time.monotonic()
+        callback = {
+            "id": str(n),
+            "from": user,
+            "data": data,
+            "chat_instance": str(user["id"]),
+            "message": {"message_id": n, "date": int(time.time()), "chat": chat, "text": "menu"},
+        }
+        return {"callback_query": callback}
+
+class Level:
+    """Risultati di un livello di concorrenza"""
+
+    def __init__(self, users, duration):
+        self.users = users
+        self.duration = duration
+        self.samples = defaultdict(list)
+        self.timeouts = defaultdict(int)
+        self.lock = threading.Lock()
+        self.elapsed = 0.0
+        self.backend = {}
+
+    def record(self, kind, latency):
+        with self.lock:
+            if latency is None:
+                self.timeouts[kind] += 1
+            else:
+                self.samples[kind].append(latency)
+
+    def summary(self, slo, max_errors):
+        all_samples = [s for samples in self.samples.values() for s in samples]
+        completed = len(all_samples)
+        timeouts = sum(self.timeouts.values())
+        total = completed + timeouts
+        p95 = percentile(all_samples, 95)
+        error_rate = timeouts / total if total else 0.0
+        return {
+            "users": self.users,
+            "duration": round(self.elapsed, 1),
+            "actions": total,
+            "timeouts": timeouts,
+            "throughput": round(completed / self.elapsed, 2) if self.elapsed else 0.0,
+            "p50": percentile(all_samples, 50),
+            "p95": p95,
+            "p99": percentile(all_samples, 99),
+            "within_slo": p95 is not None and p95 <= slo and error_rate <= max_errors,
+            "kinds": {
+                kind: {
+                    "count": len(self.samples.get(kind, [])),
+                    "timeouts": self.timeouts.get(kind, 0),
+                    "p50": percentile(self.samples.get(kind), 50),
+                    "p95": percentile(self.samples.get(kind), 95),
+                    "p99": percentile(self.samples.get(kind), 99),
+                }
+                for kind in KINDS if self.samples.get(kind) or self.timeouts.get(kind)
+            },
+            "backend_calls": self.backend,
+        }
+
+def virtual_user(index, scenario, telegram, level, deadline, think_time, timeout):
+    """Sessioni in sequenza fino a ``deadline``; ogni azione aspetta la risposta finale del bot"""
+    rng = scenario.rng(index)
+    while time.monotonic() < deadline:
+        user, premium = scenario.new_user(rng)
+        taps = {}
+        for kind in scenario.session(rng, premium):
+            if time.monotonic() >= deadline:
+                return
+            update = scenario.update(kind, user, rng, taps)
+            latency = telegram.inject(update).wait(timeout)
+            if latency is None:
+                telegram.cancel(user["id"])
+            level.record(kind, latency)
+            if think_time:
+                time.sleep(rng.expovariate(1 / think_time))
+
+def run_level(users, duration, scenario, fakes, think_time, timeout, offset):
+    """Esegue ``users`` utenti virtuali per ``duration`` secondi"""
+    telegram = fakes["telegram"]
+    level = Level(users, duration)
+    before = _backend_calls(fakes)
+    start = time.monotonic()
+    deadline = start + duration
+    threads = [
+        threading.Thread(
+            target=virtual_user,
+            args=(offset + i, scenario, telegram, level, deadline, think_time, timeout),
+            name=f"vu-{offset + i}",
+            daemon=True
+        )
+        for i in range(users)
+    ]
+    for thread in threads:
+        thread.start()
+        time.sleep(min(0.05, duration / max(users, 1) / 10))  # avvio scaglionato
+    for thread in threads:
+        thread.join(max(0.0, deadline + timeout - time.monotonic()))
+    level.elapsed = time.monotonic() - start
+    after = _backend_calls(fakes)
+    level.backend = {key: after[key] - before.get(key, 0) for key in after if after[key] - before.get(key, 0)}
+    return level
+
+def _backend_calls(fakes):
+    calls = {}
+    for name, fake in fakes.items():
+        with fake._calls_lock:
+            for key, count in fake.calls.items():
+                calls[f"{name}:{key}"] = count
+    return calls
+
+class BotProcess:
+    """``main.py --mode polling`` in una directory temporanea, puntato ai server finti"""
+
+    def __init__(self, workdir, fakes, workers=0, extra_env=None, premium_users=PREMIUM_POOL, articles=200):
+        self.workdir = workdir
+        self.fakes = fakes
+        self.workers = workers
+        self.log_path = os.path.join(workdir, "bot_stdout.log")
+        self.db_path = os.path.join(workdir, "loadtest_state.db")
+        self.env = dict(os.environ)
+        self.env.update({
+            "TELEGRAM_TOKEN": "loadtest",
+            "TELEGRAM_API_BASE": fakes["telegram"].url,
+            "OPENAI_API_KEY": "sk-loadtest",
+            "OPENAI_BASE_URL": fakes["openai"].url,
+            "STRIPE_SECRET_KEY": "sk_test_loadtest",
+            "STRIPE_API_BASE": fakes["stripe"].url,
+            "TAXAMI_DB_PATH": self.db_path,
+            "TAXAMI_METRICS_PORT": "0",
+            "PYTHONUNBUFFERED": "1",
+        })
+        for name in ("STRIPE_PRICE_ID", "STRIPE_WEBHOOK_SECRET", "TAXAMI_WORKERS"):
+            self.env.pop(name, None)
+        self.env.update(extra_env or {})
+        self._seed(premium_users, articles)
+        self.process = None
+
+    def _seed(self, premium_users, articles):
+        """Utenti premium attivi nello state store e knowledge base sintetica"""
+        sys.path.insert(0, REPO_ROOT)
+        from benchmarks.synthetic import make_knowledge, make_premium_users, write_knowledge
+        from services.state_store import StateStore
+        store = StateStore(self.db_path)
+        store.save_premium_users(make_premium_users(premium_users, start_id=PREMIUM_USERS_START, active_ratio=1.0))
+        store.close()
+        write_knowledge(os.path.join(self.workdir, "skills", "eutekne", "knowledge"), make_knowledge(articles))
+
+    def start(self, timeout=60):
+        self._log = open(self.log_path, "w", encoding="utf-8")
+        command = [sys.executable, os.path.join(REPO_ROOT, "main.py"), "--mode", "polling", "--workers", str(self.workers)]
+        self.process = subprocess.Popen(command, cwd=self.workdir, env=self.env, stdout=self._log, stderr=subprocess.STDOUT)
+        telegram = self.fakes["telegram"]
+        deadline = time.monotonic() + timeout
+        # Pronto quando main_loop fa la prima getUpdates
+        while telegram.calls["getUpdates"] == 0:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"il bot è terminato all'avvio (codice {self.process.returncode}), vedi {self.log_path}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"il bot non ha chiamato getUpdates entro {timeout} s, vedi {self.log_path}")
+            time.sleep(0.1)
+
+    def stop(self, timeout=30):
+        """Ctrl+C: main_loop chiude dispatcher e servizi come in produzione"""
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.process:
+            self._log.close()
+
+    def tail(self, lines=20):
+        with open(self.log_path, encoding="utf-8", errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+
+def _fmt(seconds):
+    return f"{seconds:7.2f}" if seconds is not None else "      -"
+
+def print_level(summary):
+    status = "OK " if summary["within_slo"] else "KO "
+    print(
+        f"{status}{summary['users']:>6} {summary['actions']:>7} {summary['timeouts']:>7} "
+        f"{summary['throughput']:>10.2f} {_fmt(summary['p50'])} {_fmt(summary['p95'])} {_fmt(summary['p99'])}",
+        flush=True
+    )
+    for kind, stats in summary["kinds"].items():
+        print(
+            f"     {kind:<8} {stats['count']:>6} {stats['timeouts']:>7} {'':>10} "
+            f"{_fmt(stats['p50'])} {_fmt(stats['p95'])} {_fmt(stats['p99'])}",
+            flush=True
+        )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test di carico end-to-end del bot con Telegram, OpenAI e Stripe finti")
+    parser.add_argument("--levels", default="5,10,20,40", help="Utenti concorrenti per livello, separati da virgola")
+    parser.add_argument("--duration", type=float, default=60, help="Secondi per livello")
+    parser.add_argument("--slo", type=float, default=20.0, help="p95 massimo in secondi della risposta finale")
+    parser.add_argument("--max-errors", type=float, default=0.01, help="Quota massima di azioni senza risposta entro --timeout")
+    parser.add_argument("--timeout", type=float, default=60, help="Secondi di attesa della risposta prima di contarla persa")
+    parser.add_argument("--keep-going", action="store_true", help="Continua con i livelli successivi anche oltre lo SLO")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"Pesi delle azioni dopo /start (default {DEFAULT_MIX})")
+    parser.add_argument("--session-actions", type=int, default=5, help="Azioni per sessione dopo /start")
+    parser.add_argument("--premium-ratio", type=float, default=0.3, help="Quota di sessioni di utenti premium")
+    parser.add_argument("--unique-text", type=float, default=0.5,
+                        help="Quota di domande libere rese uniche (mancano le cache delle risposte)")
+    parser.add_argument("--think-time", type=float, default=2.0, help="Pausa media (esponenziale) tra due azioni, in secondi")
+    parser.add_argument("--openai-latency", action="append", default=[], metavar="MODELLO=MEDIANA[:P95]",
+                        help="Latenza del modello finto (default gpt-4=4:12, gpt-3.5-turbo=1.5:4)")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="Quota di risposte 503 di OpenAI")
+    parser.add_argument("--telegram-latency", default="0.03:0.1", metavar="MEDIANA[:P95]", help="Latenza della Bot API finta")
+    parser.add_argument("--stripe-latency", default="0.3:0.8", metavar="MEDIANA[:P95]", help="Latenza di Stripe finto")
+    parser.add_argument("--workers", type=int, default=0, help="Processi worker del bot (--workers di main.py)")
+    parser.add_argument("--env", action="append", default=[], metavar="NOME=VALORE", help="Variabile d'ambiente extra per il bot")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Scrive anche il report in questo file JSON")
+    args = parser.parse_args(argv)
+
+    levels = [int(level) for level in args.levels.split(",") if level.strip()]
+    latency_specs = dict(DEFAULT_OPENAI_LATENCY)
+    latency_specs.update(dict(spec.split("=", 1) for spec in args.openai_latency))
+    openai_latency = {model: LatencyDistribution.parse(spec) for model, spec in latency_specs.items()}
+    extra_env = dict(spec.split("=", 1) for spec in args.env)
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    fakes = {
+        "telegram": FakeTelegram(LatencyDistribution.parse(args.telegram_latency)).start(),
+        "openai": FakeOpenAI(openai_latency, error_rate=args.openai_error_rate, seed=args.seed).start(),
+        "stripe": FakeStripe(LatencyDistribution.parse(args.stripe_latency)).start(),
+    }
+    # Margine sul debounce dei callback del bot, per non ripetere un tap che verrebbe scartato
+    debounce = float(extra_env.get("TAXAMI_CALLBACK_DEBOUNCE", os.getenv("TAXAMI_CALLBACK_DEBOUNCE", "2"))) + 0.5
+    scenario = Scenario(args.mix, args.premium_ratio, args.session_actions, args.unique_text, debounce, args.seed)
+
+    print(f"Load test ({platform.python_implementation()} {platform.python_version()}, {os.cpu_count()} CPU)")
+    print(f"OpenAI finto: {', '.join(f'{m} {d!r}' for m, d in openai_latency.items())}; SLO p95 {args.slo:g} s")
+    results = []
+    with tempfile.TemporaryDirectory(prefix="taxami-load-") as workdir:
+        bot = BotProcess(workdir, fakes, args.workers, extra_env)
+        try:
+            bot.start()
+            print(f"\n{'':3}{'Utenti':>6} {'Azioni':>7} {'Timeout':>7} {'Azioni/s':>10} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7}")
+            offset = 0
+            for users in levels:
+                level = run_level(users, args.duration, scenario, fakes, args.think_time, args.timeout, offset)
+                offset += users
+                summary = level.summary(args.slo, args.max_errors)
+                results.append(summary)
+                print_level(summary)
+                if bot.process.poll() is not None:
+                    print(f"Il bot è terminato durante il test (codice {bot.process.returncode}):\n{bot.tail()}")
+                    break
+                if not summary["within_slo"] and not args.keep_going:
+                    break
+        except RuntimeError as e:
+            print(f"Errore: {e}\n{bot.tail()}")
+            return 2
+        finally:
+            bot.stop()
+            for fake in fakes.values():
+                fake.stop()
+
+    sustained = max((r["users"] for r in results if r["within_slo"]), default=0)
+    print(f"\nUtenti concorrenti sostenuti entro lo SLO (p95 <= {args.slo:g} s, errori <= {args.max_errors:.0%}): {sustained or 'nessun livello'}")
+
+    if output_path:
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "config": {
+                "levels": levels,
+                "duration": args.duration,
+                "slo": args.slo,
+                "max_errors": args.max_errors,
+                "mix": args.mix,
+                "session_actions": args.session_actions,
+                "premium_ratio": args.premium_ratio,
+                "think_time": args.think_time,
+                "openai_latency": latency_specs,
+                "openai_error_rate": args.openai_error_rate,
+                "workers": args.workers,
+                "env": extra_env,
+            },
+            "levels": results,
+            "sustained_users": sustained,
+        }
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0 if sustained else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,46 +1,79 @@
-#!/usr/bin/env python3
-"""
-Taxami Bot Premium - Main Entry Point
-Cloud deployment ready
-"""
-
-import os
-import sys
-import logging
-from datetime import datetime
-
-# Add current directory to path
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-
-logger = logging.getLogger(__name__)
-
-def main():
-    logger.info("🤖 TAXAMI BOT PREMIUM - Starting...")
-    
-    # Check required environment variables
-    required_env = ["TELEGRAM_TOKEN", "OPENAI_API_KEY", "STRIPE_SECRET_KEY"]
-    missing = [e for e in required_env if not os.getenv(e)]
-    
-    if missing:
-        logger.error(f"❌ Missing environment variables: {missing}")
-        sys.exit(1)
-    
-    logger.info("✅ Environment variables OK")
-    logger.info(f"🚀 Starting Taxami Bot at {datetime.now()}")
-    
-    try:
-        # Import and start the bot
-        from taxami_bot_premium import main_loop
-        main_loop()
-    except Exception as e:
-        logger.error(f"❌ Failed to start bot: {e}")
-        sys.exit(1)
-
-if __name__ == "__main__":
-    main()
+#!/usr/bin/env python3
+"""
+Taxami Bot Premium - Main Entry Point
+Cloud deployment ready
+"""
+
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime
+
+# Add current directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Taxami Bot Premium")
+    parser.add_argument(
+        "--warm-cache", action="store_true",
+        help="Pre-genera le risposte delle domande del menu ed esce"
+    )
+    parser.add_argument(
+        "--mode", choices=["polling", "webhook"], default=os.getenv("TAXAMI_MODE", "polling"),
+        help="Ricezione update: long polling (default) o webhook HTTP"
+    )
+    parser.add_argument("--host", default=os.getenv("TAXAMI_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    parser.add_argument(
+        "--webhook-url", default=os.getenv("TAXAMI_WEBHOOK_URL"),
+        help="URL pubblico da registrare con setWebhook (webhook mode)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("TAXAMI_WORKERS", "0")),
+        help="Processi worker sharded per chat_id (0 = singolo processo)"
+    )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logger.info("🤖 TAXAMI BOT PREMIUM - Starting...")
+    
+    # Check required environment variables
+    required_env = ["TELEGRAM_TOKEN", "OPENAI_API_KEY", "STRIPE_SECRET_KEY"]
+    missing = [e for e in required_env if not os.getenv(e)]
+    
+    if missing:
+        logger.error(f"❌ Missing environment variables: {missing}")
+        sys.exit(1)
+    
+    logger.info("✅ Environment variables OK")
+    logger.info(f"🚀 Starting Taxami Bot at {datetime.now()}")
+    
+    if args.warm_cache:
+        from taxami_bot_premium import warm_canned_answers
+        warm_canned_answers()
+        return
+    
+    try:
+        # Import and start the bot
+        if args.mode == "webhook":
+            from taxami_bot_premium import run_webhook_server
+            run_webhook_server(args.host, args.port, args.webhook_url, workers=args.workers)
+        else:
+            from taxami_bot_premium import main_loop
+            main_loop(workers=args.workers)
+    except Exception as e:
+        logger.error(f"❌ Failed to start bot: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
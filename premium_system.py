@@ -5,10 +5,19 @@ Gestione pagamenti e sblocco automatico funzionalità premium
 """
 
 import stripe
-import json
+import heapq
 import logging
+import threading
+import time
 from datetime import datetime, timedelta
-from stripe_config import STRIPE_SECRET_KEY_TEST, PREMIUM_PRODUCT_INFO, STRIPE_ENV
+from concurrent.futures import ThreadPoolExecutor
+from stripe_config import (
+    STRIPE_SECRET_KEY_TEST, PREMIUM_PRODUCT_INFO, STRIPE_ENV, STRIPE_WEBHOOK_SECRET,
+    STRIPE_API_BASE, STRIPE_PRICE_ID
+)
+from services.state_store import get_state_store
+from services.circuit_breaker import CircuitBreaker, CircuitOpenError
+from services.health_monitor import get_health_monitor
 
 # Setup
 logging.basicConfig(level=logging.INFO)
@@ -16,127 +25,285 @@ logger = logging.getLogger(__name__)
 
 # Configurazione Stripe
 stripe.api_key = STRIPE_SECRET_KEY_TEST
+if STRIPE_API_BASE:
+    stripe.api_base = STRIPE_API_BASE
 
-# Files
+metrics = get_health_monitor()
+
+# Margine prima della scadenza oltre il quale un link di checkout non viene più riusato
+CHECKOUT_SESSION_MARGIN = 300
+CHECKOUT_SESSION_TTL = 24 * 3600  # durata di default delle sessioni Stripe
+
+# Files (legacy: importato una tantum nello state store SQLite)
 PREMIUM_USERS_FILE = "taxami_premium_users.json"
 
-class PremiumManager:
+def _parse_expiry(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+class _PremiumIndex:
+    """Indici derivati dagli utenti premium: scadenze, subscription, attivi e revenue"""
+    
     def __init__(self):
-        self.premium_users = self.load_premium_users()
+        self.expiry = {}           # user_id -> epoch di scadenza
+        self.by_subscription = {}  # subscription_id -> user_id
+        self.active = set()        # utenti attivi non ancora scaduti
+        self.expiry_heap = []      # (epoch, user_id) degli attivi
+        self.active_revenue = 0    # centesimi/mese
+    
+    def index_user(self, user_str, user_data, previous=None):
+        """Aggiorna gli indici per un utente (``previous``: i suoi dati già indicizzati)"""
+        if previous is not None and self.by_subscription.get(previous.get('subscription_id')) == user_str:
+            del self.by_subscription[previous['subscription_id']]
+        if user_str in self.active:
+            self.active.discard(user_str)
+            self.active_revenue -= PREMIUM_PRODUCT_INFO['price']
+        
+        expiry = _parse_expiry(user_data.get('expires_at'))
+        self.expiry[user_str] = expiry
+        if user_data.get('subscription_id'):
+            self.by_subscription[user_data['subscription_id']] = user_str
+        if user_data.get('status') == 'active' and expiry > time.time():
+            self.active.add(user_str)
+            self.active_revenue += PREMIUM_PRODUCT_INFO['price']
+            heapq.heappush(self.expiry_heap, (expiry, user_str))
+    
+    def expire(self, now):
+        """Rimuove dagli attivi gli utenti scaduti (cima dell'heap)"""
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expiry, user_str = heapq.heappop(self.expiry_heap)
+            # Voci superate da un rinnovo o da una cancellazione vengono ignorate
+            if user_str in self.active and self.expiry.get(user_str) == expiry:
+                self.active.discard(user_str)
+                self.active_revenue -= PREMIUM_PRODUCT_INFO['price']
+
+class PremiumManager:
+    """Utenti premium con indici precalcolati.
+
+    Le scadenze sono tenute come epoch (niente parsing ISO per ogni
+    verifica), ``subscription_id -> user_id`` è indicizzato e gli utenti
+    attivi stanno in un min-heap per scadenza: il conteggio attivi e la
+    revenue sono aggiornati incrementalmente e le scadenze vengono
+    consumate dalla cima dell'heap quando servono le statistiche.
+    ``reload`` costruisce indici nuovi e li sostituisce in un solo
+    assegnamento: le letture senza lock non vedono mai indici a metà.
+    """
+    
+    def __init__(self, store=None):
+        self.store = store or get_state_store()
+        self._lock = threading.RLock()
+        self.premium_users = {}
+        self._index = _PremiumIndex()
+        self.reload()
     
     def load_premium_users(self):
         """Carica utenti premium"""
         try:
-            with open(PREMIUM_USERS_FILE, 'r') as f:
-                return json.load(f)
-        except FileNotFoundError:
+            return self.store.load_premium_users()
+        except Exception as e:
+            logger.error(f"Errore caricamento premium users: {e}")
             return {}
     
-    def save_premium_users(self):
-        """Salva utenti premium"""
+    def reload(self):
+        """Ricarica gli utenti premium dallo store e ricostruisce gli indici"""
+        revision = self.store.premium_revision()
+        users = self.load_premium_users()
+        index = _PremiumIndex()
+        for user_str, user_data in users.items():
+            index.index_user(user_str, user_data)
+        with self._lock:
+            self.revision = revision
+            self.premium_users, self._index = users, index
+    
+    def refresh_if_changed(self):
+        """Ricarica se un altro processo ha modificato gli utenti premium"""
         try:
-            with open(PREMIUM_USERS_FILE, 'w') as f:
-                json.dump(self.premium_users, f, indent=2, default=str)
+            if self.store.premium_revision() != self.revision:
+                self.reload()
+                return True
+        except Exception as e:
+            logger.error(f"Errore refresh premium users: {e}")
+        return False
+    
+    def _set_user(self, user_str, user_data):
+        with self._lock:
+            self._index.index_user(user_str, user_data, self.premium_users.get(user_str))
+            self.premium_users[user_str] = user_data
+        self.save_premium_users([user_str])
+    
+    def save_premium_users(self, user_ids=None):
+        """Salva utenti premium (solo ``user_ids`` se indicati)"""
+        try:
+            users = self.premium_users
+            if user_ids is not None:
+                users = {u: self.premium_users[u] for u in user_ids}
+            self.store.save_premium_users(users)
         except Exception as e:
             logger.error(f"Errore salvataggio premium users: {e}")
     
     def is_premium_user(self, user_id):
         """Verifica se utente è premium e attivo"""
-        user_str = str(user_id)
-        if user_str not in self.premium_users:
-            return False
-        
-        user_data = self.premium_users[user_str]
-        expiry_date = datetime.fromisoformat(user_data.get('expires_at', '2000-01-01'))
-        
-        return datetime.now() < expiry_date
+        expiry = self._index.expiry.get(str(user_id))
+        return expiry is not None and time.time() < expiry
+    
+    def find_user_by_subscription(self, subscription_id):
+        """User id associato a una subscription Stripe, None se sconosciuta"""
+        user_str = self._index.by_subscription.get(subscription_id)
+        return int(user_str) if user_str is not None else None
     
     def add_premium_user(self, user_id, subscription_id, duration_months=1):
         """Aggiunge utente premium"""
         user_str = str(user_id)
         expires_at = datetime.now() + timedelta(days=duration_months * 30)
         
-        self.premium_users[user_str] = {
+        self._set_user(user_str, {
             'user_id': user_id,
             'subscription_id': subscription_id,
             'activated_at': datetime.now().isoformat(),
             'expires_at': expires_at.isoformat(),
             'status': 'active'
-        }
-        
-        self.save_premium_users()
+        })
         logger.info(f"Utente {user_id} attivato premium fino al {expires_at}")
     
     def remove_premium_user(self, user_id):
         """Rimuove utente premium"""
         user_str = str(user_id)
-        if user_str in self.premium_users:
-            self.premium_users[user_str]['status'] = 'cancelled'
-            self.save_premium_users()
+        user_data = self.premium_users.get(user_str)
+        if user_data is not None:
+            self._set_user(user_str, {**user_data, 'status': 'cancelled'})
             logger.info(f"Utente {user_id} premium cancellato")
     
     def get_premium_stats(self):
         """Statistiche utenti premium"""
-        active_count = sum(1 for user in self.premium_users.values() 
-                          if user.get('status') == 'active' and 
-                          datetime.fromisoformat(user.get('expires_at', '2000-01-01')) > datetime.now())
-        
-        total_revenue = active_count * PREMIUM_PRODUCT_INFO['price'] / 100
-        
-        return {
-            'active_premium_users': active_count,
-            'monthly_revenue': total_revenue,
-            'total_users': len(self.premium_users)
-        }
+        with self._lock:
+            index = self._index
+            index.expire(time.time())
+            return {
+                'active_premium_users': len(index.active),
+                'monthly_revenue': index.active_revenue / 100,
+                'total_users': len(self.premium_users)
+            }
+
+def is_stripe_outage(exc):
+    """Errori che indicano Stripe non raggiungibile o in difficoltà (non richieste invalide)"""
+    if isinstance(exc, (stripe.error.InvalidRequestError, stripe.error.CardError,
+                        stripe.error.AuthenticationError, stripe.error.SignatureVerificationError)):
+        return False
+    return True
 
 class StripePaymentManager:
-    def __init__(self):
-        self.premium_manager = PremiumManager()
+    """Pagamenti Stripe.
+
+    Prodotto e prezzo vengono risolti una volta e tenuti in memoria; le
+    sessioni di checkout restano valide fino a ``expires_at`` e vengono
+    riusate per lo stesso utente. ``create_payment_link_async`` crea la
+    sessione su un thread dedicato, fuori dal percorso della richiesta.
+    Le chiamate a Stripe passano da ``breaker``: con il circuito aperto il
+    link fallisce subito invece di attendere i timeout.
+    """
+    
+    def __init__(self, premium_manager=None, price_id=STRIPE_PRICE_ID, workers=2, breaker=None):
+        self.premium_manager = premium_manager or PremiumManager()
+        self.breaker = breaker or CircuitBreaker("stripe", is_failure=is_stripe_outage)
+        self._price_id = price_id or None
+        self._price_lock = threading.Lock()
+        self._sessions = {}   # user_id -> (url, expires_at epoch)
+        self._pending = {}    # user_id -> Future della creazione in corso
+        self._sessions_lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stripe-checkout")
+    
+    def _stripe_call(self, operation, func, *args, **kwargs):
+        """Chiamata Stripe attraverso il circuit breaker, con latenza ed esito nelle metriche"""
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            result = self.breaker.call(func, *args, **kwargs)
+            outcome = "ok"
+            return result
+        except CircuitOpenError:
+            outcome = "circuit_open"
+            raise
+        finally:
+            metrics.observe("stripe_request_seconds", time.perf_counter() - start, operation=operation)
+            metrics.inc("stripe_requests_total", operation=operation, outcome=outcome)
+    
+    def resolve_price_id(self):
+        """Price id del prodotto premium (ricerca/creazione una sola volta)"""
+        if self._price_id:
+            return self._price_id
+        with self._price_lock:
+            if not self._price_id:
+                self._price_id = self._stripe_call("resolve_price", self._find_or_create_price)
+                logger.info(f"Prezzo Stripe premium: {self._price_id}")
+            return self._price_id
+    
+    def _find_or_create_price(self):
+        """Cerca (o crea) prodotto e prezzo premium su Stripe"""
+        # Cerca prodotti esistenti
+        products = stripe.Product.list(limit=10)
+        product = None
+        
+        # Trova prodotto Taxami o crealo
+        for p in products:
+            if p.name == PREMIUM_PRODUCT_INFO['name']:
+                product = p
+                break
+        
+        if not product:
+            product = stripe.Product.create(
+                name=PREMIUM_PRODUCT_INFO['name'],
+                description=PREMIUM_PRODUCT_INFO['description']
+            )
+        
+        # Cerca prezzi esistenti per questo prodotto
+        prices = stripe.Price.list(product=product.id, limit=10)
+        price = None
+        
+        # Trova prezzo corrispondente o crealo
+        for p in prices:
+            if (p.unit_amount == PREMIUM_PRODUCT_INFO['price'] and 
+                p.currency == PREMIUM_PRODUCT_INFO['currency'] and
+                p.recurring and p.recurring.interval == PREMIUM_PRODUCT_INFO['interval']):
+                price = p
+                break
+        
+        if not price:
+            price = stripe.Price.create(
+                unit_amount=PREMIUM_PRODUCT_INFO['price'],
+                currency=PREMIUM_PRODUCT_INFO['currency'],
+                recurring={"interval": PREMIUM_PRODUCT_INFO['interval']},
+                product=product.id
+            )
+        
+        return price.id
+    
+    def cached_payment_link(self, user_id):
+        """Link di checkout ancora valido per l'utente, senza chiamate a Stripe"""
+        with self._sessions_lock:
+            cached = self._sessions.get(user_id)
+        if cached and cached[1] - CHECKOUT_SESSION_MARGIN > time.time():
+            return cached[0]
+        return None
+    
+    def invalidate_payment_link(self, user_id):
+        with self._sessions_lock:
+            self._sessions.pop(user_id, None)
     
     def create_payment_link(self, user_id):
-        """Crea link di pagamento Stripe per utente"""
+        """Crea link di pagamento Stripe per utente (riusa la sessione se ancora valida)"""
+        cached = self.cached_payment_link(user_id)
+        if cached:
+            return cached
         try:
-            # Cerca prodotti esistenti
-            products = stripe.Product.list(limit=10)
-            product = None
-            
-            # Trova prodotto Taxami o crealo
-            for p in products:
-                if p.name == PREMIUM_PRODUCT_INFO['name']:
-                    product = p
-                    break
-            
-            if not product:
-                product = stripe.Product.create(
-                    name=PREMIUM_PRODUCT_INFO['name'],
-                    description=PREMIUM_PRODUCT_INFO['description']
-                )
-            
-            # Cerca prezzi esistenti per questo prodotto
-            prices = stripe.Price.list(product=product.id, limit=10)
-            price = None
-            
-            # Trova prezzo corrispondente o crealo
-            for p in prices:
-                if (p.unit_amount == PREMIUM_PRODUCT_INFO['price'] and 
-                    p.currency == PREMIUM_PRODUCT_INFO['currency'] and
-                    p.recurring and p.recurring.interval == PREMIUM_PRODUCT_INFO['interval']):
-                    price = p
-                    break
-            
-            if not price:
-                price = stripe.Price.create(
-                    unit_amount=PREMIUM_PRODUCT_INFO['price'],
-                    currency=PREMIUM_PRODUCT_INFO['currency'],
-                    recurring={"interval": PREMIUM_PRODUCT_INFO['interval']},
-                    product=product.id
-                )
-            
             # Crea sessione di checkout
-            session = stripe.checkout.Session.create(
+            session = self._stripe_call(
+                "checkout_session",
+                stripe.checkout.Session.create,
                 payment_method_types=['card'],
                 line_items=[{
-                    'price': price.id,
+                    'price': self.resolve_price_id(),
                     'quantity': 1,
                 }],
                 mode='subscription',
@@ -148,25 +315,67 @@ class StripePaymentManager:
                 }
             )
             
+            expires_at = session.get('expires_at') or time.time() + CHECKOUT_SESSION_TTL
+            with self._sessions_lock:
+                now = time.time()
+                if len(self._sessions) > 10000:
+                    self._sessions = {u: s for u, s in self._sessions.items() if s[1] > now}
+                self._sessions[user_id] = (session.url, expires_at)
             return session.url
             
         except Exception as e:
             logger.error(f"Errore creazione payment link: {e}")
             return None
     
-    def handle_webhook(self, payload, sig_header):
-        """Gestisce webhook Stripe per sblocco automatico"""
+    def create_payment_link_async(self, user_id):
+        """Future con il link di pagamento; tap ripetuti condividono la stessa creazione"""
+        with self._sessions_lock:
+            future = self._pending.get(user_id)
+            if future is None:
+                future = self._executor.submit(self.create_payment_link, user_id)
+                self._pending[user_id] = future
+                future.add_done_callback(lambda f: self._clear_pending(user_id, f))
+            return future
+    
+    def _clear_pending(self, user_id, future):
+        with self._sessions_lock:
+            if self._pending.get(user_id) is future:
+                del self._pending[user_id]
+    
+    def warm_up(self):
+        """Risolve il prezzo all'avvio: la prima sessione costa una sola chiamata"""
+        try:
+            return self.resolve_price_id()
+        except Exception as e:
+            logger.warning(f"Prezzo Stripe non risolto all'avvio: {e}")
+            return None
+    
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+    
+    def verify_webhook(self, payload, sig_header):
+        """Valida il payload del webhook e restituisce l'evento Stripe (None se non valido)"""
+        # Senza secret la firma non è verificabile: nessun evento viene accettato
+        if not STRIPE_WEBHOOK_SECRET:
+            logger.error("Webhook Stripe rifiutato: STRIPE_WEBHOOK_SECRET non configurato")
+            return None
+        try:
+            return stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+        except Exception as e:
+            logger.error(f"Webhook Stripe non valido: {e}")
+            return None
+    
+    def process_event(self, event):
+        """Applica un evento Stripe già verificato"""
         try:
-            # Per ora senza verifica signature (da implementare in produzione)
-            event = stripe.Event.construct_from(json.loads(payload), stripe.api_key)
-            
             if event['type'] == 'checkout.session.completed':
                 session = event['data']['object']
                 user_id = int(session['metadata']['user_id'])
                 subscription_id = session.get('subscription')
                 
-                # Attiva utente premium
+                # Attiva utente premium; la sessione usata non è più riutilizzabile
                 self.premium_manager.add_premium_user(user_id, subscription_id)
+                self.invalidate_payment_link(user_id)
                 logger.info(f"Pagamento completato per user {user_id}")
                 
                 return True
@@ -174,10 +383,9 @@ class StripePaymentManager:
             elif event['type'] == 'customer.subscription.deleted':
                 subscription = event['data']['object']
                 # Trova utente e disattiva premium
-                for user_id, user_data in self.premium_manager.premium_users.items():
-                    if user_data.get('subscription_id') == subscription['id']:
-                        self.premium_manager.remove_premium_user(int(user_id))
-                        break
+                user_id = self.premium_manager.find_user_by_subscription(subscription['id'])
+                if user_id is not None:
+                    self.premium_manager.remove_premium_user(user_id)
                         
                 return True
                 
@@ -186,10 +394,17 @@ class StripePaymentManager:
             return False
         
         return True
+    
+    def handle_webhook(self, payload, sig_header):
+        """Gestisce webhook Stripe per sblocco automatico"""
+        event = self.verify_webhook(payload, sig_header)
+        if event is None:
+            return False
+        return self.process_event(event)
 
-# Istanza globale
-payment_manager = StripePaymentManager()
+# Istanza globale (un solo PremiumManager: i webhook aggiornano lo stesso stato letto dal bot)
 premium_manager = PremiumManager()
+payment_manager = StripePaymentManager(premium_manager)
 
 def test_stripe_connection():
     """Test connessione Stripe"""
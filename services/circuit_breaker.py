@@ -0,0 +1,159 @@
+"""
+Circuit Breaker Service
+Circuit breaker per dipendenza con finestra mobile e probe in half-open
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitOpenError(Exception):
+    """Chiamata rifiutata senza tentarla: il circuito della dipendenza è aperto"""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"Circuito {name} aperto, nuovo tentativo tra {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """Circuit breaker non bloccante per una singola dipendenza.
+
+    In ``closed`` gli esiti vengono contati in bucket da un secondo su una
+    finestra di ``window`` secondi: con almeno ``min_calls`` chiamate e un
+    tasso di errore >= ``error_rate`` il circuito si apre. In ``open`` le
+    chiamate falliscono subito (``allow`` restituisce False) per
+    ``open_timeout`` secondi, poi il circuito passa in ``half_open`` e lascia
+    passare al massimo ``probes`` chiamate di prova: se riescono tutte si
+    richiude, al primo errore si riapre. ``is_failure(exc)`` decide quali
+    eccezioni indicano un guasto della dipendenza (es. un 400 non lo è).
+    """
+
+    def __init__(self, name, window=60, min_calls=10, error_rate=0.5, open_timeout=30, probes=3,
+                 is_failure=None):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_timeout = open_timeout
+        self.probes = probes
+        self.is_failure = is_failure or (lambda exc: True)
+        self.state = CLOSED
+        self.transitions = {}  # (da, a) -> conteggio
+        self.rejected = 0
+        self._buckets = deque()  # [secondo, successi, errori]
+        self._calls = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes_started = 0
+        self._probes_ok = 0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state, now):
+        previous, self.state = self.state, state
+        key = (previous, state)
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        if state == OPEN:
+            self._opened_at = now
+            logger.warning(f"🔌 Circuito {self.name} APERTO ({previous} -> open)")
+        elif state == HALF_OPEN:
+            self._probes_started = 0
+            self._probes_ok = 0
+            logger.info(f"🔌 Circuito {self.name} half-open: provo {self.probes} richieste")
+        else:
+            self._buckets.clear()
+            self._calls = self._failures = 0
+            logger.info(f"🔌 Circuito {self.name} richiuso")
+
+    def _prune(self, second):
+        while self._buckets and self._buckets[0][0] <= second - self.window:
+            _, ok, failed = self._buckets.popleft()
+            self._calls -= ok + failed
+            self._failures -= failed
+
+    def _count(self, now, failed):
+        second = int(now)
+        self._prune(second)
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append([second, 0, 0])
+        self._buckets[-1][2 if failed else 1] += 1
+        self._calls += 1
+        self._failures += failed
+
+    def available(self):
+        """False se il circuito è aperto e non è ancora ora di riprovare (nessun effetto)"""
+        return not (self.state == OPEN and time.monotonic() - self._opened_at < self.open_timeout)
+
+    def allow(self):
+        """True se la chiamata può partire; in half-open riserva uno dei probe"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self._opened_at < self.open_timeout:
+                    self.rejected += 1
+                    return False
+                self._set_state(HALF_OPEN, now)
+            if self.state == HALF_OPEN:
+                if self._probes_started >= self.probes:
+                    self.rejected += 1
+                    return False
+                self._probes_started += 1
+            return True
+
+    def on_success(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                self._probes_ok += 1
+                if self._probes_ok >= self.probes:
+                    self._set_state(CLOSED, now)
+            elif self.state == CLOSED:
+                self._count(now, False)
+
+    def on_error(self, exc):
+        """Registra un'eccezione: conta come guasto solo se ``is_failure(exc)``"""
+        if not self.is_failure(exc):
+            # La dipendenza ha risposto: per il circuito è un esito positivo
+            self.on_success()
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                self._set_state(OPEN, now)
+            elif self.state == CLOSED:
+                self._count(now, True)
+                if self._calls >= self.min_calls and self._failures >= self.error_rate * self._calls:
+                    self._set_state(OPEN, now)
+
+    def call(self, func, *args, **kwargs):
+        """Esegue ``func`` attraverso il circuito; CircuitOpenError se è aperto"""
+        if not self.allow():
+            raise CircuitOpenError(self.name, max(0.0, self._opened_at + self.open_timeout - time.monotonic()))
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.on_error(e)
+            raise
+        self.on_success()
+        return result
+
+    def stats(self):
+        """Stato corrente, finestra e contatori delle transizioni"""
+        with self._lock:
+            self._prune(int(time.monotonic()))
+            return {
+                "state": self.state,
+                "state_code": STATE_CODES[self.state],
+                "window_calls": self._calls,
+                "window_failures": self._failures,
+                "error_rate": self._failures / self._calls if self._calls else 0.0,
+                "rejected": self.rejected,
+                "transitions": {f"{a}->{b}": n for (a, b), n in self.transitions.items()},
+            }
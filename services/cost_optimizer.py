@@ -1,18 +1,190 @@
-"""
-Cost Optimizer Service
-"""
-
-import logging
-import asyncio
-
-logger = logging.getLogger(__name__)
-
-class CostOptimizer:
-    def __init__(self):
-        self.running = False
-        
-    async def start(self):
-        self.running = True
-        
-    async def stop(self):
-        self.running = False
+"""
+Cost Optimizer Service
+Contabilità token/costi per modello e scelta del modello per tier, budget e latenza
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+# USD per 1K token (prompt, completion)
+MODEL_PRICING = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+# Modelli per tier in ordine di preferenza: il primo è quello "pieno", gli altri i ripieghi
+TIER_MODELS = {
+    "premium": ("gpt-4", "gpt-3.5-turbo"),
+    "free": ("gpt-3.5-turbo",),
+}
+
+class _ModelStats:
+    __slots__ = ("latencies", "calls", "errors", "prompt_tokens", "completion_tokens", "cost")
+
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class CostOptimizer:
+    """Registra token, costo e latenza di ogni chiamata OpenAI e sceglie il modello.
+
+    ``choose_models(tier)`` parte dal modello preferito del tier e scende al
+    successivo quando il p95 di latenza osservato (ultime ``window``
+    chiamate negli ultimi ``max_age`` secondi, almeno ``min_samples``) supera
+    ``latency_slo``, oppure quando la spesa del giorno ha raggiunto
+    ``daily_budget`` (0 = nessun limite). Con ``store`` la spesa del giorno
+    è una riga dello state store sommata atomicamente: sopravvive ai
+    riavvii ed è la stessa per tutti i worker. Un modello scartato non riceve più
+    traffico: quando i suoi campioni scadono torna a essere provato. Ogni
+    cambio di decisione per un tier viene loggato; i conteggi sono in
+    ``stats()`` e, con ``metrics``, nel contatore ``model_routing_total``.
+    """
+
+    def __init__(self, daily_budget=0.0, latency_slo=20.0, window=200, min_samples=20, max_age=600,
+                 pricing=None, tiers=None, metrics=None, store=None):
+        self.daily_budget = daily_budget
+        self.store = store
+        self.latency_slo = latency_slo
+        self.window = window
+        self.min_samples = min_samples
+        self.max_age = max_age
+        self.pricing = pricing or MODEL_PRICING
+        self.tiers = tiers or TIER_MODELS
+        self.metrics = metrics
+        self._models = {}
+        self._day = date.today()
+        self._spent_today = 0.0  # spesa di questo processo (ripiego se lo store non risponde)
+        self._decisions = {}  # tier -> (model, motivo) dell'ultima scelta
+        self._decision_counts = {}
+        self._lock = threading.Lock()
+
+    def _stats_for(self, model):
+        stats = self._models.get(model)
+        if stats is None:
+            stats = self._models[model] = _ModelStats(self.window)
+        return stats
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        prompt_price, completion_price = self.pricing.get(model, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+    def _roll_day(self):
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._spent_today = 0.0
+
+    def record(self, model, seconds, prompt_tokens=0, completion_tokens=0, ok=True):
+        """Registra una chiamata (anche fallita: la sua latenza conta per lo SLO)"""
+        cost = self.cost(model, prompt_tokens, completion_tokens)
+        with self._lock:
+            self._roll_day()
+            stats = self._stats_for(model)
+            stats.latencies.append((time.monotonic(), seconds))
+            stats.calls += 1
+            stats.errors += 0 if ok else 1
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.cost += cost
+            self._spent_today += cost
+            day = self._day.isoformat()
+        if self.store is not None and cost:
+            try:
+                self.store.add_openai_spend(day, cost)
+            except Exception as e:
+                logger.error(f"Spesa OpenAI non registrata sullo store: {e}")
+        return cost
+
+    def latency(self, model):
+        """(p50, p95) delle ultime chiamate, None se i campioni sono troppo pochi"""
+        oldest = time.monotonic() - self.max_age
+        with self._lock:
+            stats = self._models.get(model)
+            samples = [seconds for at, seconds in stats.latencies if at >= oldest] if stats else []
+        if len(samples) < self.min_samples:
+            return None
+        return _percentile(samples, 0.5), _percentile(samples, 0.95)
+
+    def spent_today(self):
+        """Spesa del giorno: totale dello store (tutti i processi) o, senza store, di questo processo"""
+        with self._lock:
+            self._roll_day()
+            local, day = self._spent_today, self._day.isoformat()
+        if self.store is not None:
+            try:
+                return max(local, self.store.get_openai_spend(day))
+            except Exception as e:
+                logger.error(f"Lettura spesa OpenAI fallita: {e}")
+        return local
+
+    def choose_models(self, tier):
+        """(modello, modello di fallback) per il tier in base a budget e latenza"""
+        candidates = self.tiers.get(tier) or self.tiers["free"]
+        model, reason = candidates[0], "default"
+
+        if self.daily_budget and self.spent_today() >= self.daily_budget:
+            model, reason = min(candidates, key=lambda m: sum(self.pricing.get(m, (0.0, 0.0)))), "budget"
+        else:
+            for index, candidate in enumerate(candidates):
+                latency = self.latency(candidate)
+                if latency is None or latency[1] <= self.latency_slo or index == len(candidates) - 1:
+                    model = candidate
+                    break
+                # p95 oltre lo SLO: prova il modello successivo, più veloce
+                reason = f"latency p95 {latency[1]:.1f}s > {self.latency_slo:.0f}s ({candidate})"
+
+        index = candidates.index(model)
+        fallback = candidates[index + 1] if index + 1 < len(candidates) else model
+        self._record_decision(tier, model, reason)
+        return model, fallback
+
+    def _record_decision(self, tier, model, reason):
+        kind = reason.split(" ", 1)[0]
+        with self._lock:
+            key = (tier, model, kind)
+            self._decision_counts[key] = self._decision_counts.get(key, 0) + 1
+            previous = self._decisions.get(tier)
+            self._decisions[tier] = (model, reason)
+        if self.metrics is not None:
+            self.metrics.inc("model_routing_total", tier=tier, model=model, reason=kind)
+        if previous is None or previous[0] != model or previous[1].split(" ", 1)[0] != kind:
+            logger.info(f"🧭 Routing {tier}: {model} ({reason})")
+
+    def stats(self):
+        """Per modello: chiamate, errori, token, costo, p50/p95; spesa del giorno e decisioni"""
+        models = {}
+        for model in list(self._models):
+            latency = self.latency(model)
+            with self._lock:
+                stats = self._models[model]
+                models[model] = {
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "prompt_tokens": stats.prompt_tokens,
+                    "completion_tokens": stats.completion_tokens,
+                    "cost": round(stats.cost, 4),
+                    "p50": latency[0] if latency else None,
+                    "p95": latency[1] if latency else None,
+                }
+        spent_today = self.spent_today()
+        with self._lock:
+            return {
+                "models": models,
+                "spent_today": round(spent_today, 4),
+                "daily_budget": self.daily_budget,
+                "routing": {tier: model for tier, (model, _) in self._decisions.items()},
+                "decisions": {f"{t}/{m}/{k}": n for (t, m, k), n in self._decision_counts.items()},
+            }
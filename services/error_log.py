@@ -0,0 +1,156 @@
+"""
+Error Log Service
+Ring buffer degli errori in memoria con aggregazione e flush in background
+"""
+
+import hashlib
+import logging
+import re
+import threading
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Parti variabili dei messaggi sostituite prima del fingerprint
+_VOLATILE_PATTERNS = [
+    (re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.I), "<uuid>"),
+    (re.compile(r"0x[0-9a-f]+", re.I), "<hex>"),
+    (re.compile(r"'[^']*'|\"[^\"]*\""), "<str>"),
+    (re.compile(r"\d+(\.\d+)?"), "<n>"),
+]
+
+def fingerprint(message):
+    """Impronta stabile di un messaggio d'errore (numeri, id e stringhe normalizzati)"""
+    normalized = str(message)[:500]
+    for pattern, placeholder in _VOLATILE_PATTERNS:
+        normalized = pattern.sub(placeholder, normalized)
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12], normalized
+
+class ErrorLog:
+    """Log degli errori che non tocca il disco nel percorso della richiesta.
+
+    ``record`` aggiunge l'errore a un ring buffer (ultimi ``capacity``) e
+    aggiorna gli aggregati per (tipo, fingerprint) con conteggio e primo e
+    ultimo timestamp. Un thread in background scrive in batch sullo store
+    gli errori nuovi e gli incrementi degli aggregati. Se lo store non
+    tiene il passo (es. durante un outage) gli errori in attesa oltre
+    ``max_pending`` vengono scartati e contati in ``dropped``.
+    """
+
+    def __init__(self, store, capacity=100, flush_interval=5.0, max_pending=1000, max_aggregates=500):
+        self.store = store
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.max_aggregates = max_aggregates
+        self.dropped = 0
+        self.total = 0
+        self._recent = deque(maxlen=capacity)
+        self._pending = deque(maxlen=max_pending)
+        self._aggregates = {}   # (type, fingerprint) -> dict
+        self._deltas = {}       # (type, fingerprint) -> conteggio non ancora scritto
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, error_type, message, context=None, traceback_text=None):
+        """Registra un errore (solo memoria, nessun I/O)"""
+        now = datetime.now().isoformat()
+        message = str(message)
+        fp, normalized = fingerprint(message)
+        entry = {
+            "timestamp": now,
+            "type": error_type,
+            "message": message,
+            "context": context,
+            "traceback": traceback_text,
+            "fingerprint": fp
+        }
+        key = (error_type, fp)
+        with self._lock:
+            self.total += 1
+            self._recent.append(entry)
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped += 1
+            self._pending.append(entry)
+
+            aggregate = self._aggregates.get(key)
+            if aggregate is None:
+                if len(self._aggregates) >= self.max_aggregates:
+                    oldest = min(self._aggregates, key=lambda k: self._aggregates[k]['last_seen'])
+                    del self._aggregates[oldest]
+                aggregate = self._aggregates[key] = {
+                    "type": error_type, "fingerprint": fp, "message": normalized,
+                    "count": 0, "first_seen": now, "last_seen": now
+                }
+            aggregate['count'] += 1
+            aggregate['last_seen'] = now
+            self._deltas[key] = self._deltas.get(key, 0) + 1
+
+    def pending(self):
+        """Errori in attesa del prossimo flush"""
+        return len(self._pending)
+
+    def recent(self, limit=10):
+        """Ultimi errori, dal più recente"""
+        with self._lock:
+            return list(self._recent)[-limit:][::-1]
+
+    def top(self, limit=10):
+        """Aggregati più frequenti dall'avvio"""
+        with self._lock:
+            aggregates = [dict(a) for a in self._aggregates.values()]
+        return sorted(aggregates, key=lambda a: a['count'], reverse=True)[:limit]
+
+    def flush(self):
+        """Scrive sullo store gli errori e gli aggregati accumulati"""
+        with self._lock:
+            entries = list(self._pending)
+            self._pending.clear()
+            deltas, self._deltas = self._deltas, {}
+            rows = []
+            for key, delta in deltas.items():
+                aggregate = self._aggregates.get(key)
+                if aggregate is not None:
+                    rows.append((aggregate['type'], aggregate['fingerprint'], aggregate['message'],
+                                 delta, aggregate['first_seen'], aggregate['last_seen']))
+
+        if not entries and not rows:
+            return 0
+        written = 0
+        try:
+            if entries:
+                self.store.add_errors(entries, keep_last=self.capacity)
+                written, entries = len(entries), []
+            if rows:
+                self.store.upsert_error_aggregates(rows)
+        except Exception as e:
+            logger.error(f"Flush error log fallito ({len(entries)} errori): {e}")
+            with self._lock:
+                # Riprova al prossimo giro, prima degli errori arrivati nel frattempo
+                if entries:
+                    pending = entries + list(self._pending)
+                    overflow = max(0, len(pending) - self._pending.maxlen)
+                    self.dropped += overflow
+                    self._pending = deque(pending[overflow:], maxlen=self._pending.maxlen)
+                for key, delta in deltas.items():
+                    self._deltas[key] = self._deltas.get(key, 0) + delta
+        return written
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="error-log-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Ferma il flusher e scrive gli ultimi errori"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -0,0 +1,139 @@
+"""
+Fiscal Search Service
+Indice invertito BM25 sulla knowledge base fiscale
+"""
+
+import heapq
+import logging
+import math
+import re
+import unicodedata
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Parole funzionali italiane escluse dall'indice
+ITALIAN_STOPWORDS = frozenset("""
+a ad al allo alla ai agli alle anche come con col coi da dal dallo dalla dai dagli dalle
+del dello della dei degli delle di e ed gli i il in la le lo ma mi ne negli nei nel nello
+nella nelle non o per piu poi quale quali quando quanto questo questa questi queste quello
+quella se si sia sono su sul sullo sulla sui sugli sulle ti tra fra un una uno va vi
+che chi cosa cui ci ha hanno ho essere fare cosi ogni loro mio mia tuo tua suo sua
+""".split())
+
+# Campi dell'articolo indicizzati come corpo del testo
+BODY_FIELDS = ("content", "text", "body", "summary", "abstract", "testo", "contenuto")
+
+TITLE_WEIGHT = 2  # I token del titolo contano doppio
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def strip_accents(text):
+    """Rimuove gli accenti (è -> e, à -> a)"""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def stem(token):
+    """Stemming leggero italiano: avverbi in -mente e vocale finale"""
+    if len(token) > 7 and token.endswith("mente"):
+        token = token[:-5]
+    if len(token) > 4 and token[-1] in "aeio":
+        token = token[:-1]
+    return token
+
+def tokenize(text):
+    """Normalizza un testo in token: minuscolo, senza accenti, stopword e stemming"""
+    text = strip_accents(text.lower())
+    return [stem(t) for t in _TOKEN_RE.findall(text) if t not in ITALIAN_STOPWORDS]
+
+def _article_text(article):
+    """Restituisce (titolo, corpo) di un articolo della knowledge base"""
+    if isinstance(article, str):
+        return "", article
+    if not isinstance(article, dict):
+        return "", ""
+    title = str(article.get('title', '') or '')
+    body = " ".join(str(article[f]) for f in BODY_FIELDS if article.get(f))
+    return title, body
+
+class FiscalSearchIndex:
+    """Indice invertito con ranking BM25 su titoli e corpo degli articoli.
+
+    ``knowledge`` è il dizionario {sezione: [articoli]} della knowledge base.
+    L'indice è immutabile: va ricostruito quando la knowledge base cambia.
+    """
+
+    def __init__(self, knowledge, k1=1.2, b=0.75, version=None):
+        self.k1 = k1
+        self.b = b
+        self.version = version
+        self.titles = []
+        self.postings = {}  # token -> [(doc_id, contributo BM25)]
+        self.idf = {}
+        self._contexts = {}
+        self._build(knowledge or {})
+
+    def _build(self, knowledge):
+        lengths = []
+        for section, articles in knowledge.items():
+            if isinstance(articles, dict):
+                articles = list(articles.values())
+            if not isinstance(articles, list):
+                continue
+            for article in articles:
+                title, body = _article_text(article)
+                terms = Counter()
+                for token in tokenize(title):
+                    terms[token] += TITLE_WEIGHT
+                terms.update(tokenize(body))
+                if not terms:
+                    continue
+
+                doc_id = len(self.titles)
+                self.titles.append(title or section)
+                lengths.append(sum(terms.values()))
+                for token, tf in terms.items():
+                    self.postings.setdefault(token, []).append((doc_id, tf))
+
+        n_docs = len(lengths)
+        avg_len = (sum(lengths) / n_docs) if n_docs else 0.0
+        self.idf = {
+            token: math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for token, docs in self.postings.items()
+        }
+        # Contributo BM25 precalcolato per (token, documento): la ricerca
+        # si riduce a somme sulle posting list dei token della query
+        k1, b = self.k1, self.b
+        for token, docs in self.postings.items():
+            idf = self.idf[token]
+            self.postings[token] = [
+                (doc_id, idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[doc_id] / avg_len)))
+                for doc_id, tf in docs
+            ]
+
+    def __len__(self):
+        return len(self.titles)
+
+    def search(self, query, top_k=5):
+        """Restituisce [(score, titolo)] dei migliori ``top_k`` articoli"""
+        scores = {}
+        get = scores.get
+        for token in set(tokenize(query)):
+            for doc_id, weight in self.postings.get(token, ()):
+                scores[doc_id] = get(doc_id, 0.0) + weight
+
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(score, self.titles[doc_id]) for doc_id, score in best]
+
+    def format_context(self, query, top_k=5):
+        """Contesto normativo per il prompt: un punto elenco per articolo"""
+        return "\n".join(f"• {title}" for _, title in self.search(query, top_k))
+
+    def precompute_contexts(self, queries, top_k=5):
+        """Precalcola i contesti per query statiche {chiave: testo}"""
+        for key, query in queries.items():
+            self._contexts[key] = self.format_context(query, top_k)
+
+    def get_context(self, key):
+        """Contesto precalcolato, o None se la chiave non è stata precalcolata"""
+        return self._contexts.get(key)
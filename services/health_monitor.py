@@ -1,18 +1,241 @@
-"""
-Health Monitor Service
-"""
-
-import logging
-import asyncio
-
-logger = logging.getLogger(__name__)
-
-class HealthMonitor:
-    def __init__(self):
-        self.running = False
-        
-    async def start(self):
-        self.running = True
-        
-    async def stop(self):
-        self.running = False
+"""
+Health Monitor Service
+Metriche (contatori, istogrammi di latenza, gauge) esportate in formato Prometheus
+"""
+
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import psutil
+except ImportError:  # metriche di processo opzionali
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+# Bucket di latenza (secondi): da pochi ms per cache e ricerca fino alle risposte AI lente
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+class Histogram:
+    """Istogramma cumulativo a bucket fissi (una bisect e tre somme per osservazione)"""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # l'ultimo è +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Stima del quantile ``q`` (limite superiore del bucket che lo contiene)"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+class HealthMonitor:
+    """Registro metriche del processo.
+
+    ``inc`` e ``observe`` costano un lookup in un dict e qualche somma sotto
+    un lock non conteso: si possono chiamare su ogni richiesta. I gauge sono
+    callback valutate solo quando ``render`` produce l'output Prometheus
+    (stato di cache, code e circuiti letto al momento dello scrape).
+    """
+
+    def __init__(self, prefix="taxami"):
+        self.prefix = prefix
+        self.running = False
+        self._counters = {}    # nome -> {labels: valore}
+        self._histograms = {}  # nome -> {labels: Histogram}
+        self._gauges = {}      # nome -> callback
+        self._help = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self._process = psutil.Process(os.getpid()) if psutil else None
+        self.started = time.time()
+
+    def _name(self, name):
+        return f"{self.prefix}_{name}"
+
+    def describe(self, name, help_text):
+        self._help[self._name(name)] = help_text
+
+    def inc(self, name, value=1, **labels):
+        """Incrementa un contatore (``name`` senza prefisso, es. ``updates_total``)"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(self._name(name), {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Registra una durata nell'istogramma ``name``"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(self._name(name), {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Misura il blocco ``with`` e lo registra in ``name`` (anche se solleva)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, callback, help_text=None):
+        """Registra un gauge: ``callback()`` restituisce un numero o una lista di (labels dict, numero)"""
+        self._gauges[self._name(name)] = callback
+        if help_text:
+            self.describe(name, help_text)
+
+    def histogram(self, name, **labels):
+        """Copia dell'istogramma (per report e quantili), None se mai osservato"""
+        with self._lock:
+            histogram = self._histograms.get(self._name(name), {}).get(tuple(sorted(labels.items())))
+            if histogram is None:
+                return None
+            snapshot = Histogram(histogram.buckets)
+            snapshot.counts = list(histogram.counts)
+            snapshot.sum, snapshot.count = histogram.sum, histogram.count
+            return snapshot
+
+    def _process_lines(self):
+        values = [("uptime_seconds", "gauge", f"{time.time() - self.started:.1f}")]
+        if self._process is not None:
+            try:
+                memory = self._process.memory_info()
+                cpu = self._process.cpu_times()
+                values.append(("process_resident_memory_bytes", "gauge", memory.rss))
+                values.append(("process_cpu_seconds_total", "counter", f"{cpu.user + cpu.system:.2f}"))
+                values.append(("process_threads", "gauge", self._process.num_threads()))
+            except Exception as e:
+                logger.debug(f"Metriche di processo non disponibili: {e}")
+        lines = []
+        for name, kind, value in values:
+            lines.append(f"# TYPE {self._name(name)} {kind}")
+            lines.append(f"{self._name(name)} {value}")
+        return lines
+
+    def render(self):
+        """Tutte le metriche in formato testo Prometheus (exposition 0.0.4)"""
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {
+                name: {labels: (list(h.counts), h.sum, h.count, h.buckets) for labels, h in series.items()}
+                for name, series in self._histograms.items()
+            }
+
+        lines = []
+        for name in sorted(counters):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in counters[name].items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name in sorted(histograms):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, (counts, total, count, buckets) in histograms[name].items():
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for name in sorted(self._gauges):
+            try:
+                value = self._gauges[name]()
+            except Exception as e:
+                logger.warning(f"Gauge {name} non disponibile: {e}")
+                continue
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            if isinstance(value, list):
+                for labels, item in value:
+                    lines.append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {item}")
+            else:
+                lines.append(f"{name} {value}")
+
+        lines.extend(self._process_lines())
+        return "\n".join(lines) + "\n"
+
+    def start(self, host="0.0.0.0", port=9100):
+        """Espone /metrics su un server HTTP dedicato (thread daemon)"""
+        if self._server is not None:
+            return
+        monitor = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/health"):
+                    self.send_error(404)
+                    return
+                body = (monitor.render() if self.path.startswith("/metrics") else "ok\n").encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True)
+        self._thread.start()
+        self.running = True
+        logger.info(f"Metriche Prometheus su http://{host}:{self._server.server_address[1]}/metrics")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.running = False
+
+_health_monitor = None
+_health_monitor_lock = threading.Lock()
+
+def get_health_monitor():
+    """Registro metriche condiviso dal processo"""
+    global _health_monitor
+    with _health_monitor_lock:
+        if _health_monitor is None:
+            _health_monitor = HealthMonitor()
+        return _health_monitor
@@ -0,0 +1,91 @@
+"""
+Hedged Requests Service
+Richieste "hedged": secondo tentativo in parallelo se il primo tarda, con deadline complessiva
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+class HedgedExecutor:
+    """Esegue una lista di tentativi alternativi e restituisce il primo riuscito.
+
+    ``run(attempts, hedge_after, deadline)`` avvia il primo tentativo; se
+    dopo ``hedge_after`` secondi non ha ancora risposto (o appena fallisce)
+    avvia il successivo in parallelo, e così via. Vince il primo risultato
+    non vuoto: gli altri tentativi ancora in coda vengono annullati, quelli
+    già partiti vengono ignorati. Ogni tentativo è ``func(timeout)`` e riceve
+    il tempo residuo fino alla deadline, così anche un perdente abbandonato
+    non sopravvive oltre. Restituisce ``(risultato, indice del tentativo)``
+    oppure ``(None, None)`` se falliscono tutti o scade la deadline.
+    """
+
+    OUTCOMES = ("primary", "hedge", "failed", "deadline")
+
+    def __init__(self, workers=16, metrics=None, name="openai"):
+        self.name = name
+        self.metrics = metrics
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-hedge")
+        self._counts = dict.fromkeys(self.OUTCOMES + ("hedged",), 0)
+        self._lock = threading.Lock()
+
+    def _count(self, outcome):
+        with self._lock:
+            self._counts[outcome] += 1
+        if self.metrics is not None:
+            self.metrics.inc("hedged_requests_total", dependency=self.name, outcome=outcome)
+
+    def run(self, attempts, hedge_after, deadline):
+        end = time.monotonic() + deadline
+        remaining = list(enumerate(attempts))
+        running = {}
+
+        def _launch():
+            index, func = remaining.pop(0)
+            running[self._executor.submit(func, max(0.1, end - time.monotonic()))] = index
+            return time.monotonic() + hedge_after
+
+        next_hedge = _launch()
+        try:
+            while running:
+                now = time.monotonic()
+                if now >= end:
+                    logger.warning(f"⏱️ {self.name}: deadline di {deadline:.0f}s superata")
+                    self._count("deadline")
+                    return None, None
+                wake = min(end, next_hedge) if remaining else end
+                done, _ = wait(running, timeout=max(0.0, wake - now), return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    index = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.warning(f"{self.name}: tentativo {index + 1} fallito: {e}")
+                        result = None
+                    if result:
+                        self._count("primary" if index == 0 else "hedge")
+                        return result, index
+
+                if remaining and (not running or time.monotonic() >= next_hedge):
+                    if running:
+                        self._count("hedged")
+                        logger.info(f"🏁 {self.name}: nessuna risposta dopo {hedge_after:.1f}s, "
+                                    f"avvio tentativo {len(attempts) - len(remaining) + 1} in parallelo")
+                    next_hedge = _launch()
+
+            self._count("failed")
+            return None, None
+        finally:
+            for future in running:
+                future.cancel()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
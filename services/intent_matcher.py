@@ -0,0 +1,163 @@
+"""
+Intent Matcher Service
+Riconoscimento delle domande del menu nel testo libero con un automa Aho-Corasick
+"""
+
+import logging
+import threading
+from collections import deque
+
+from services.fiscal_search import ITALIAN_STOPWORDS, stem, strip_accents
+
+logger = logging.getLogger(__name__)
+
+MIN_PREFIX_LENGTH = 4  # keyword più corte (iva, srl, 231) solo come parola intera
+GENERIC_WEIGHT = 0.25  # peso delle keyword generiche ("partita", "iva", "fiscale")
+
+def _is_word_char(char):
+    return char.isalnum()
+
+class IntentMatcher:
+    """Automa Aho-Corasick compilato dalle keyword di tutte le domande.
+
+    ``intents`` è {intent_id: [keyword]}. Testo e keyword sono normalizzati
+    (minuscolo, senza accenti); le keyword lunghe vengono ridotte alla radice
+    (``stem``) e riconosciute come inizio di parola ("scadenze" trova anche
+    "scadenza"), quelle corte solo come parola intera. Le stopword ("ma",
+    "chi", "quando") non distinguono nessuna domanda e vengono ignorate.
+    Ogni keyword pesa 1/numero di domande che la usano: "società" conta
+    meno di "concordato". Le keyword in ``generic`` compaiono in domande di
+    ogni tipo e pesano solo ``GENERIC_WEIGHT``: da sole non bastano a
+    riconoscere una domanda. ``exclude`` è {intent_id: [radice]}: una parola
+    che inizia con una di queste radici (non ridotte con ``stem``) esclude la
+    domanda, ad esempio "chiudere" per "come aprire la partita IVA". Una
+    scansione del messaggio dà il punteggio di tutte le domande.
+    """
+
+    def __init__(self, intents, generic=(), exclude=None):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]  # nodo -> [(lunghezza, parola intera, keyword)]
+        self._weights = {}   # keyword normalizzata -> {intent_id: peso}
+        self._specific = {}  # keyword normalizzata -> domande per cui non è generica
+        self._excludes = {}  # radice normalizzata -> domande escluse
+        self.matched = 0
+        self.unmatched = 0
+        self._lock = threading.Lock()
+
+        generic = {strip_accents(keyword.lower().strip()) for keyword in generic}
+        owners = {}
+        for intent_id, keywords in intents.items():
+            for keyword in keywords:
+                normalized = strip_accents(keyword.lower().strip())
+                if not normalized or normalized in ITALIAN_STOPWORDS:
+                    continue
+                owners.setdefault(normalized, set()).add(intent_id)
+        patterns = {}
+        for keyword, intent_ids in owners.items():
+            weight = GENERIC_WEIGHT if keyword in generic else 1.0 / len(intent_ids)
+            self._weights[keyword] = {intent_id: weight for intent_id in intent_ids}
+            if keyword not in generic:
+                self._specific[keyword] = intent_ids
+            whole_word = len(keyword) < MIN_PREFIX_LENGTH
+            patterns[keyword] = (keyword if whole_word else stem(keyword), whole_word)
+        for intent_id, roots in (exclude or {}).items():
+            for root in roots:
+                normalized = strip_accents(root.lower().strip())
+                self._excludes.setdefault(normalized, set()).add(intent_id)
+                patterns.setdefault(normalized, (normalized, False))
+        for keyword, (pattern, whole_word) in patterns.items():
+            self._add(pattern, whole_word, keyword)
+        self._build_failure_links()
+
+    def _add(self, pattern, whole_word, keyword):
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        self._output[node].append((len(pattern), whole_word, keyword))
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._output[child].extend(self._output[self._fail[child]])
+
+    def keywords(self, text):
+        """Keyword distinte presenti nel testo (una sola passata)"""
+        text = strip_accents(text.lower())
+        found = set()
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length, whole_word, keyword in self._output[node]:
+                start = end - length + 1
+                if start > 0 and _is_word_char(text[start - 1]):
+                    continue
+                if whole_word and end + 1 < len(text) and _is_word_char(text[end + 1]):
+                    continue
+                found.add(keyword)
+        return found
+
+    def _scores(self, text, allowed=None):
+        """({intent_id: punteggio}, domande con una keyword specifica) senza le domande escluse"""
+        found = self.keywords(text)
+        excluded = set()
+        for keyword in found:
+            excluded.update(self._excludes.get(keyword, ()))
+        scores = {}
+        specific = set()
+        for keyword in found:
+            for intent_id, weight in self._weights.get(keyword, {}).items():
+                if intent_id in excluded or (allowed is not None and intent_id not in allowed):
+                    continue
+                scores[intent_id] = scores.get(intent_id, 0.0) + weight
+                if intent_id in self._specific.get(keyword, ()):
+                    specific.add(intent_id)
+        return scores, specific
+
+    def scores(self, text, allowed=None):
+        """{intent_id: punteggio} delle domande con almeno una keyword nel testo"""
+        return self._scores(text, allowed)[0]
+
+    def match(self, text, allowed=None, min_score=1.5, threshold=0.75):
+        """(intent_id, confidenza) se una domanda è riconosciuta con sicurezza, altrimenti (None, confidenza).
+
+        Servono almeno ``min_score`` punti, almeno una keyword non generica
+        della domanda e una confidenza (quota del punteggio della migliore
+        sulla somma con la seconda) >= ``threshold``.
+        """
+        scores, specific = self._scores(text, allowed)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        if not ranked:
+            confidence, intent_id = 0.0, None
+        else:
+            best_id, best = ranked[0]
+            runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+            confidence = best / (best + runner_up)
+            recognized = best >= min_score and confidence >= threshold and best_id in specific
+            intent_id = best_id if recognized else None
+        with self._lock:
+            if intent_id is None:
+                self.unmatched += 1
+            else:
+                self.matched += 1
+        return intent_id, confidence
+
+    def stats(self):
+        with self._lock:
+            return {"matched": self.matched, "unmatched": self.unmatched, "keywords": len(self._weights)}
@@ -0,0 +1,127 @@
+"""
+Fiscal Knowledge Base Service
+Knowledge base caricata una volta e ricaricata solo per i file modificati
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class FiscalKnowledgeBase:
+    """Knowledge base fiscale condivisa dal processo.
+
+    Ogni file ``<sezione>.json`` della directory diventa una sezione. Il
+    controllo delle modifiche (mtime e dimensione) avviene al massimo ogni
+    ``check_interval`` secondi e ricarica solo i file cambiati. ``version``
+    aumenta ad ogni modifica effettiva, così le cache a valle possono usarla
+    come chiave; ``fingerprint`` identifica il contenuto anche tra riavvii
+    (hash di nome, mtime e dimensione dei file) per le cache persistenti.
+    """
+
+    def __init__(self, path, check_interval=30):
+        self.path = path
+        self.check_interval = check_interval
+        self.version = 0
+        self.fingerprint = ""
+        self._sections = {}
+        self._signatures = {}  # filename -> (mtime_ns, size)
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        """Restituisce {filename: (mtime_ns, size)} dei file JSON presenti"""
+        signatures = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and entry.is_file():
+                    stat = entry.stat()
+                    signatures[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return signatures
+
+    @staticmethod
+    def _fingerprint(signatures):
+        digest = hashlib.sha1(repr(sorted(signatures.items())).encode('utf-8'))
+        return digest.hexdigest()[:12]
+
+    def _load_file(self, filename):
+        """Legge un singolo file della knowledge base"""
+        file_path = os.path.join(self.path, filename)
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Errore lettura knowledge base {file_path}: {e}")
+            return None
+
+    def refresh(self, force=False):
+        """Ricarica i file modificati; restituisce True se qualcosa è cambiato"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_check and now - self._last_check < self.check_interval:
+                return False
+            self._last_check = now
+
+            if not os.path.isdir(self.path):
+                if self._sections:
+                    logger.warning("Database fiscale non più disponibile")
+                    self._sections = {}
+                    self._signatures = {}
+                    self.version += 1
+                    self.fingerprint = ""
+                    return True
+                return False
+
+            try:
+                signatures = self._scan()
+            except OSError as e:
+                logger.error(f"Errore scansione knowledge base: {e}")
+                return False
+
+            sections = dict(self._sections)
+            changed = False
+
+            for filename in self._signatures.keys() - signatures.keys():
+                sections.pop(filename[:-len('.json')], None)
+                changed = True
+
+            loaded = {}
+            for filename, signature in signatures.items():
+                if self._signatures.get(filename) == signature:
+                    loaded[filename] = signature
+                    continue
+                data = self._load_file(filename)
+                section = filename[:-len('.json')]
+                if data is None:
+                    # Lettura fallita (es. file a metà scrittura): resta la sezione precedente
+                    # e la firma vecchia, così il file viene riletto al prossimo controllo
+                    if filename in self._signatures:
+                        loaded[filename] = self._signatures[filename]
+                    continue
+                if data:
+                    sections[section] = data
+                else:
+                    sections.pop(section, None)
+                loaded[filename] = signature
+                changed = True
+
+            self._signatures = loaded
+            if changed:
+                # Sostituzione atomica: i lettori vedono sempre uno snapshot coerente
+                self._sections = sections
+                self.version += 1
+                self.fingerprint = self._fingerprint(loaded)
+                logger.info(f"Knowledge base aggiornata: {len(sections)} sezioni (v{self.version})")
+            return changed
+
+    def get_knowledge(self):
+        """Snapshot corrente {sezione: articoli}, con controllo modifiche periodico"""
+        self.refresh()
+        return self._sections
+
+    def __len__(self):
+        return len(self._sections)
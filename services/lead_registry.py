@@ -0,0 +1,135 @@
+"""
+Lead Registry Service
+Indice dei lead in memoria con log append-only e compattazione in background
+"""
+
+import csv
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FIELDS = ["id", "username", "first_name", "last_name", "timestamp", "last_interaction", "interactions"]
+
+class LeadRegistry:
+    """Registro dei lead indicizzato per user id.
+
+    Ogni interazione aggiorna l'indice in memoria e aggiunge una riga al log
+    ``lead_events`` (un solo INSERT, costo indipendente dal numero di lead).
+    Un thread in background consolida periodicamente il log nella tabella
+    ``leads``; all'avvio l'indice viene ricostruito da tabella + log residuo.
+    Con ``shared`` (più processi sullo stesso store) ``count`` legge lo store,
+    perché l'indice locale vede solo i lead nuovi del proprio processo.
+    """
+
+    def __init__(self, store, compact_interval=60.0, compact_threshold=500):
+        self.store = store
+        self.compact_interval = compact_interval
+        self.compact_threshold = compact_threshold
+        self.shared = False
+        self._index = {}
+        self._pending_events = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self.load()
+
+    @staticmethod
+    def _apply(index, user_id, user, timestamp):
+        lead = index.get(user_id)
+        if lead is None:
+            index[user_id] = {
+                "id": user_id,
+                "username": user.get('username', ''),
+                "first_name": user.get('first_name', ''),
+                "last_name": user.get('last_name', ''),
+                "timestamp": timestamp,
+                "last_interaction": None,
+                "interactions": 1
+            }
+            return True
+        lead['interactions'] = lead.get('interactions', 0) + 1
+        lead['last_interaction'] = timestamp
+        return False
+
+    def load(self):
+        """Ricostruisce l'indice dalla tabella leads più gli eventi non compattati"""
+        index = {lead['id']: lead for lead in self.store.iter_leads()}
+        pending = 0
+        for event in self.store.iter_lead_events():
+            self._apply(index, event['user_id'], event, event['timestamp'])
+            pending += 1
+        with self._lock:
+            self._index = index
+            self._pending_events = pending
+
+    def record_interaction(self, user):
+        """Registra un'interazione; restituisce True se il lead è nuovo"""
+        user_id = str(user.get('id'))
+        timestamp = datetime.now().isoformat()
+        with self._lock:
+            self.store.append_lead_event(user, timestamp)
+            is_new = self._apply(self._index, user_id, user, timestamp)
+            self._pending_events += 1
+            if self._pending_events >= self.compact_threshold:
+                self._wake.set()
+        return is_new
+
+    def get(self, user_id):
+        lead = self._index.get(str(user_id))
+        return dict(lead) if lead else None
+
+    def count(self):
+        """Numero di lead, O(1) (dallo store se condiviso tra processi)"""
+        if self.shared:
+            self.compact()
+            return self.store.count_leads()
+        return len(self._index)
+
+    def compact(self):
+        """Consolida il log degli eventi nella tabella leads"""
+        try:
+            compacted = self.store.compact_lead_events()
+        except Exception as e:
+            logger.error(f"Compattazione lead fallita: {e}")
+            return 0
+        with self._lock:
+            self._pending_events = max(0, self._pending_events - compacted)
+        if compacted:
+            logger.info(f"Lead compattati: {compacted} eventi")
+        return compacted
+
+    def export_csv(self, fileobj):
+        """Scrive tutti i lead in CSV riga per riga (senza caricarli in una lista)"""
+        self.compact()
+        writer = csv.DictWriter(fileobj, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        rows = 0
+        for lead in self.store.iter_leads():
+            writer.writerow(lead)
+            rows += 1
+        return rows
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.compact_interval)
+            self._wake.clear()
+            if self._pending_events:
+                self.compact()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="lead-compactor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Ferma la compattazione in background ed esegue l'ultima"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.compact()
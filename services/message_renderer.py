@@ -0,0 +1,134 @@
+"""
+Message Renderer Service
+Tastiere pre-serializzate, template validati e Markdown di Telegram sempre valido
+"""
+
+import json
+import logging
+import re
+from string import Formatter
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+# Caratteri speciali del Markdown "legacy" di Telegram (parse_mode="Markdown")
+_MARKER_RE = re.compile(r"[*_`\[\\]|https?://")
+_ESCAPE_RE = re.compile(r"([*_`\[])")
+_UNESCAPED_RE = re.compile(r"(?<!\\)([*_`\[])")
+_LINK_RE = re.compile(r"\[[^\[\]\n]*\]\([^)\s]+\)")
+_URL_RE = re.compile(r"https?://[^\s)\]]+")
+
+# Markdown "GitHub" tipico delle risposte AI, convertito nell'equivalente Telegram
+_AI_BOLD_RE = re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*")
+_AI_HEADING_RE = re.compile(r"^[ \t]*#{1,6}[ \t]+(.+?)[ \t#]*$", re.MULTILINE)
+_AI_BULLET_RE = re.compile(r"^([ \t]*)[*\-+][ \t]+", re.MULTILINE)
+
+def escape_markdown(text):
+    """Testo letterale (nomi utente, messaggi di errore) da inserire in un messaggio Markdown"""
+    return _ESCAPE_RE.sub(r"\\\1", str(text))
+
+def _balance(text):
+    """(testo, marcatori spaiati): ogni entità non chiusa viene escapata.
+
+    Regole del parser Telegram: asterisco, underscore, backtick e triplo
+    backtick aprono un'entità che dura fino allo stesso marcatore (senza
+    annidamento), la parentesi quadra apre un link ``[testo](url)``.
+    Un'entità senza chiusura fa rifiutare tutto il messaggio ("can't parse
+    entities").
+    """
+    parts = []
+    unmatched = 0
+    position = 0
+    match = _MARKER_RE.search(text)
+    while match:
+        start = match.start()
+        token = match.group()
+        end = start + 1
+        if token == "\\":
+            # Escape già presente: il carattere successivo resta letterale
+            end = min(len(text), start + 2)
+            parts.append(text[position:end])
+        elif token == "[":
+            link = _LINK_RE.match(text, start)
+            if link:
+                end = link.end()
+                parts.append(text[position:end])
+            else:
+                unmatched += 1
+                parts.append(text[position:start] + "\\[")
+        elif token.startswith("http"):
+            url = _URL_RE.match(text, start)
+            end = url.end() if url else start + len(token)
+            # "_" e "*" negli URL non devono aprire entità (link automatici di Telegram)
+            parts.append(text[position:start] + _UNESCAPED_RE.sub(r"\\\1", text[start:end]))
+        else:
+            fence = "```" if text.startswith("```", start) else token
+            close = text.find(fence, start + len(fence))
+            if close != -1:
+                end = close + len(fence)
+                parts.append(text[position:end])
+            else:
+                unmatched += 1
+                parts.append(text[position:start] + "\\" + token)
+        position = end
+        match = _MARKER_RE.search(text, position)
+    parts.append(text[position:])
+    return "".join(parts), unmatched
+
+def sanitize_markdown(text, limit=MAX_MESSAGE_LENGTH):
+    """Markdown interpretabile da Telegram di al massimo ``limit`` caratteri, escape compresi"""
+    sanitized = _balance(text[:limit])[0]
+    if len(sanitized) <= limit:
+        return sanitized
+    # Gli escape aggiunti superano il limite: il prefisso più lungo che ci sta dopo il bilanciamento
+    best, low, high = "", 0, limit - 1
+    while low <= high:
+        cut = (low + high) // 2
+        candidate = _balance(text[:cut])[0]
+        if len(candidate) <= limit:
+            best, low = candidate, cut + 1
+        else:
+            high = cut - 1
+    return best
+
+def is_valid_markdown(text):
+    """True se Telegram interpreterebbe il testo senza errori di parsing"""
+    return _balance(text)[1] == 0
+
+def render_ai_markdown(text):
+    """Risposta AI in Markdown Telegram: titoli e **grassetto** in *grassetto*, elenchi puntati con •"""
+    text = _AI_HEADING_RE.sub(lambda m: "*" + m.group(1).replace("*", "") + "*", text)
+    text = _AI_BOLD_RE.sub(r"*\1*", text)
+    text = _AI_BULLET_RE.sub(r"\1• ", text)
+    return _balance(text)[0]
+
+class MessageRenderer:
+    """Tastiere e testi statici preparati una volta all'avvio.
+
+    ``add_keyboard`` serializza subito la tastiera in JSON: la Bot API accetta
+    ``reply_markup`` come stringa JSON, quindi gli invii la riusano così com'è.
+    ``add_template`` verifica che il testo fisso sia Markdown valido (errore
+    all'avvio invece che a ogni invio); ``render`` inserisce i valori
+    escapati, per cui il risultato è sempre valido.
+    """
+
+    def __init__(self):
+        self._keyboards = {}
+        self._templates = {}
+
+    def add_keyboard(self, name, keyboard):
+        self._keyboards[name] = json.dumps(keyboard, ensure_ascii=False, separators=(",", ":"))
+        return self._keyboards[name]
+
+    def keyboard(self, name):
+        return self._keyboards[name]
+
+    def add_template(self, name, text):
+        fields = {field for _, field, _, _ in Formatter().parse(text) if field}
+        if not is_valid_markdown(text.format(**dict.fromkeys(fields, ""))):
+            raise ValueError(f"Template {name}: Markdown non valido")
+        self._templates[name] = text
+
+    def render(self, template, /, **values):
+        return self._templates[template].format(**{key: escape_markdown(value) for key, value in values.items()})
@@ -0,0 +1,78 @@
+"""
+Message Streamer Service
+Risposte progressive su Telegram tramite editMessageText a frequenza limitata
+"""
+
+import logging
+import time
+
+from services.telegram_client import TelegramAPIError
+
+logger = logging.getLogger(__name__)
+
+STREAM_CURSOR = " ▌"
+MAX_MESSAGE_LENGTH = 4096
+
+class StreamingMessage:
+    """Messaggio Telegram aggiornato man mano che arriva il testo.
+
+    ``start()`` invia subito il placeholder; ``append()`` accumula i delta
+    dello stream e modifica il messaggio al massimo ogni ``min_interval``
+    secondi (limite edit di Telegram per chat). I 429 spostano in avanti la
+    prossima modifica di ``retry_after`` secondi invece di essere ritentati.
+    Le modifiche intermedie sono in testo semplice: il Markdown parziale
+    potrebbe non essere valido.
+    """
+
+    def __init__(self, telegram, chat_id, placeholder, min_interval=1.5):
+        self.telegram = telegram
+        self.chat_id = chat_id
+        self.placeholder = placeholder
+        self.min_interval = min_interval
+        self.message_id = None
+        self.edits = 0
+        self._parts = []
+        self._next_edit = 0.0
+        self._last_text = None
+
+    def start(self):
+        """Invia il placeholder; restituisce False se l'invio non è riuscito"""
+        if self.message_id is not None:
+            return True
+        try:
+            response = self.telegram.send_message(self.chat_id, self.placeholder, parse_mode=None)
+            self.message_id = response["result"]["message_id"]
+            self._next_edit = time.monotonic() + self.min_interval
+        except Exception as e:
+            logger.warning(f"Placeholder streaming non inviato a chat {self.chat_id}: {e}")
+        return self.message_id is not None
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    def append(self, delta):
+        """Aggiunge un frammento di testo e aggiorna il messaggio se consentito"""
+        self._parts.append(delta)
+        if self.message_id is None or time.monotonic() < self._next_edit:
+            return
+        self._edit(self.text[:MAX_MESSAGE_LENGTH - len(STREAM_CURSOR)] + STREAM_CURSOR)
+
+    def _edit(self, text):
+        if text == self._last_text:
+            return
+        self._next_edit = time.monotonic() + self.min_interval
+        try:
+            self.telegram.edit_message_text(self.chat_id, self.message_id, text, parse_mode=None)
+            self._last_text = text
+            self.edits += 1
+        except TelegramAPIError as e:
+            if e.retry_after:
+                self._next_edit = time.monotonic() + e.retry_after
+            logger.debug(f"Edit streaming saltato per chat {self.chat_id}: {e}")
+        except Exception as e:
+            logger.debug(f"Edit streaming saltato per chat {self.chat_id}: {e}")
+
+    def reset(self):
+        """Scarta il testo accumulato (es. stream interrotto e rigenerato)"""
+        self._parts = []
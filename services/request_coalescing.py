@@ -0,0 +1,114 @@
+"""
+Request Coalescing Service
+Single-flight delle richieste identiche in corso e debounce dei tap ripetuti
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Una sola esecuzione per chiave tra le chiamate concorrenti.
+
+    ``do(key, func, *args)`` esegue ``func`` se nessun'altra chiamata con la
+    stessa chiave è in corso; altrimenti attende quella in corso e ne
+    restituisce il risultato (o ne rilancia l'eccezione). Non è una cache:
+    finita l'esecuzione la chiave viene rimossa e la chiamata successiva
+    riparte. Restituisce ``(risultato, condiviso)``.
+    """
+
+    def __init__(self, name="singleflight", metrics=None):
+        self.name = name
+        self.metrics = metrics
+        self.executed = 0
+        self.deduplicated = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                call.waiters += 1
+                self.deduplicated += 1
+
+        if not leader:
+            if self.metrics is not None:
+                self.metrics.inc("coalesced_requests_total", kind=self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            if call.waiters:
+                logger.info(f"🔗 {self.name}: risultato condiviso con {call.waiters} richieste identiche")
+        return call.result, False
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        with self._lock:
+            return {"executed": self.executed, "deduplicated": self.deduplicated, "in_flight": len(self._calls)}
+
+class Debouncer:
+    """Scarta le ripetizioni della stessa chiave entro ``window`` secondi.
+
+    ``allow(key)`` è True per il primo evento e False per quelli che arrivano
+    entro la finestra (misurata dal primo, non allungata dai doppi tap).
+    Le chiavi scadute vengono rimosse a ogni ``max_keys`` inserimenti.
+    """
+
+    def __init__(self, window=2.0, max_keys=10000, name="debounce", metrics=None):
+        self.window = window
+        self.max_keys = max_keys
+        self.name = name
+        self.metrics = metrics
+        self.suppressed = 0
+        self._seen = {}  # chiave -> istante del primo evento
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen < self.window:
+                self.suppressed += 1
+                suppressed = True
+            else:
+                suppressed = False
+                self._seen[key] = now
+                if len(self._seen) > self.max_keys:
+                    self._seen = {k: t for k, t in self._seen.items() if now - t < self.window}
+        if suppressed and self.metrics is not None:
+            self.metrics.inc("coalesced_requests_total", kind=self.name)
+        return not suppressed
+
+    def stats(self):
+        with self._lock:
+            return {"suppressed": self.suppressed, "tracked": len(self._seen)}
@@ -0,0 +1,102 @@
+"""
+Response Cache Service
+Cache LRU con TTL delle risposte AI alle domande del menu, persistita su disco
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    """Cache a chiave esatta con scadenza (TTL) ed eviction LRU.
+
+    Con uno ``store`` (StateStore) ogni inserimento viene scritto anche su
+    SQLite e all'avvio le voci non scadute vengono ricaricate: la cache resta
+    calda tra i riavvii.
+    """
+
+    def __init__(self, max_entries=500, ttl=86400, store=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, created_at)
+        self._lock = threading.Lock()
+        if store is not None:
+            self._load()
+
+    @staticmethod
+    def make_key(*parts):
+        """Chiave testuale stabile, es. make_key("q", "1", "free", "gpt-3.5-turbo", 400, "ab12")"""
+        return "|".join(str(p) for p in parts)
+
+    def _load(self):
+        try:
+            for key, value, created_at in self.store.load_cache_entries(time.time() - self.ttl, self.max_entries):
+                self._entries[key] = (value, created_at)
+            if self._entries:
+                logger.info(f"Response cache: {len(self._entries)} risposte ricaricate")
+        except Exception as e:
+            logger.error(f"Errore caricamento response cache: {e}")
+
+    def get(self, key):
+        """Risposta in cache o None (le voci scadute vengono rimosse)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, created_at = entry
+            if time.time() - created_at > self.ttl:
+                del self._entries[key]
+                self.misses += 1
+                expired = True
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if expired:
+            self._persist_delete([key])
+        return None
+
+    def put(self, key, value):
+        created_at = time.time()
+        evicted = []
+        with self._lock:
+            self._entries[key] = (value, created_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+
+        if self.store is not None:
+            try:
+                self.store.put_cache_entry(key, value, created_at)
+            except Exception as e:
+                logger.error(f"Errore salvataggio response cache: {e}")
+        if evicted:
+            self._persist_delete(evicted)
+
+    def _persist_delete(self, keys):
+        if self.store is None:
+            return
+        try:
+            self.store.delete_cache_entries(keys)
+        except Exception as e:
+            logger.error(f"Errore pulizia response cache: {e}")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,170 @@
+"""
+Semantic Cache Service
+Cache per similarità delle domande libere (hashing vectors + coseno in NumPy)
+"""
+
+import logging
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from services.fiscal_search import ITALIAN_STOPWORDS, strip_accents
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_NUMBER_SEPARATOR_RE = re.compile(r"(?<=\d)[.,](?=\d)")
+
+# Negazioni: non sono stopword qui, "posso detrarre" e "non posso detrarre" vanno distinte
+NEGATIONS = frozenset("non senza mai nessun nessuno nessuna niente nulla neanche nemmeno neppure".split())
+
+# Desinenze verbali e nominali: "apro", "aprire" e "aperto" condividono la radice
+_SUFFIXES = (
+    "azione", "azioni", "amento", "imento", "mente", "iamo", "ando", "endo",
+    "are", "ere", "ire", "ato", "ata", "ati", "ate", "ito", "ita", "iti", "ite", "uto", "uta", "uti", "ute",
+)
+
+def _stem(token):
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)]
+    if len(token) > 3 and token[-1] in "aeio":
+        token = token[:-1]
+    return token
+
+def normalize(text):
+    """(radici, guardia): la guardia (numeri, negazione) deve coincidere per un hit.
+
+    Importi e anni ("reddito 50000" contro "reddito 90000") e la presenza di
+    una negazione cambiano la risposta anche quando il resto della domanda è
+    identico, quindi restano fuori dal vettore e vanno confrontati esattamente.
+    """
+    text = _NUMBER_SEPARATOR_RE.sub("", strip_accents(text.lower()))
+    stems = []
+    numbers = set()
+    negated = False
+    for token in _TOKEN_RE.findall(text):
+        if token.isdigit():
+            numbers.add(token.lstrip("0") or "0")
+        elif token in NEGATIONS:
+            negated = True
+        elif token not in ITALIAN_STOPWORDS:
+            stems.append(_stem(token))
+    return stems, (frozenset(numbers), negated)
+
+class _Namespace:
+    """Matrice pre-allocata di vettori normalizzati con le relative risposte"""
+
+    def __init__(self, capacity, dims):
+        self.matrix = np.zeros((capacity, dims), dtype=np.float32)
+        self.answers = [None] * capacity
+        self.questions = [None] * capacity
+        self.guards = [None] * capacity
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.size = 0
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+
+class SemanticCache:
+    """Restituisce una risposta già data a una domanda abbastanza simile.
+
+    Il testo viene normalizzato (accenti, stopword, radici verbali) e
+    trasformato in un vettore a ``dims`` dimensioni tramite feature hashing di
+    parole e trigrammi di caratteri. La ricerca è un prodotto matrice-vettore
+    (similarità coseno): vince la voce più simile sopra soglia con la stessa
+    guardia di numeri e negazione (vedi ``normalize``).
+    Ogni namespace (es. tier free/premium) ha una capacità fissa; quando è
+    pieno viene sostituita la voce usata meno di recente.
+    """
+
+    def __init__(self, threshold=0.78, capacity=1000, dims=2048):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.dims = dims
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def _hash(self, feature):
+        return zlib.crc32(feature.encode('utf-8')) % self.dims
+
+    def vectorize(self, text):
+        """(vettore L2-normalizzato, guardia) del testo; vettore None se non contiene termini utili"""
+        stems, guard = normalize(text)
+        vector = np.zeros(self.dims, dtype=np.float32)
+        for token in stems:
+            vector[self._hash(token)] += 1.0
+            padded = f"#{token}#"
+            for i in range(len(padded) - 2):
+                vector[self._hash(padded[i:i + 3])] += 0.5
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None, guard
+        return vector / norm, guard
+
+    def _namespace(self, name):
+        namespace = self._namespaces.get(name)
+        if namespace is None:
+            namespace = self._namespaces[name] = _Namespace(self.capacity, self.dims)
+        return namespace
+
+    def lookup(self, namespace, text, threshold=None):
+        """Restituisce (risposta, similarità) del miglior match sopra soglia, o (None, similarità)"""
+        threshold = self.threshold if threshold is None else threshold
+        vector, guard = self.vectorize(text)
+        with self._lock:
+            ns = self._namespace(namespace)
+            ns.lookups += 1
+            if vector is None or not ns.size:
+                return None, 0.0
+
+            similarities = ns.matrix[:ns.size] @ vector
+            # Candidati sopra soglia dal più simile: il primo con la stessa guardia
+            candidates = np.flatnonzero(similarities >= threshold)
+            for row in candidates[np.argsort(-similarities[candidates])]:
+                if ns.guards[row] == guard:
+                    ns.hits += 1
+                    ns.last_used[row] = time.monotonic()
+                    return ns.answers[row], float(similarities[row])
+            return None, float(similarities.max())
+
+    def add(self, namespace, text, answer):
+        """Memorizza la risposta alla domanda, sostituendo la voce LRU se pieno"""
+        vector, guard = self.vectorize(text)
+        if vector is None:
+            return
+        with self._lock:
+            ns = self._namespace(namespace)
+            if ns.size < self.capacity:
+                row = ns.size
+                ns.size += 1
+            else:
+                row = int(np.argmin(ns.last_used))
+                ns.evictions += 1
+            ns.matrix[row] = vector
+            ns.answers[row] = answer
+            ns.questions[row] = text
+            ns.guards[row] = guard
+            ns.last_used[row] = time.monotonic()
+
+    def clear(self):
+        """Svuota tutti i namespace (es. dopo un aggiornamento della knowledge base)"""
+        with self._lock:
+            self._namespaces.clear()
+
+    def stats(self):
+        """Contatori per namespace: voci, lookup, hit, hit ratio, eviction"""
+        with self._lock:
+            return {
+                name: {
+                    "entries": ns.size,
+                    "lookups": ns.lookups,
+                    "hits": ns.hits,
+                    "hit_ratio": ns.hits / ns.lookups if ns.lookups else 0.0,
+                    "evictions": ns.evictions,
+                }
+                for name, ns in self._namespaces.items()
+            }
@@ -0,0 +1,271 @@
+"""
+Send Scheduler Service
+Coda di invio verso Telegram con limiti globali e per chat e gestione dei 429
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from services.telegram_client import TelegramAPIError
+
+logger = logging.getLogger(__name__)
+
+# Lane di priorità: numero più basso = servito prima
+PRIORITY_CALLBACK = 0
+PRIORITY_MESSAGE = 1
+PRIORITY_EDIT = 2
+LANE_NAMES = {PRIORITY_CALLBACK: "callback", PRIORITY_MESSAGE: "message", PRIORITY_EDIT: "edit"}
+
+class SendTimeout(Exception):
+    """Il job è rimasto in coda oltre il timeout ed è stato annullato: nessun invio è avvenuto"""
+
+class TokenBucket:
+    """Token bucket classico: ``rate`` token/s, al massimo ``capacity`` accumulati"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now):
+        """Secondi prima che un token sia disponibile (0 se disponibile ora)"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def pause(self, until):
+        self.paused_until = max(self.paused_until, until)
+
+class _Job:
+    __slots__ = ("chat_id", "priority", "func", "args", "kwargs", "future", "attempts", "started")
+
+    def __init__(self, chat_id, priority, func, args, kwargs):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+        self.started = False
+
+class SendScheduler:
+    """Scheduler delle chiamate in uscita verso la Bot API.
+
+    Ogni chat ha un limite GCRA (``per_chat_rate`` msg/s con burst
+    ``per_chat_burst``) applicato al momento dell'accodamento: il job diventa
+    eleggibile solo quando la sua chat può ricevere. Tra i job eleggibili
+    viene servita prima la lane a priorità più alta, rispettando il token
+    bucket globale (``global_rate`` chiamate/s). Un 429 sposta la chat (o
+    l'intero scheduler, per chiamate senza chat) avanti di ``retry_after``
+    secondi e ri-accoda il job, senza contarlo come errore.
+    """
+
+    def __init__(self, global_rate=30, per_chat_rate=1.0, per_chat_burst=3, workers=8, max_throttle_retries=3):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_interval = 1.0 / per_chat_rate
+        self.chat_burst = per_chat_burst
+        self.max_throttle_retries = max_throttle_retries
+        self._chat_tat = {}  # chat_id -> theoretical arrival time (GCRA)
+        self._waiting = []   # (ready_at, seq, job)
+        self._eligible = []  # (priority, seq, job)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="telegram-send")
+        self.sent = 0
+        self.throttled = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.in_flight = 0
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name="send-scheduler", daemon=True)
+        self._thread.start()
+
+    def _reserve_chat(self, chat_id, now):
+        """Restituisce l'istante in cui la chat può ricevere il prossimo invio"""
+        if chat_id is None:
+            return now
+        tat = max(self._chat_tat.get(chat_id, now), now)
+        ready_at = max(now, tat - (self.chat_burst - 1) * self.chat_interval)
+        self._chat_tat[chat_id] = tat + self.chat_interval
+        if len(self._chat_tat) > 10000:
+            # Le chat inattive non servono più: il loro TAT è nel passato
+            self._chat_tat = {c: t for c, t in self._chat_tat.items() if t > now}
+        return ready_at
+
+    def _enqueue(self, job, ready_at):
+        heapq.heappush(self._waiting, (ready_at, next(self._seq), job))
+        self._cond.notify()
+
+    def submit(self, chat_id, priority, func, *args, **kwargs):
+        """Accoda ``func(*args, **kwargs)`` e restituisce un Future con il risultato"""
+        job = _Job(chat_id, priority, func, args, kwargs)
+        with self._cond:
+            if not self.running:
+                raise RuntimeError("Send scheduler fermato")
+            self._enqueue(job, self._reserve_chat(chat_id, time.monotonic()))
+        return job.future
+
+    def call(self, chat_id, priority, func, *args, timeout=30, **kwargs):
+        """Come ``submit`` ma attende il risultato (o rilancia l'eccezione).
+
+        Se dopo ``timeout`` secondi il job è ancora in coda viene annullato e
+        si ottiene ``SendTimeout``: un nuovo tentativo del chiamante non
+        duplica il messaggio. Un job già partito viene invece atteso, la sua
+        durata è limitata dal timeout HTTP del client.
+        """
+        future = self.submit(chat_id, priority, func, *args, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            if future.cancel():
+                raise SendTimeout(f"invio non partito entro {timeout}s (chat {chat_id})") from None
+            return future.result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = None
+                while job is None:
+                    now = time.monotonic()
+                    while self._waiting and self._waiting[0][0] <= now:
+                        _, seq, ready = heapq.heappop(self._waiting)
+                        heapq.heappush(self._eligible, (ready.priority, seq, ready))
+
+                    # Job annullati dal chiamante (timeout in coda): si scartano senza usare token
+                    for queue in (self._eligible, self._waiting):
+                        while queue and queue[0][2].future.cancelled():
+                            heapq.heappop(queue)
+                            self.cancelled += 1
+
+                    if not self.running and not self._waiting and not self._eligible:
+                        return
+
+                    timeout = self._waiting[0][0] - now if self._waiting else None
+                    if self._eligible:
+                        wait = self.global_bucket.wait_time(now)
+                        if wait == 0:
+                            job = heapq.heappop(self._eligible)[2]
+                            # Da qui il job non è più annullabile (i re-invii dopo un 429 sono già partiti)
+                            if not job.started and not job.future.set_running_or_notify_cancel():
+                                self.cancelled += 1
+                                job = None
+                                continue
+                            job.started = True
+                            self.global_bucket.consume()
+                            self.in_flight += 1
+                            break
+                        timeout = wait if timeout is None else min(timeout, wait)
+                    self._cond.wait(timeout)
+
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        try:
+            result = job.func(*job.args, **job.kwargs)
+        except TelegramAPIError as e:
+            if e.retry_after and job.attempts < self.max_throttle_retries:
+                job.attempts += 1
+                with self._cond:
+                    self.throttled += 1
+                    self.in_flight -= 1
+                    until = time.monotonic() + e.retry_after
+                    if job.chat_id is None:
+                        self.global_bucket.pause(until)
+                    else:
+                        self._chat_tat[job.chat_id] = max(self._chat_tat.get(job.chat_id, 0), until)
+                    self._enqueue(job, until)
+                logger.warning(f"429 da Telegram (chat {job.chat_id}): riprovo tra {e.retry_after}s")
+                return
+            self._finish(job, exception=e)
+        except Exception as e:
+            self._finish(job, exception=e)
+        else:
+            self._finish(job, result=result)
+
+    def _finish(self, job, result=None, exception=None):
+        with self._cond:
+            self.in_flight -= 1
+            if exception is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+        if exception is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(exception)
+
+    def stats(self):
+        """Profondità delle code per lane e contatori di invio"""
+        with self._cond:
+            depth = {name: 0 for name in LANE_NAMES.values()}
+            for entry in itertools.chain(self._eligible, self._waiting):
+                lane = LANE_NAMES.get(entry[2].priority, "other")
+                depth[lane] = depth.get(lane, 0) + 1
+            return {
+                "queue_depth": depth,
+                "queued": len(self._eligible) + len(self._waiting),
+                "in_flight": self.in_flight,
+                "sent": self.sent,
+                "throttled_429": self.throttled,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+            }
+
+    def shutdown(self, wait=True):
+        """Smette di accettare job; con wait=True svuota la coda prima di uscire"""
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        if wait:
+            self._thread.join()
+        self._executor.shutdown(wait=wait)
+
+class RateLimitedTelegram:
+    """Facciata di TelegramClient che instrada gli invii sullo SendScheduler.
+
+    Espone gli stessi metodi del client: i chiamanti (handler, streaming)
+    non cambiano. ``getUpdates`` e gli altri metodi passano direttamente.
+    """
+
+    def __init__(self, client, scheduler, timeout=30):
+        self.client = client
+        self.scheduler = scheduler
+        self.timeout = timeout
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self.scheduler.call(chat_id, PRIORITY_MESSAGE, self.client.send_message,
+                                   chat_id, *args, timeout=self.timeout, **kwargs)
+
+    def edit_message_text(self, chat_id, *args, **kwargs):
+        return self.scheduler.call(chat_id, PRIORITY_EDIT, self.client.edit_message_text,
+                                   chat_id, *args, timeout=self.timeout, **kwargs)
+
+    def send_chat_action(self, chat_id, *args, **kwargs):
+        return self.scheduler.call(chat_id, PRIORITY_EDIT, self.client.send_chat_action,
+                                   chat_id, *args, timeout=self.timeout, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self.scheduler.call(chat_id, PRIORITY_MESSAGE, self.client.send_document,
+                                   chat_id, *args, timeout=max(self.timeout, 120), **kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        # Le risposte ai callback non contano nel limite messaggi della chat
+        return self.scheduler.call(None, PRIORITY_CALLBACK, self.client.answer_callback_query,
+                                   *args, timeout=self.timeout, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
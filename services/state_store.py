@@ -0,0 +1,499 @@
+"""
+State Store Service
+Persistenza transazionale su SQLite (WAL) per lead, limiti, errori e premium
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.getenv('TAXAMI_DB_PATH', 'taxami_state.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS leads (
+    id TEXT PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    timestamp TEXT,
+    last_interaction TEXT,
+    interactions INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS lead_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_limits (
+    user_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day)
+);
+CREATE INDEX IF NOT EXISTS idx_user_limits_day ON user_limits (day);
+CREATE TABLE IF NOT EXISTS openai_spend (
+    day TEXT PRIMARY KEY,
+    cost REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS errors (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT,
+    type TEXT,
+    message TEXT,
+    context TEXT,
+    traceback TEXT
+);
+CREATE TABLE IF NOT EXISTS error_aggregates (
+    type TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    message TEXT,
+    count INTEGER NOT NULL,
+    first_seen TEXT,
+    last_seen TEXT,
+    PRIMARY KEY (type, fingerprint)
+);
+CREATE TABLE IF NOT EXISTS analytics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT,
+    event TEXT,
+    user_id TEXT,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS premium_users (
+    user_id TEXT PRIMARY KEY,
+    subscription_id TEXT,
+    expires_at TEXT,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_premium_subscription ON premium_users (subscription_id);
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+class StateStore:
+    """Repository SQLite condiviso dal bot e dal PremiumManager.
+
+    Una connessione per thread, journal WAL: le letture non bloccano le
+    scritture e ogni evento costa una singola transazione di poche righe
+    invece della riscrittura completa di un file JSON.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Transazione esplicita (BEGIN IMMEDIATE) sulla connessione del thread"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        """Chiude la connessione del thread corrente"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # Meta
+    def get_meta(self, key, default=None):
+        row = self._connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else default
+
+    def set_meta(self, key, value):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, str(value))
+            )
+
+    @staticmethod
+    def _bump_meta(conn, key):
+        """Incrementa un contatore in meta all'interno della transazione ``conn``"""
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+            (key,)
+        )
+
+    # Leads
+    def upsert_lead(self, user):
+        """Registra un'interazione del lead; restituisce il numero di interazioni"""
+        user_id = str(user.get('id'))
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO leads (id, username, first_name, last_name, timestamp, interactions) "
+                "VALUES (?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT(id) DO UPDATE SET interactions = interactions + 1, last_interaction = ?",
+                (user_id, user.get('username', ''), user.get('first_name', ''),
+                 user.get('last_name', ''), now, now)
+            )
+            row = conn.execute("SELECT interactions FROM leads WHERE id = ?", (user_id,)).fetchone()
+        return row["interactions"]
+
+    def count_leads(self):
+        return self._connection().execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+
+    def iter_leads(self, batch_size=500):
+        """Itera i lead in ordine di inserimento senza caricarli tutti in memoria"""
+        cursor = self._connection().execute("SELECT * FROM leads ORDER BY rowid")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+
+    def append_lead_event(self, user, timestamp):
+        """Aggiunge un'interazione al log append-only dei lead"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO lead_events (user_id, username, first_name, last_name, timestamp) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (str(user.get('id')), user.get('username', ''), user.get('first_name', ''),
+                 user.get('last_name', ''), timestamp)
+            )
+
+    def iter_lead_events(self):
+        """Eventi non ancora compattati, in ordine di arrivo"""
+        cursor = self._connection().execute("SELECT * FROM lead_events ORDER BY id")
+        for row in cursor:
+            yield dict(row)
+
+    def count_lead_events(self):
+        return self._connection().execute("SELECT COUNT(*) FROM lead_events").fetchone()[0]
+
+    def compact_lead_events(self):
+        """Consolida il log degli eventi nella tabella leads; restituisce gli eventi consolidati"""
+        with self.transaction() as conn:
+            max_id = conn.execute("SELECT MAX(id) FROM lead_events").fetchone()[0]
+            if max_id is None:
+                return 0
+            # Un lead nuovo prende anagrafica e timestamp dal primo evento
+            conn.execute(
+                "INSERT INTO leads (id, username, first_name, last_name, timestamp, last_interaction, interactions) "
+                "SELECT e.user_id, e.username, e.first_name, e.last_name, e.timestamp, "
+                "CASE WHEN g.n > 1 THEN g.last_ts END, g.n "
+                "FROM (SELECT user_id, MIN(id) AS first_id, MAX(timestamp) AS last_ts, COUNT(*) AS n "
+                "      FROM lead_events WHERE id <= ? GROUP BY user_id) g "
+                "JOIN lead_events e ON e.id = g.first_id WHERE 1 "
+                "ON CONFLICT(id) DO UPDATE SET "
+                "interactions = leads.interactions + excluded.interactions, "
+                "last_interaction = COALESCE(excluded.last_interaction, excluded.timestamp)",
+                (max_id,)
+            )
+            return conn.execute("DELETE FROM lead_events WHERE id <= ?", (max_id,)).rowcount
+
+    # User limits
+    def get_usage(self, user_id, day):
+        row = self._connection().execute(
+            "SELECT count FROM user_limits WHERE user_id = ? AND day = ?", (str(user_id), day)
+        ).fetchone()
+        return row["count"] if row else 0
+
+    def increment_usage(self, user_id, day, amount=1):
+        """Incrementa il contatore giornaliero; restituisce il nuovo valore"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO user_limits (user_id, day, count) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id, day) DO UPDATE SET count = count + excluded.count",
+                (str(user_id), day, amount)
+            )
+            row = conn.execute(
+                "SELECT count FROM user_limits WHERE user_id = ? AND day = ?", (str(user_id), day)
+            ).fetchone()
+        return row["count"]
+
+    def load_usage_since(self, day):
+        """Contatori (user_id, day, count) dal giorno ``day`` incluso"""
+        rows = self._connection().execute(
+            "SELECT user_id, day, count FROM user_limits WHERE day >= ?", (day,)
+        ).fetchall()
+        return [(row["user_id"], row["day"], row["count"]) for row in rows]
+
+    def add_usage_counts(self, rows):
+        """Somma in blocco gli incrementi (user_id, day, delta): più processi possono scrivere lo stesso utente"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO user_limits (user_id, day, count) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id, day) DO UPDATE SET count = count + excluded.count",
+                [(str(user_id), day, delta) for user_id, day, delta in rows]
+            )
+
+    def try_consume_usage(self, user_id, day, limit):
+        """Check-and-increment atomico tra processi: (True, nuovo valore) se sotto ``limit``"""
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT count FROM user_limits WHERE user_id = ? AND day = ?", (str(user_id), day)
+            ).fetchone()
+            count = row["count"] if row else 0
+            if count >= limit:
+                return False, count
+            conn.execute(
+                "INSERT INTO user_limits (user_id, day, count) VALUES (?, ?, 1) "
+                "ON CONFLICT(user_id, day) DO UPDATE SET count = count + 1",
+                (str(user_id), day)
+            )
+            return True, count + 1
+
+    def count_active_users(self, day):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM user_limits WHERE day = ? AND count > 0", (day,)
+        ).fetchone()[0]
+
+    def purge_usage_before(self, day):
+        """Elimina in blocco i contatori dei giorni precedenti a ``day``"""
+        with self.transaction() as conn:
+            return conn.execute("DELETE FROM user_limits WHERE day < ?", (day,)).rowcount
+
+    # OpenAI spend
+    def get_openai_spend(self, day):
+        row = self._connection().execute("SELECT cost FROM openai_spend WHERE day = ?", (day,)).fetchone()
+        return row["cost"] if row else 0.0
+
+    def add_openai_spend(self, day, cost):
+        """Somma ``cost`` alla spesa del giorno (condivisa tra i processi); restituisce il totale"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO openai_spend (day, cost) VALUES (?, ?) "
+                "ON CONFLICT(day) DO UPDATE SET cost = cost + excluded.cost",
+                (day, cost)
+            )
+            return conn.execute("SELECT cost FROM openai_spend WHERE day = ?", (day,)).fetchone()["cost"]
+
+    # Errors
+    def add_error(self, entry, keep_last=100):
+        """Aggiunge un errore mantenendo solo gli ultimi ``keep_last``"""
+        self.add_errors([entry], keep_last)
+
+    def add_errors(self, entries, keep_last=100):
+        """Aggiunge un batch di errori in un'unica transazione"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO errors (timestamp, type, message, context, traceback) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (entry.get('timestamp'), entry.get('type'), entry.get('message'),
+                     _dumps(entry.get('context')), entry.get('traceback'))
+                    for entry in entries
+                ]
+            )
+            if keep_last:
+                last_id = conn.execute("SELECT MAX(id) FROM errors").fetchone()[0] or 0
+                conn.execute("DELETE FROM errors WHERE id <= ?", (last_id - keep_last,))
+
+    def upsert_error_aggregates(self, rows):
+        """Somma i conteggi (type, fingerprint, message, delta, first_seen, last_seen)"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO error_aggregates (type, fingerprint, message, count, first_seen, last_seen) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(type, fingerprint) DO UPDATE SET count = count + excluded.count, "
+                "message = excluded.message, last_seen = excluded.last_seen",
+                rows
+            )
+
+    def recent_errors(self, limit=20):
+        rows = self._connection().execute(
+            "SELECT * FROM errors ORDER BY id DESC LIMIT ?", (limit,)
+        ).fetchall()
+        errors = []
+        for row in rows:
+            entry = dict(row)
+            entry['context'] = json.loads(entry['context']) if entry['context'] else None
+            errors.append(entry)
+        return errors
+
+    # Analytics
+    def record_event(self, event, user_id=None, data=None, timestamp=None):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO analytics (timestamp, event, user_id, data) VALUES (?, ?, ?, ?)",
+                (timestamp or datetime.now().isoformat(), event,
+                 str(user_id) if user_id is not None else None, _dumps(data))
+            )
+
+    # Premium users
+    def load_premium_users(self):
+        """Restituisce {user_id: dati} come il vecchio file JSON"""
+        rows = self._connection().execute("SELECT user_id, data FROM premium_users").fetchall()
+        return {row["user_id"]: json.loads(row["data"]) for row in rows}
+
+    def save_premium_user(self, user_id, data):
+        self.save_premium_users({str(user_id): data})
+
+    def save_premium_users(self, users):
+        """Salva (upsert) uno o più utenti premium in un'unica transazione"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO premium_users (user_id, subscription_id, expires_at, status, data) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET subscription_id = excluded.subscription_id, "
+                "expires_at = excluded.expires_at, status = excluded.status, data = excluded.data",
+                [
+                    (str(user_id), data.get('subscription_id'), data.get('expires_at'),
+                     data.get('status'), _dumps(data))
+                    for user_id, data in users.items()
+                ]
+            )
+            # Gli altri processi confrontano la revisione per sapere quando ricaricare
+            self._bump_meta(conn, 'premium_revision')
+
+    def premium_revision(self):
+        return self.get_meta('premium_revision', '0')
+
+    # Response cache
+    def load_cache_entries(self, since, limit):
+        """Voci più recenti create dopo ``since``, in ordine cronologico"""
+        rows = self._connection().execute(
+            "SELECT key, value, created_at FROM "
+            "(SELECT * FROM response_cache WHERE created_at >= ? ORDER BY created_at DESC LIMIT ?) "
+            "ORDER BY created_at",
+            (since, limit)
+        ).fetchall()
+        return [(row["key"], row["value"], row["created_at"]) for row in rows]
+
+    def put_cache_entry(self, key, value, created_at):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, created_at)
+            )
+
+    def delete_cache_entries(self, keys):
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM response_cache WHERE key = ?", [(k,) for k in keys])
+
+    # Import dai vecchi file JSON
+    def import_legacy_json(self, leads_file=None, limits_file=None, errors_file=None,
+                           analytics_file=None, premium_file=None):
+        """Importa una sola volta i vecchi file JSON; restituisce True se ha importato"""
+        if self.get_meta('legacy_json_imported'):
+            return False
+
+        def _read(path, default):
+            if not path or not os.path.exists(path):
+                return default
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.error(f"Import {path} fallito: {e}")
+                return default
+
+        leads = _read(leads_file, [])
+        limits = _read(limits_file, {})
+        errors = _read(errors_file, [])
+        analytics = _read(analytics_file, [])
+        premium = _read(premium_file, {})
+
+        if isinstance(analytics, dict):
+            analytics = [{"event": key, "data": value} for key, value in analytics.items()]
+
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO leads "
+                "(id, username, first_name, last_name, timestamp, last_interaction, interactions) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (str(l.get('id')), l.get('username', ''), l.get('first_name', ''),
+                     l.get('last_name', ''), l.get('timestamp'), l.get('last_interaction'),
+                     l.get('interactions', 1))
+                    for l in leads
+                ]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO user_limits (user_id, day, count) VALUES (?, ?, ?)",
+                [
+                    (str(user_id), day, count)
+                    for user_id, days in limits.items()
+                    for day, count in days.items()
+                ]
+            )
+            conn.executemany(
+                "INSERT INTO errors (timestamp, type, message, context, traceback) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (e.get('timestamp'), e.get('type'), e.get('message'),
+                     _dumps(e.get('context')), e.get('traceback'))
+                    for e in errors
+                ]
+            )
+            conn.executemany(
+                "INSERT INTO analytics (timestamp, event, user_id, data) VALUES (?, ?, ?, ?)",
+                [
+                    (a.get('timestamp'), a.get('event') or a.get('type'),
+                     str(a['user_id']) if a.get('user_id') is not None else None, _dumps(a.get('data', a)))
+                    for a in analytics if isinstance(a, dict)
+                ]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO premium_users (user_id, subscription_id, expires_at, status, data) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (str(user_id), data.get('subscription_id'), data.get('expires_at'),
+                     data.get('status'), _dumps(data))
+                    for user_id, data in premium.items()
+                ]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_json_imported', ?)",
+                (datetime.now().isoformat(),)
+            )
+
+        logger.info(
+            f"Import JSON completato: {len(leads)} lead, {len(limits)} utenti con limiti, "
+            f"{len(errors)} errori, {len(analytics)} eventi, {len(premium)} premium"
+        )
+        return True
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+def get_state_store():
+    """Istanza condivisa dello store (percorso da TAXAMI_DB_PATH)"""
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                _default_store = StateStore(DEFAULT_DB_PATH)
+    return _default_store
@@ -0,0 +1,157 @@
+"""
+Telegram Client Service
+Client Bot API con connection pool condiviso e keep-alive
+"""
+
+import logging
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_BASE = "https://api.telegram.org"
+
+# Timeout HTTP per metodo (secondi); getUpdates aggiunge il long polling
+DEFAULT_TIMEOUTS = {
+    "getUpdates": 5,
+    "sendMessage": 10,
+    "editMessageText": 10,
+    "answerCallbackQuery": 5,
+    "sendChatAction": 5,
+    "default": 10,
+}
+
+class TelegramAPIError(requests.exceptions.HTTPError):
+    """Risposta ``ok: false`` della Bot API"""
+
+    def __init__(self, method, error_code, description, parameters=None):
+        super().__init__(f"{method} fallito ({error_code}): {description}")
+        self.method = method
+        self.error_code = error_code
+        self.description = description or ""
+        self.parameters = parameters or {}
+
+    @property
+    def retry_after(self):
+        """Secondi di attesa richiesti da un 429, altrimenti None"""
+        return self.parameters.get("retry_after")
+
+    @property
+    def is_parse_error(self):
+        """True se Telegram non è riuscito a interpretare il Markdown"""
+        return self.error_code == 400 and "can't parse entities" in self.description.lower()
+
+class TelegramClient:
+    """Client Bot API su una ``requests.Session`` condivisa tra i thread.
+
+    La sessione mantiene le connessioni TLS verso api.telegram.org aperte
+    (keep-alive) e le riusa tra le chiamate: niente handshake per messaggio.
+    Con ``metrics`` (HealthMonitor) registra latenza ed esito per metodo.
+    """
+
+    def __init__(self, token, api_base=DEFAULT_API_BASE, pool_size=20, timeouts=None, metrics=None):
+        self.base_url = f"{api_base.rstrip('/')}/bot{token}"
+        self.metrics = metrics
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def call(self, method, payload=None, timeout=None):
+        """Invoca un metodo della Bot API e restituisce il JSON della risposta"""
+        if timeout is None:
+            timeout = self.timeouts.get(method, self.timeouts["default"])
+        return self._post(method, timeout, json=payload or {})
+
+    def _post(self, method, timeout, **request_kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.post(f"{self.base_url}/{method}", timeout=timeout, **request_kwargs)
+            body = self._parse(method, response)
+        except TelegramAPIError as e:
+            self._record(method, start, str(e.error_code))
+            raise
+        except Exception:
+            self._record(method, start, "exception")
+            raise
+        self._record(method, start, "ok")
+        return body
+
+    def _parse(self, method, response):
+        try:
+            body = response.json()
+        except ValueError:
+            response.raise_for_status()
+            raise
+
+        if not body.get("ok"):
+            raise TelegramAPIError(
+                method,
+                body.get("error_code", response.status_code),
+                body.get("description"),
+                body.get("parameters")
+            )
+        return body
+
+    def _record(self, method, start, outcome):
+        if self.metrics is not None:
+            self.metrics.observe("telegram_request_seconds", time.perf_counter() - start, method=method)
+            self.metrics.inc("telegram_requests_total", method=method, outcome=outcome)
+
+    def get_updates(self, offset=None, timeout=10, limit=100):
+        payload = {"timeout": timeout, "limit": limit}
+        if offset:
+            payload["offset"] = offset
+        return self.call("getUpdates", payload, timeout=timeout + self.timeouts["getUpdates"])
+
+    def send_message(self, chat_id, text, reply_markup=None, parse_mode="Markdown"):
+        payload = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        if reply_markup:
+            payload["reply_markup"] = reply_markup
+        return self.call("sendMessage", payload)
+
+    def edit_message_text(self, chat_id, message_id, text, reply_markup=None, parse_mode="Markdown"):
+        payload = {"chat_id": chat_id, "message_id": message_id, "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        if reply_markup:
+            payload["reply_markup"] = reply_markup
+        return self.call("editMessageText", payload)
+
+    def answer_callback_query(self, callback_query_id, text=None):
+        payload = {"callback_query_id": callback_query_id}
+        if text:
+            payload["text"] = text
+        return self.call("answerCallbackQuery", payload)
+
+    def send_chat_action(self, chat_id, action="typing"):
+        return self.call("sendChatAction", {"chat_id": chat_id, "action": action})
+
+    def send_document(self, chat_id, filename, fileobj, caption=None):
+        """Invia un file (multipart/form-data) letto in streaming da ``fileobj``"""
+        data = {"chat_id": chat_id}
+        if caption:
+            data["caption"] = caption
+        return self._post(
+            "sendDocument",
+            self.timeouts.get("sendDocument", 60),
+            data=data,
+            files={"document": (filename, fileobj)}
+        )
+
+    def set_webhook(self, url, secret_token=None, max_connections=40):
+        payload = {"url": url, "max_connections": max_connections,
+                   "allowed_updates": ["message", "callback_query"]}
+        if secret_token:
+            payload["secret_token"] = secret_token
+        return self.call("setWebhook", payload)
+
+    def delete_webhook(self):
+        return self.call("deleteWebhook", {})
+
+    def close(self):
+        self.session.close()
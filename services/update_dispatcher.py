@@ -0,0 +1,89 @@
+"""
+Update Dispatcher Service
+Esegue gli handler di chat diverse in parallelo mantenendo l'ordine per chat
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class UpdateDispatcher:
+    """Worker pool limitato con code ordinate per chat_id.
+
+    Gli update della stessa chat vengono eseguiti uno alla volta nell'ordine
+    di arrivo; chat diverse procedono in parallelo fino a ``max_workers``.
+    ``max_pending`` limita gli update in attesa: ``submit`` si blocca quando
+    il limite è raggiunto (backpressure verso getUpdates).
+    """
+
+    def __init__(self, max_workers=8, max_pending=500):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="update-worker")
+        self._lock = threading.Lock()
+        self._queues = {}  # chat_id -> deque di (handler, args)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self.running = True
+
+    def submit(self, chat_id, handler, *args):
+        """Accoda un handler per la chat; parte subito se la chat è libera"""
+        if not self.running:
+            raise RuntimeError("Dispatcher fermato")
+
+        self._slots.acquire()
+        with self._lock:
+            self._pending += 1
+            queue = self._queues.get(chat_id)
+            if queue is not None:
+                # Chat già in lavorazione: il drain in corso lo eseguirà in ordine
+                queue.append((handler, args))
+                return
+            self._queues[chat_id] = deque([(handler, args)])
+
+        self._executor.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id):
+        """Esegue in ordine tutti gli update accodati per una chat"""
+        while True:
+            with self._lock:
+                queue = self._queues[chat_id]
+                if not queue:
+                    del self._queues[chat_id]
+                    return
+                handler, args = queue.popleft()
+
+            try:
+                handler(*args)
+            except Exception as e:
+                logger.error(f"Errore handler per chat {chat_id}: {e}")
+            finally:
+                self._slots.release()
+                with self._lock:
+                    self._pending -= 1
+                    if self._pending == 0:
+                        self._idle.notify_all()
+
+    def pending(self):
+        """Numero di update accodati o in esecuzione"""
+        with self._lock:
+            return self._pending
+
+    def active_chats(self):
+        """Numero di chat con almeno un update in lavorazione"""
+        with self._lock:
+            return len(self._queues)
+
+    def wait_idle(self, timeout=None):
+        """Attende che tutti gli update accodati siano stati processati"""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def shutdown(self, wait=True):
+        """Ferma il dispatcher; con wait=True completa gli update in coda"""
+        self.running = False
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,151 @@
+"""
+Usage Counters Service
+Contatori giornalieri in memoria con write-behind sullo state store
+"""
+
+import logging
+import threading
+from datetime import date, timedelta
+
+logger = logging.getLogger(__name__)
+
+class DailyUsageCounters:
+    """Domande usate per (utente, giorno), tenute in memoria.
+
+    I contatori sono raggruppati per giorno: il cambio di data elimina in
+    blocco i giorni oltre ``retention_days`` invece di scandire gli utenti ad
+    ogni richiesta. Gli incrementi vengono sommati sullo store in batch ogni
+    ``flush_interval`` secondi da un thread in background (write-behind);
+    all'avvio lo snapshot dei giorni trattenuti viene ricaricato dallo store.
+    Con ``shared`` (worker sharded per chat) lo stesso utente può scrivere da
+    più processi (chat private e gruppi): letture e consumi passano allora
+    direttamente dallo store, che resta l'unico conteggio autorevole.
+    """
+
+    def __init__(self, store, retention_days=7, flush_interval=5.0):
+        self.store = store
+        self.retention_days = retention_days
+        self.flush_interval = flush_interval
+        self.shared = False
+        self._days = {}      # day -> {user_id: count}
+        self._pending = {}   # (user_id, day) -> incremento non ancora scritto
+        self._today = None
+        self._purge_before = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.load()
+
+    def _cutoff(self, today):
+        return (today - timedelta(days=self.retention_days)).isoformat()
+
+    def load(self):
+        """Ricarica lo snapshot dei giorni ancora trattenuti"""
+        today = date.today()
+        days = {}
+        for user_id, day, count in self.store.load_usage_since(self._cutoff(today)):
+            days.setdefault(day, {})[user_id] = count
+        with self._lock:
+            self._days = days
+            self._today = today
+
+    def _bucket(self):
+        """Bucket di oggi; al cambio data scarta in blocco i giorni scaduti"""
+        today = date.today()
+        if today != self._today:
+            self._today = today
+            cutoff = self._cutoff(today)
+            for day in [d for d in self._days if d < cutoff]:
+                del self._days[day]
+            self._pending = {key: delta for key, delta in self._pending.items() if key[1] >= cutoff}
+            self._purge_before = cutoff
+        return self._days.setdefault(today.isoformat(), {})
+
+    def _shared_day(self):
+        """Giorno corrente in modalità ``shared`` (il cambio data pianifica comunque la pulizia)"""
+        with self._lock:
+            self._bucket()
+            return self._today.isoformat()
+
+    def get(self, user_id):
+        """Domande usate oggi dall'utente"""
+        if self.shared:
+            return self.store.get_usage(str(user_id), self._shared_day())
+        with self._lock:
+            return self._bucket().get(str(user_id), 0)
+
+    def increment(self, user_id, amount=1):
+        """Incrementa il contatore di oggi; restituisce il nuovo valore"""
+        user_key = str(user_id)
+        if self.shared:
+            return self.store.increment_usage(user_key, self._shared_day(), amount)
+        with self._lock:
+            bucket = self._bucket()
+            count = bucket.get(user_key, 0) + amount
+            bucket[user_key] = count
+            key = (user_key, self._today.isoformat())
+            self._pending[key] = self._pending.get(key, 0) + amount
+            return count
+
+    def try_consume(self, user_id, limit):
+        """Check-and-increment atomico: (True, nuovo valore) se sotto il limite"""
+        user_key = str(user_id)
+        if self.shared:
+            return self.store.try_consume_usage(user_key, self._shared_day(), limit)
+        with self._lock:
+            bucket = self._bucket()
+            count = bucket.get(user_key, 0)
+            if count >= limit:
+                return False, count
+            bucket[user_key] = count + 1
+            key = (user_key, self._today.isoformat())
+            self._pending[key] = self._pending.get(key, 0) + 1
+            return True, count + 1
+
+    def active_users(self):
+        """Utenti con almeno una domanda oggi"""
+        if self.shared:
+            self.flush()
+            return self.store.count_active_users(date.today().isoformat())
+        with self._lock:
+            return sum(1 for count in self._bucket().values() if count > 0)
+
+    def flush(self):
+        """Somma sullo store gli incrementi dall'ultimo flush"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            rows = [(user_key, day, delta) for (user_key, day), delta in pending.items()]
+            purge_before, self._purge_before = self._purge_before, None
+
+        try:
+            if rows:
+                self.store.add_usage_counts(rows)
+            if purge_before:
+                self.store.purge_usage_before(purge_before)
+        except Exception as e:
+            logger.error(f"Flush contatori fallito ({len(rows)} righe): {e}")
+            with self._lock:
+                # Riprova al prossimo giro
+                for user_key, day, delta in rows:
+                    self._pending[(user_key, day)] = self._pending.get((user_key, day), 0) + delta
+                self._purge_before = self._purge_before or purge_before
+            return 0
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="usage-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Ferma il flusher e scrive gli ultimi contatori"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -0,0 +1,137 @@
+"""
+Webhook Server Service
+Server HTTP asyncio leggero per i webhook di Telegram e Stripe
+"""
+
+import asyncio
+import json
+import logging
+import signal
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+class WebhookServer:
+    """Server HTTP/1.1 minimale (keep-alive, Content-Length) su asyncio.
+
+    Ogni route è una funzione sincrona ``handler(body, headers)`` che deve
+    solo validare e accodare il lavoro, restituendo ``(status, payload)``:
+    viene eseguita nell'executor del loop, così un'eventuale backpressure
+    del dispatcher non blocca le altre connessioni. ``payload`` può essere
+    bytes, str o un oggetto serializzabile in JSON.
+    """
+
+    def __init__(self, host="0.0.0.0", port=8080, max_body_size=1024 * 1024):
+        self.host = host
+        self.port = port
+        self.max_body_size = max_body_size
+        self.routes = {}  # path -> (methods, handler)
+        self.requests_served = 0
+        self._server = None
+
+    def add_route(self, path, handler, methods=("POST",)):
+        self.routes[path] = (tuple(methods), handler)
+
+    async def start(self):
+        """Avvia l'ascolto; con port=0 la porta effettiva è in ``self.port``"""
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Webhook server in ascolto su {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode('latin-1').split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0) or 0)
+        if length > self.max_body_size:
+            return method, path.split("?", 1)[0], headers, None
+        body = await reader.readexactly(length) if length else b""
+        return method, path.split("?", 1)[0], headers, body
+
+    async def _dispatch(self, method, path, headers, body):
+        route = self.routes.get(path)
+        if route is None:
+            return 404, {"ok": False, "error": "not found"}
+        methods, handler = route
+        if method not in methods:
+            return 405, {"ok": False, "error": "method not allowed"}
+        if body is None:
+            return 413, {"ok": False, "error": "payload too large"}
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, handler, body, headers)
+        except Exception as e:
+            logger.error(f"Errore webhook {path}: {e}")
+            return 500, {"ok": False, "error": "internal error"}
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    request = None
+                if request is None:
+                    break
+
+                method, path, headers, body = request
+                status, payload = await self._dispatch(method, path, headers, body)
+                self.requests_served += 1
+
+                content_type = "application/json"
+                if isinstance(payload, str):
+                    payload, content_type = payload.encode('utf-8'), "text/plain; charset=utf-8"
+                elif not isinstance(payload, bytes):
+                    payload = json.dumps(payload).encode('utf-8')
+
+                # Con un body rifiutato (413) lo stream non è più allineato: chiudi
+                keep_alive = body is not None and headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def serve_forever(self, on_shutdown=None):
+        """Esegue il server fino a SIGINT/SIGTERM, poi chiama ``on_shutdown``"""
+        async def _main():
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.add_signal_handler(sig, stop_event.set)
+                except (NotImplementedError, RuntimeError):
+                    pass
+            await self.start()
+            await stop_event.wait()
+            await self.stop()
+
+        try:
+            asyncio.run(_main())
+        finally:
+            if on_shutdown:
+                on_shutdown()
@@ -0,0 +1,234 @@
+"""
+Worker Pool Service
+Processi worker con sharding degli update per chat_id e report di salute
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+
+from services.update_dispatcher import UpdateDispatcher
+
+logger = logging.getLogger(__name__)
+
+_STOP = None  # sentinella di arresto sulla coda di un worker
+
+def shard_for(chat_id, shards):
+    """Shard stabile tra processi (``hash`` di str cambia a ogni avvio)"""
+    return zlib.crc32(str(chat_id).encode('utf-8')) % shards
+
+def _worker_main(worker_id, workers, tasks, health, hooks, max_concurrency, max_pending, heartbeat_interval):
+    """Loop di un processo worker: riceve (chat_id, handler, args) dalla sua coda"""
+    # Ctrl+C arriva a tutto il gruppo: l'arresto lo coordina il processo principale
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    initializer, periodic, finalizer = hooks
+    if initializer:
+        initializer(worker_id, workers)
+
+    dispatcher = UpdateDispatcher(max_concurrency, max_pending)
+    counters_lock = threading.Lock()
+    processed = 0
+    failed = 0
+    started = time.time()
+    last_report = 0.0
+
+    def _report(state):
+        health.put({
+            "worker": worker_id,
+            "pid": os.getpid(),
+            "state": state,
+            "processed": processed,
+            "failed": failed,
+            "pending": dispatcher.pending(),
+            "uptime": round(time.time() - started, 1),
+            "timestamp": time.time()
+        })
+
+    def _run(handler, args):
+        nonlocal processed, failed
+        try:
+            handler(*args)
+        except Exception:
+            with counters_lock:
+                failed += 1
+            raise
+        with counters_lock:
+            processed += 1
+
+    _report("ready")
+    while True:
+        try:
+            task = tasks.get(timeout=min(1.0, heartbeat_interval))
+        except queue.Empty:
+            task = False
+
+        if task is _STOP:
+            break
+        if task:
+            chat_id, handler, args = task
+            dispatcher.submit(chat_id, _run, handler, args)
+
+        now = time.time()
+        if now - last_report >= heartbeat_interval:
+            last_report = now
+            if periodic:
+                try:
+                    periodic()
+                except Exception as e:
+                    logger.error(f"Worker {worker_id}: errore periodic hook: {e}")
+            _report("running")
+
+    dispatcher.shutdown(wait=True)
+    if finalizer:
+        finalizer()
+    _report("stopped")
+
+class WorkerPool:
+    """Pool di processi worker con la stessa interfaccia di UpdateDispatcher.
+
+    ``submit(chat_id, handler, *args)`` sceglie il worker con un hash stabile
+    di ``chat_id``: gli update di una chat finiscono sempre nello stesso
+    processo e ci restano in ordine (ogni worker usa un UpdateDispatcher
+    interno). Handler e argomenti devono essere picklable: funzioni a livello
+    di modulo e dati JSON. I worker inviano un heartbeat ogni
+    ``heartbeat_interval`` secondi (passati anche a ``on_report``); un
+    worker morto viene segnalato e riavviato sulla stessa coda.
+    """
+
+    def __init__(self, workers=2, initializer=None, periodic=None, finalizer=None,
+                 max_concurrency=8, max_pending=500, queue_size=1000, heartbeat_interval=5.0,
+                 on_report=None):
+        self.workers = workers
+        self.on_report = on_report
+        self.hooks = (initializer, periodic, finalizer)
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.heartbeat_interval = heartbeat_interval
+        # spawn: il processo principale ha già thread attivi, fork non è sicuro
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues = [self._ctx.Queue(queue_size) for _ in range(workers)]
+        self._health_queue = self._ctx.Queue()
+        self._processes = [None] * workers
+        self._health = {}
+        self._restarts = [0] * workers
+        self._lock = threading.Lock()
+        self._monitor = None
+        self.running = False
+
+    def _spawn(self, worker_id):
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, self.workers, self._queues[worker_id], self._health_queue, self.hooks,
+                  self.max_concurrency, self.max_pending, self.heartbeat_interval),
+            name=f"taxami-worker-{worker_id}",
+            daemon=False
+        )
+        process.start()
+        self._processes[worker_id] = process
+
+    def start(self, ready_timeout=60):
+        """Avvia i worker e attende il primo heartbeat di ciascuno"""
+        self.running = True
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        deadline = time.time() + ready_timeout
+        ready = set()
+        while len(ready) < self.workers and time.time() < deadline:
+            try:
+                report = self._health_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            self._record(report)
+            ready.add(report["worker"])
+        if len(ready) < self.workers:
+            logger.warning(f"⚠️ Worker pronti: {len(ready)}/{self.workers}")
+
+        self._monitor = threading.Thread(target=self._watch, name="worker-monitor", daemon=True)
+        self._monitor.start()
+
+    def _record(self, report):
+        with self._lock:
+            self._health[report["worker"]] = report
+        if self.on_report:
+            try:
+                self.on_report(report)
+            except Exception as e:
+                logger.error(f"Errore report worker {report['worker']}: {e}")
+
+    def _watch(self):
+        """Raccoglie gli heartbeat e riavvia i worker terminati"""
+        while self.running:
+            try:
+                self._record(self._health_queue.get(timeout=self.heartbeat_interval))
+            except queue.Empty:
+                pass
+            except (EOFError, OSError):
+                return
+
+            for worker_id, process in enumerate(self._processes):
+                if self.running and process is not None and not process.is_alive():
+                    self._restarts[worker_id] += 1
+                    logger.error(f"💥 Worker {worker_id} terminato (exit {process.exitcode}), riavvio "
+                                 f"#{self._restarts[worker_id]}")
+                    self._spawn(worker_id)
+
+    def submit(self, chat_id, handler, *args):
+        """Accoda l'handler sul worker della chat (si blocca se la coda è piena)"""
+        if not self.running:
+            raise RuntimeError("Worker pool fermato")
+        self._queues[shard_for(chat_id, self.workers)].put((chat_id, handler, args))
+
+    def pending(self):
+        """Update in coda nei worker, secondo l'ultimo heartbeat più le code"""
+        total = 0
+        for worker_id, tasks in enumerate(self._queues):
+            try:
+                total += tasks.qsize()
+            except NotImplementedError:
+                pass
+            total += self._health.get(worker_id, {}).get("pending", 0)
+        return total
+
+    def health(self):
+        """Ultimo report di ogni worker con vivo/morto ed età dell'heartbeat"""
+        now = time.time()
+        with self._lock:
+            reports = dict(self._health)
+        result = []
+        for worker_id, process in enumerate(self._processes):
+            report = dict(reports.get(worker_id, {"worker": worker_id, "state": "unknown"}))
+            report["alive"] = bool(process and process.is_alive())
+            report["restarts"] = self._restarts[worker_id]
+            if "timestamp" in report:
+                report["heartbeat_age"] = round(now - report["timestamp"], 1)
+            result.append(report)
+        return result
+
+    def shutdown(self, wait=True, timeout=30):
+        """Invia la sentinella a ogni worker e attende che svuotino le code"""
+        self.running = False
+        for tasks in self._queues:
+            tasks.put(_STOP)
+        if not wait:
+            return
+        deadline = time.time() + timeout
+        for worker_id, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(max(0.1, deadline - time.time()))
+            if process.is_alive():
+                logger.warning(f"⚠️ Worker {worker_id} non terminato entro {timeout}s, terminate()")
+                process.terminate()
+                process.join(5)
+        # Ultimi report ("stopped") dopo il flush dei worker
+        while True:
+            try:
+                self._record(self._health_queue.get_nowait())
+            except (queue.Empty, EOFError, OSError):
+                break
@@ -14,8 +14,14 @@ PREMIUM_PRODUCT_INFO = {
     "interval": "month"
 }
 
+# Endpoint API (sovrascrivibile per puntare a un server Stripe finto in test)
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', '')
+
+# Price id già noto: salta la ricerca di prodotto e prezzo all'avvio
+STRIPE_PRICE_ID = os.getenv('STRIPE_PRICE_ID', '')
+
 # Webhook per automazione
-STRIPE_WEBHOOK_SECRET = ""  # Da configurare
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', '')  # Se vuoto, webhook Stripe disattivato
 
 # Environment
 STRIPE_ENV = "test"  # "test" o "live"
\ No newline at end of file
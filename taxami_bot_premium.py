@@ -11,9 +11,37 @@ import time
 import os
 import traceback
 import sys
-from datetime import datetime, date, timedelta
-from openai import OpenAI
-from premium_system import payment_manager, premium_manager
+import io
+import hmac
+import secrets
+import tempfile
+import threading
+from datetime import date
+from types import SimpleNamespace
+from openai import OpenAI, APIStatusError
+from premium_system import payment_manager, premium_manager, PREMIUM_USERS_FILE
+from stripe_config import STRIPE_WEBHOOK_SECRET
+from services.update_dispatcher import UpdateDispatcher
+from services.knowledge_base import FiscalKnowledgeBase
+from services.fiscal_search import FiscalSearchIndex
+from services.state_store import get_state_store
+from services.telegram_client import TelegramClient, TelegramAPIError
+from services.response_cache import ResponseCache
+from services.semantic_cache import SemanticCache
+from services.message_streamer import StreamingMessage
+from services.webhook_server import WebhookServer
+from services.send_scheduler import SendScheduler, RateLimitedTelegram, SendTimeout, PRIORITY_CALLBACK
+from services.usage_counters import DailyUsageCounters
+from services.lead_registry import LeadRegistry
+from services.error_log import ErrorLog
+from services.worker_pool import WorkerPool
+from services.circuit_breaker import CircuitBreaker
+from services.health_monitor import get_health_monitor
+from services.cost_optimizer import CostOptimizer
+from services.hedged_requests import HedgedExecutor
+from services.request_coalescing import SingleFlight, Debouncer
+from services.intent_matcher import IntentMatcher
+from services.message_renderer import MessageRenderer, escape_markdown, render_ai_markdown, sanitize_markdown
 
 # Configurazione
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
@@ -30,10 +58,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Global error counter for circuit breaker
+# Contatore globale degli errori API (per /stats)
 error_count = 0
-MAX_ERRORS_BEFORE_PAUSE = 10
-ERROR_RESET_TIME = 300  # 5 minutes
+
+# Metriche Prometheus (latenze, contatori, gauge) su /metrics
+metrics = get_health_monitor()
+METRICS_PORT = int(os.getenv('TAXAMI_METRICS_PORT', '9100'))  # 0 = disattivato
+METRICS_HOST = os.getenv('TAXAMI_METRICS_HOST', '127.0.0.1')  # solo interfaccia interna, non esposto con i webhook
+_request_state = threading.local()  # esito dell'update in corso (per handler)
 
 # Setup OpenAI with retry
 def initialize_openai_client():
@@ -49,26 +81,113 @@ def initialize_openai_client():
         return None
 
 client = initialize_openai_client()
-BASE_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
+
+# Routing dei modelli: budget giornaliero in USD (0 = illimitato) e SLO sul p95 di latenza
+OPENAI_DAILY_BUDGET = float(os.getenv('TAXAMI_OPENAI_DAILY_BUDGET', '0'))
+OPENAI_LATENCY_SLO = float(os.getenv('TAXAMI_OPENAI_LATENCY_SLO', '20'))
+# La spesa del giorno sta nello state store: condivisa dai worker e persistente tra i riavvii
+cost_optimizer = CostOptimizer(daily_budget=OPENAI_DAILY_BUDGET, latency_slo=OPENAI_LATENCY_SLO,
+                               metrics=metrics, store=get_state_store())
+
+# Hedging: se il modello primario non risponde entro il suo p95 osservato parte in parallelo il fallback
+OPENAI_HEDGING = os.getenv('TAXAMI_OPENAI_HEDGING', '1') == '1'
+OPENAI_HEDGE_AFTER = float(os.getenv('TAXAMI_OPENAI_HEDGE_AFTER', '10'))  # senza campioni di latenza
+OPENAI_HEDGE_MIN = float(os.getenv('TAXAMI_OPENAI_HEDGE_MIN', '3'))
+OPENAI_DEADLINE = float(os.getenv('TAXAMI_OPENAI_DEADLINE', '45'))  # tempo massimo per domanda
+TELEGRAM_API_BASE = os.getenv('TELEGRAM_API_BASE', 'https://api.telegram.org')
+BASE_URL = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}"
 
 # Marco admin ID
 ADMIN_USER_ID = 1606066237
 
-# Files con error handling
+# Files legacy: importati una tantum nello state store SQLite all'avvio
 LEADS_FILE = "taxami_leads.json"
 ANALYTICS_FILE = "taxami_analytics.json"
 USER_LIMITS_FILE = "taxami_user_limits.json"
 ERROR_LOG_FILE = "taxami_errors.json"
+ERROR_LOG_MAX_ENTRIES = 100
+USAGE_RETENTION_DAYS = 7
+
+# Persistenza transazionale (SQLite WAL, percorso da TAXAMI_DB_PATH)
+state_store = get_state_store()
+
+# Contatori giornalieri in memoria, scritti sullo store in background
+USAGE_FLUSH_INTERVAL = float(os.getenv('TAXAMI_USAGE_FLUSH_INTERVAL', '5'))
+usage_counters = DailyUsageCounters(state_store, USAGE_RETENTION_DAYS, USAGE_FLUSH_INTERVAL)
+usage_counters.start()
+
+# Registro lead: indice in memoria + log append-only compattato in background
+LEAD_COMPACT_INTERVAL = float(os.getenv('TAXAMI_LEAD_COMPACT_INTERVAL', '60'))
+lead_registry = LeadRegistry(state_store, LEAD_COMPACT_INTERVAL)
+lead_registry.start()
+
+# Log errori: ring buffer in memoria, scritto sullo store in batch
+ERROR_LOG_FLUSH_INTERVAL = float(os.getenv('TAXAMI_ERROR_LOG_FLUSH_INTERVAL', '5'))
+error_log = ErrorLog(state_store, ERROR_LOG_MAX_ENTRIES, ERROR_LOG_FLUSH_INTERVAL)
+error_log.start()
+
+# Cache risposte AI per le domande del menu (persistita nello state store)
+RESPONSE_CACHE_TTL = int(os.getenv('TAXAMI_RESPONSE_CACHE_TTL', str(24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('TAXAMI_RESPONSE_CACHE_MAX_ENTRIES', '500'))
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, store=state_store)
+
+# Cache per similarità delle domande libere, un namespace per tier (0.78: parafrasi sopra, domande diverse sotto)
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('TAXAMI_SEMANTIC_CACHE_THRESHOLD', '0.78'))
+SEMANTIC_CACHE_CAPACITY = int(os.getenv('TAXAMI_SEMANTIC_CACHE_CAPACITY', '1000'))
+semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_CAPACITY)
+
+# Streaming delle risposte AI con modifiche progressive del messaggio
+STREAMING_ENABLED = os.getenv('TAXAMI_STREAMING', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('TAXAMI_STREAM_EDIT_INTERVAL', '1.5'))
+STREAM_PLACEHOLDER = "✍️ Sto preparando la risposta..."
 FISCAL_KB_PATH = "./skills/eutekne/knowledge"
+FISCAL_KB_CHECK_INTERVAL = int(os.getenv('TAXAMI_KB_CHECK_INTERVAL', '30'))
+
+# Knowledge base condivisa: caricata all'avvio, ricarica solo i file modificati
+fiscal_kb = FiscalKnowledgeBase(FISCAL_KB_PATH, FISCAL_KB_CHECK_INTERVAL)
 
 # Freemium limits
 FREE_QUESTIONS_PER_DAY = 3
 
+# Concorrenza: handler di chat diverse in parallelo, stessa chat in ordine
+MAX_CONCURRENT_UPDATES = int(os.getenv('TAXAMI_MAX_CONCURRENCY', '8'))
+MAX_PENDING_UPDATES = int(os.getenv('TAXAMI_MAX_PENDING_UPDATES', '500'))
+
+# Due tentativi OpenAI al massimo per ogni update in lavorazione
+openai_hedger = HedgedExecutor(workers=MAX_CONCURRENT_UPDATES * 2, metrics=metrics)
+
+# Coalescing: una generazione per prompt identici in corso, tap ripetuti sullo stesso bottone scartati
+ai_requests = SingleFlight("openai", metrics=metrics)
+CALLBACK_DEBOUNCE_SECONDS = float(os.getenv('TAXAMI_CALLBACK_DEBOUNCE', '2'))
+callback_debouncer = Debouncer(CALLBACK_DEBOUNCE_SECONDS, name="callback", metrics=metrics)
+
+# Worker mode: processi worker sharded per chat_id (0 = singolo processo)
+WORKER_PROCESSES = int(os.getenv('TAXAMI_WORKERS', '0'))
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv('TAXAMI_WORKER_HEARTBEAT', '5'))
+
+# Webhook mode: path dei webhook e secret inviato da Telegram nell'header
+TELEGRAM_WEBHOOK_PATH = os.getenv('TAXAMI_TELEGRAM_WEBHOOK_PATH', '/telegram')
+STRIPE_WEBHOOK_PATH = os.getenv('TAXAMI_STRIPE_WEBHOOK_PATH', '/stripe')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TAXAMI_WEBHOOK_SECRET', '')
+
+# Limiti di invio Telegram: ~30 msg/s globali, ~1 msg/s per chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TAXAMI_TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TAXAMI_TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = int(os.getenv('TAXAMI_TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_SEND_WORKERS = int(os.getenv('TAXAMI_TELEGRAM_SEND_WORKERS', '8'))
+
+# Client Telegram con connection pool keep-alive condiviso dai worker;
+# gli invii passano dallo scheduler che rispetta i rate limit e i 429
+telegram_client = TelegramClient(TELEGRAM_TOKEN, TELEGRAM_API_BASE, pool_size=TELEGRAM_SEND_WORKERS + 2, metrics=metrics)
+send_scheduler = SendScheduler(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_SEND_WORKERS)
+telegram = RateLimitedTelegram(telegram_client, send_scheduler)
+
 # Domande fiscali GRATUITE (Strategia Freemium)
 DOMANDE_FREE = {
     "1": {
         "titolo": "🆕 Come aprire partita IVA",
         "keywords": ["aprire", "partita", "iva", "nuova", "iniziare", "attivare"],
+        "esclusioni": ["chiud", "chius", "cess"],
         "categoria": "base",
         "prompt": "Spiega come aprire partita IVA in Italia nel 2026: documenti necessari, costi, tempistiche e primi passi. Fornisci una guida pratica step-by-step."
     },
@@ -87,6 +206,7 @@ DOMANDE_FREE = {
     "4": {
         "titolo": "🏢 SRL vs Ditta Individuale",
         "keywords": ["srl", "ditta", "individuale", "società", "responsabilità", "limitata"],
+        "esclusioni": ["sciogl", "sciolt", "liquidaz"],
         "categoria": "base",
         "prompt": "Confronta SRL e Ditta Individuale: vantaggi fiscali, responsabilità, costi gestione, tassazione. Quando conviene una forma o l'altra?"
     },
@@ -99,6 +219,7 @@ DOMANDE_FREE = {
     "6": {
         "titolo": "🤝 Società di persone - SNC/SAS",
         "keywords": ["snc", "sas", "società", "persone", "accomandita", "collettiva"],
+        "esclusioni": ["sciogl", "sciolt", "liquidaz"],
         "categoria": "base", 
         "prompt": "Caratteristiche delle società di persone (SNC/SAS): costituzione, tassazione, responsabilità soci, gestione. Pro e contro."
     },
@@ -120,7 +241,7 @@ DOMANDE_PREMIUM = {
     },
     "102": {
         "titolo": "🔍 Controlli fiscali e verifiche",
-        "keywords": ["controlli", "verifiche", "guardia", "finanza", "accertamento", "difesa"],
+        "keywords": ["controlli", "verifiche", "guardia di finanza", "accertamento", "difesa"],
         "categoria": "avanzata", 
         "prompt": "Gestione controlli fiscali 2026: diritti del contribuente, strategie difensive, documentazione richiesta, tempi e modalità verifiche."
     },
@@ -161,6 +282,21 @@ DOMANDE_PREMIUM = {
         "prompt": "GDPR e compliance privacy aziendale: adeguamenti normativi, registro trattamenti, analisi impatto, strategie protezione dati."
     }
 }
+ALL_QUESTIONS = {**DOMANDE_FREE, **DOMANDE_PREMIUM}
+
+# Intent del testo libero: keyword di tutte le domande compilate in un solo automa
+INTENT_MIN_SCORE = float(os.getenv('TAXAMI_INTENT_MIN_SCORE', '1.5'))
+INTENT_THRESHOLD = float(os.getenv('TAXAMI_INTENT_THRESHOLD', '0.75'))  # > 1 disattiva il routing
+# Termini presenti in domande fiscali di ogni tipo: da soli non identificano una domanda del menu
+INTENT_GENERIC_KEYWORDS = (
+    "partita", "iva", "fiscale", "fiscal", "società", "spese", "dichiarazione", "pagare",
+    "nuova", "due", "dati", "analisi", "rischi", "impresa", "informazioni",
+)
+intent_matcher = IntentMatcher(
+    {q_id: q["keywords"] for q_id, q in ALL_QUESTIONS.items()},
+    generic=INTENT_GENERIC_KEYWORDS,
+    exclude={q_id: q["esclusioni"] for q_id, q in ALL_QUESTIONS.items() if q.get("esclusioni")}
+)
 
 # Robust utility functions
 def safe_file_operation(file_path, operation, default_value=None, retries=3):
@@ -198,72 +334,102 @@ def safe_file_operation(file_path, operation, default_value=None, retries=3):
     return False
 
 def log_error(error_type, error_message, context=None):
-    """Log degli errori in file separato per analisi"""
+    """Log degli errori per analisi (in memoria, flush sullo store in background)"""
+    _request_state.failed = True
     try:
-        errors = safe_file_operation(ERROR_LOG_FILE, 'read', [])
-        error_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "type": error_type,
-            "message": str(error_message),
-            "context": context,
-            "traceback": traceback.format_exc() if sys.exc_info()[0] else None
-        }
-        errors.append(error_entry)
-        
-        # Mantieni solo gli ultimi 100 errori
-        if len(errors) > 100:
-            errors = errors[-100:]
-            
-        safe_file_operation(ERROR_LOG_FILE, 'write', errors)
+        metrics.inc("errors_total", type=error_type)
+        error_log.record(
+            error_type,
+            error_message,
+            context,
+            traceback.format_exc() if sys.exc_info()[0] else None
+        )
     except Exception as e:
         logger.error(f"Impossibile loggare errore: {e}")
 
-def circuit_breaker_check():
-    """Circuit breaker pattern per prevenire cascade failures"""
-    global error_count, ERROR_RESET_TIME
-    current_time = time.time()
-    
-    # Reset error count dopo timeout
-    if hasattr(circuit_breaker_check, 'last_reset'):
-        if current_time - circuit_breaker_check.last_reset > ERROR_RESET_TIME:
-            error_count = 0
-            circuit_breaker_check.last_reset = current_time
-    else:
-        circuit_breaker_check.last_reset = current_time
-    
-    if error_count >= MAX_ERRORS_BEFORE_PAUSE:
-        logger.warning(f"Circuit breaker attivato: troppi errori ({error_count}). Pausa 30 secondi...")
-        time.sleep(30)
-        error_count = 0
+# Circuit breaker per dipendenza: un guasto di OpenAI non ferma Telegram e Stripe
+BREAKER_WINDOW = int(os.getenv('TAXAMI_BREAKER_WINDOW', '60'))
+BREAKER_MIN_CALLS = int(os.getenv('TAXAMI_BREAKER_MIN_CALLS', '10'))
+BREAKER_ERROR_RATE = float(os.getenv('TAXAMI_BREAKER_ERROR_RATE', '0.5'))
+BREAKER_OPEN_SECONDS = float(os.getenv('TAXAMI_BREAKER_OPEN_SECONDS', '30'))
+BREAKER_PROBES = int(os.getenv('TAXAMI_BREAKER_PROBES', '3'))
+
+def is_telegram_outage(exc):
+    """Timeout, errori di rete e 5xx; i 4xx (Markdown, chat bloccata, 429) e la coda di invio locale no"""
+    if isinstance(exc, SendTimeout):
         return False
-    return True
+    return not (isinstance(exc, TelegramAPIError) and exc.error_code < 500)
+
+def is_openai_outage(exc):
+    """Errori di rete, 429 e 5xx; le richieste rifiutate (4xx) no"""
+    return not (isinstance(exc, APIStatusError) and exc.status_code < 500 and exc.status_code != 429)
+
+def create_breaker(name, is_failure):
+    return CircuitBreaker(name, BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_ERROR_RATE,
+                          BREAKER_OPEN_SECONDS, BREAKER_PROBES, is_failure)
+
+telegram_breaker = create_breaker("telegram", is_telegram_outage)
+openai_breaker = create_breaker("openai", is_openai_outage)
+circuit_breakers = {
+    "telegram": telegram_breaker,
+    "openai": openai_breaker,
+    "stripe": payment_manager.breaker,
+}
+
+def robust_api_call(func, *args, max_retries=3, breaker=None, **kwargs):
+    """Wrapper per chiamate API con retry, error handling e circuit breaker.
 
-def robust_api_call(func, *args, max_retries=3, **kwargs):
-    """Wrapper per chiamate API con retry e error handling"""
+    Con il circuito di ``breaker`` aperto restituisce subito None senza
+    chiamare la dipendenza: i chiamanti passano al percorso degradato.
+    """
     global error_count
     
     for attempt in range(max_retries):
+        if breaker is not None and not breaker.allow():
+            logger.warning(f"Circuito {breaker.name} aperto: {func.__name__} saltata")
+            return None
+        
         try:
-            if not circuit_breaker_check():
-                continue
-                
             result = func(*args, **kwargs)
-            error_count = max(0, error_count - 1)  # Decrementa su successo
+            if breaker is not None:
+                breaker.on_success()
             return result
             
-        except requests.exceptions.Timeout:
+        except SendTimeout as e:
+            # Annullato nella coda di invio: ritentare accoderebbe solo un altro job
+            if breaker is not None:
+                breaker.on_error(e)
+            logger.warning(f"{func.__name__} non inviato: {e}")
+            return None
+            
+        except requests.exceptions.Timeout as e:
+            if breaker is not None:
+                breaker.on_error(e)
             logger.warning(f"Timeout su {func.__name__}, tentativo {attempt + 1}/{max_retries}")
             time.sleep(2 ** attempt)  # Exponential backoff
             
         except requests.exceptions.ConnectionError as e:
+            if breaker is not None:
+                breaker.on_error(e)
             logger.warning(f"Errore connessione su {func.__name__}: {e}")
             time.sleep(5)
             
         except Exception as e:
+            if breaker is not None:
+                breaker.on_error(e)
+            # 429: rate limit, non un guasto. Attendi quanto richiesto senza contare errori
+            if isinstance(e, TelegramAPIError) and e.retry_after:
+                logger.warning(f"Rate limit su {func.__name__}: retry tra {e.retry_after}s")
+                time.sleep(min(e.retry_after, 30))
+                continue
+            
             error_count += 1
             log_error(f"API_CALL_{func.__name__}", str(e), {"attempt": attempt + 1})
             logger.error(f"Errore {func.__name__} (tentativo {attempt + 1}): {e}")
             
+            # Altri 4xx: la stessa richiesta verrebbe rifiutata di nuovo
+            if isinstance(e, TelegramAPIError) and e.error_code < 500:
+                return None
             if attempt == max_retries - 1:
                 return None
             time.sleep(1)
@@ -272,125 +438,401 @@ def robust_api_call(func, *args, max_retries=3, **kwargs):
 
 # API Telegram robuste
 def send_message_robust(chat_id, text, reply_markup=None, parse_mode="Markdown"):
-    """Invio messaggi robusto con fallback"""
+    """Invio messaggi robusto: testo troncato e Markdown reso valido prima dell'invio"""
+    text = sanitize_markdown(text) if parse_mode else text[:4096]
+    
     def _send():
-        data = {
-            "chat_id": chat_id,
-            "text": text[:4096],  # Truncate se troppo lungo
-            "parse_mode": parse_mode
-        }
-        if reply_markup:
-            data["reply_markup"] = json.dumps(reply_markup)
-        
-        response = requests.post(f"{BASE_URL}/sendMessage", data=data, timeout=10)
-        response.raise_for_status()
-        return response.json()
-    
-    # Prova prima con Markdown
-    result = robust_api_call(_send)
-    
-    # Fallback senza Markdown se fallisce
-    if not result and parse_mode == "Markdown":
-        logger.warning(f"Markdown fallito per chat {chat_id}, retry senza formatting")
-        def _send_plain():
-            data = {
-                "chat_id": chat_id,
-                "text": text[:4096],
-                "parse_mode": None
-            }
-            if reply_markup:
-                data["reply_markup"] = json.dumps(reply_markup)
-            
-            response = requests.post(f"{BASE_URL}/sendMessage", data=data, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        
-        result = robust_api_call(_send_plain)
+        try:
+            return telegram.send_message(chat_id, text, reply_markup, parse_mode)
+        except TelegramAPIError as e:
+            # Ultima difesa se Telegram rifiuta comunque le entità: invio senza Markdown
+            if not (parse_mode and e.is_parse_error):
+                raise
+            logger.warning(f"Markdown fallito per chat {chat_id}, retry senza formatting")
+            return telegram.send_message(chat_id, text, reply_markup, None)
     
-    return result
+    return robust_api_call(_send, breaker=telegram_breaker)
 
 def get_updates_robust(offset=None):
     """Get updates robusto"""
     def _get_updates():
-        params = {"timeout": 10, "limit": 100}
-        if offset:
-            params["offset"] = offset
-            
-        response = requests.get(f"{BASE_URL}/getUpdates", params=params, timeout=15)
-        response.raise_for_status()
-        return response.json()
+        return telegram.get_updates(offset, timeout=10, limit=100)
     
-    return robust_api_call(_get_updates)
+    return robust_api_call(_get_updates, breaker=telegram_breaker)
 
 def answer_callback_robust(callback_query_id):
     """Answer callback query robusto"""
     def _answer():
-        data = {"callback_query_id": callback_query_id}
-        response = requests.post(f"{BASE_URL}/answerCallbackQuery", data=data, timeout=5)
-        response.raise_for_status()
-        return response.json()
+        return telegram.answer_callback_query(callback_query_id)
     
-    return robust_api_call(_answer)
+    return robust_api_call(_answer, breaker=telegram_breaker)
+
+def edit_message_robust(chat_id, message_id, text, reply_markup=None, parse_mode="Markdown"):
+    """Modifica un messaggio esistente, con la stessa preparazione del testo di send_message_robust"""
+    text = sanitize_markdown(text) if parse_mode else text[:4096]
+    
+    def _edit():
+        try:
+            return telegram.edit_message_text(chat_id, message_id, text, reply_markup, parse_mode)
+        except TelegramAPIError as e:
+            if not (parse_mode and e.is_parse_error):
+                raise
+            logger.warning(f"Markdown fallito per chat {chat_id}, modifica senza formatting")
+            return telegram.edit_message_text(chat_id, message_id, text, reply_markup, None)
+    
+    return robust_api_call(_edit, breaker=telegram_breaker)
+
+def send_chat_action_robust(chat_id, action="typing"):
+    """Mostra "sta scrivendo..." mentre la risposta è in preparazione"""
+    return robust_api_call(telegram.send_chat_action, chat_id, action, max_retries=1, breaker=telegram_breaker)
 
 # OpenAI robusto
-def generate_ai_response_robust(prompt, is_premium=False, max_tokens=400):
-    """Genera risposta AI con fallback models"""
-    if not client:
-        return "⚠️ Servizio AI temporaneamente non disponibile. Riprova tra qualche minuto."
-    
-    # Model selection basato su premium status
-    primary_model = "gpt-4" if is_premium else "gpt-3.5-turbo"
-    fallback_model = "gpt-3.5-turbo" if primary_model == "gpt-4" else "gpt-3.5-turbo"
-    
-    def _generate(model):
-        response = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=max_tokens,
-            temperature=0.6,
-            timeout=30
-        )
+AI_UNAVAILABLE_MESSAGE = "⚠️ Servizio AI temporaneamente non disponibile. Riprova tra qualche minuto."
+AI_OVERLOADED_MESSAGE = "⚠️ Servizio AI temporaneamente sovraccarico. Riprova tra qualche minuto o contatta il supporto."
+
+def select_models(is_premium=False):
+    """Restituisce (primary_model, fallback_model) per il tier dell'utente, secondo budget e latenza"""
+    return cost_optimizer.choose_models("premium" if is_premium else "free")
+
+def is_ai_fallback_message(text):
+    """True se il testo è un messaggio di servizio e non una risposta AI"""
+    return text in (AI_UNAVAILABLE_MESSAGE, AI_OVERLOADED_MESSAGE)
+
+def record_openai_call(model, seconds, usage=None, mode="sync", ok=True):
+    """Latenza e token (``response.usage``) di una chiamata OpenAI, per metriche e routing"""
+    prompt_tokens = (usage.prompt_tokens or 0) if usage is not None else 0
+    completion_tokens = (usage.completion_tokens or 0) if usage is not None else 0
+    metrics.observe("openai_request_seconds", seconds, model=model, mode=mode)
+    if usage is not None:
+        metrics.inc("openai_tokens_total", prompt_tokens, model=model, kind="prompt")
+        metrics.inc("openai_tokens_total", completion_tokens, model=model, kind="completion")
+    cost = cost_optimizer.record(model, seconds, prompt_tokens, completion_tokens, ok=ok)
+    if cost:
+        metrics.inc("openai_cost_usd_total", cost, model=model)
+
+def estimate_stream_usage(prompt, content_chunks):
+    """Usage stimato di uno stream chiuso prima della fine: quello reale arriva solo nell'ultimo chunk.
+
+    Il prompt è comunque fatturato (circa 4 caratteri per token), il
+    completamento conta un token per chunk di testo ricevuto.
+    """
+    return SimpleNamespace(prompt_tokens=max(1, len(prompt) // 4), completion_tokens=content_chunks)
+
+def hedge_delay(model, fallback_model, remaining):
+    """Attesa prima del tentativo parallelo: p95 osservato del modello (o il default).
+
+    Se il fallback è lo stesso modello (tier free) un secondo tentativo
+    parallelo raddoppierebbe solo la spesa: parte soltanto dopo un errore.
+    """
+    if fallback_model == model:
+        return remaining
+    latency = cost_optimizer.latency(model)
+    if latency is None:
+        return OPENAI_HEDGE_AFTER
+    return max(OPENAI_HEDGE_MIN, latency[1])
+
+def generate_ai_response_stream(prompt, models, max_tokens, stream, deadline):
+    """Genera la risposta in streaming aggiornando ``stream``; None se fallisce o supera ``deadline``.
+
+    Come per le risposte sincrone niente retry interni del client e timeout
+    pari al tempo rimasto. Con l'hedging attivo è coperta anche l'attesa del
+    primo token: se il primary non inizia a rispondere entro il suo p95 parte
+    lo streaming del fallback e prosegue quello che emette per primo.
+    """
+    primary_model, fallback_model = models
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        return None
+    fast_client = client.with_options(max_retries=0)
+    lock = threading.Lock()
+    state = {"winner": None, "abandoned": False}
+    
+    def _attempt(model):
+        def _open(timeout):
+            if not openai_breaker.allow():
+                return None
+            start = time.perf_counter()
+            try:
+                response = fast_client.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    max_tokens=max_tokens,
+                    temperature=0.6,
+                    timeout=timeout,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                # Chunk letti fino al primo token: vengono riprodotti da chi prosegue lo stream
+                chunks = []
+                for chunk in response:
+                    chunks.append(chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        break
+            except Exception as e:
+                openai_breaker.on_error(e)
+                record_openai_call(model, time.perf_counter() - start, mode="stream", ok=False)
+                log_error("AI_STREAM", str(e), {"model": model})
+                raise
+            if not chunks or not chunks[-1].choices or not chunks[-1].choices[0].delta.content:
+                openai_breaker.on_success()
+                return None  # stream terminato senza testo
+            metrics.observe("openai_first_token_seconds", time.perf_counter() - start, model=model)
+            with lock:
+                if state["winner"] is None and not state["abandoned"]:
+                    # L'esito per il circuit breaker lo registra chi legge lo stream fino in fondo
+                    state["winner"] = (model, response, chunks, start)
+                    return state["winner"]
+            # Un altro tentativo sta già rispondendo (o la domanda è scaduta)
+            openai_breaker.on_success()
+            response.close()
+            record_openai_call(model, time.perf_counter() - start, estimate_stream_usage(prompt, 1), mode="stream")
+            return None
+        return _open
+    
+    stream.start()
+    if OPENAI_HEDGING:
+        openai_hedger.run([_attempt(primary_model), _attempt(fallback_model)],
+                          hedge_delay(primary_model, fallback_model, remaining), remaining)
+    else:
+        try:
+            _attempt(primary_model)(remaining)
+        except Exception as e:
+            logger.warning(f"Streaming {primary_model} fallito: {e}")
+    # Da qui nessun tentativo in ritardo può più vincere
+    with lock:
+        state["abandoned"] = True
+        winner = state["winner"]
+    if winner is None:
+        stream.reset()
+        return None
+    
+    model, response, chunks, start = winner
+    if model != primary_model:
+        logger.info(f"Streaming dal tentativo parallelo ({model}) invece di {primary_model}")
+    usage = None
+    received = 0
+    
+    def _consume(chunk):
+        nonlocal usage, received
+        if chunk.choices and chunk.choices[0].delta.content:
+            received += 1
+            stream.append(chunk.choices[0].delta.content)
+        if chunk.usage:
+            usage = chunk.usage
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"deadline di {OPENAI_DEADLINE:.0f}s superata durante lo streaming")
+    
+    try:
+        for chunk in chunks:
+            _consume(chunk)
+        for chunk in response:
+            _consume(chunk)
+    except Exception as e:
+        response.close()
+        openai_breaker.on_error(e)
+        record_openai_call(model, time.perf_counter() - start, usage or estimate_stream_usage(prompt, received),
+                           mode="stream", ok=False)
+        log_error("AI_STREAM", str(e), {"model": model})
+        logger.warning(f"Streaming {model} fallito, uso la generazione standard: {e}")
+        stream.reset()
+        return None
+    openai_breaker.on_success()
+    record_openai_call(model, time.perf_counter() - start, usage, mode="stream")
+    return stream.text or None
+
+def generate_ai_response_hedged(generate, primary_model, fallback_model, deadline):
+    """Primary e, se tarda oltre il suo p95, fallback in parallelo: vince la prima risposta.
+
+    Un solo tentativo per modello (niente retry interni del client OpenAI):
+    il fallback sostituisce i retry, e ``deadline`` limita l'attesa totale.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        return AI_OVERLOADED_MESSAGE
+    fast_client = client.with_options(max_retries=0)
+    
+    def _attempt(model):
+        def _call(timeout):
+            if not openai_breaker.allow():
+                return None
+            try:
+                result = generate(model, timeout, fast_client)
+            except Exception as e:
+                openai_breaker.on_error(e)
+                log_error("AI_CALL", str(e), {"model": model})
+                raise
+            openai_breaker.on_success()
+            return result
+        return _call
+    
+    result, winner = openai_hedger.run(
+        [_attempt(primary_model), _attempt(fallback_model)],
+        hedge_delay(primary_model, fallback_model, remaining), remaining
+    )
+    if winner:
+        logger.info(f"Risposta dal tentativo parallelo ({fallback_model}) invece di {primary_model}")
+    if not result:
+        return AI_OVERLOADED_MESSAGE if openai_breaker.available() else AI_UNAVAILABLE_MESSAGE
+    return result
+
+def generate_ai_response_robust(prompt, is_premium=False, max_tokens=400, stream=None, models=None):
+    """Genera risposta AI con fallback models (in streaming se ``stream`` è fornito)"""
+    if not client or not openai_breaker.available():
+        return AI_UNAVAILABLE_MESSAGE
+    
+    # Model selection basato su premium status, budget e latenza (o già fatta dal chiamante)
+    models = models or select_models(is_premium)
+    
+    # Richieste identiche già in corso (broadcast, doppio tap): attendono la stessa generazione
+    result, _ = ai_requests.do((models[0], prompt, max_tokens), generate_ai_response, prompt, models, max_tokens, stream)
+    return result
+
+def generate_ai_response(prompt, models, max_tokens, stream=None):
+    """Una generazione entro OPENAI_DEADLINE: streaming (hedged sul primo token), poi hedging (o retry sequenziali) primary/fallback"""
+    primary_model, fallback_model = models
+    deadline = time.monotonic() + OPENAI_DEADLINE
+    
+    if stream is not None:
+        result = generate_ai_response_stream(prompt, models, max_tokens, stream, deadline)
+        if result:
+            return result
+    
+    def _generate(model, timeout=30, openai_client=client):
+        start = time.perf_counter()
+        try:
+            response = openai_client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_tokens,
+                temperature=0.6,
+                timeout=timeout
+            )
+        except Exception:
+            record_openai_call(model, time.perf_counter() - start, ok=False)
+            raise
+        record_openai_call(model, time.perf_counter() - start, response.usage)
         return response.choices[0].message.content
     
+    if OPENAI_HEDGING:
+        return generate_ai_response_hedged(_generate, primary_model, fallback_model, deadline)
+    
     # Prova primary model
-    result = robust_api_call(_generate, primary_model)
+    result = robust_api_call(_generate, primary_model, breaker=openai_breaker)
     
     # Fallback se primary fallisce
     if not result and primary_model != fallback_model:
         logger.warning(f"Fallback da {primary_model} a {fallback_model}")
-        result = robust_api_call(_generate, fallback_model)
+        result = robust_api_call(_generate, fallback_model, breaker=openai_breaker)
     
     # Ultima risorsa: messaggio di fallback
     if not result:
-        return "⚠️ Servizio AI temporaneamente sovraccarico. Riprova tra qualche minuto o contatta il supporto."
+        return AI_OVERLOADED_MESSAGE if openai_breaker.available() else AI_UNAVAILABLE_MESSAGE
     
     return result
 
+def get_canned_answer(question_id, question, is_premium=False, stream=None):
+    """Risposta AI a una domanda del menu, dalla response cache se disponibile"""
+    max_tokens = 600 if is_premium else 400
+    models = select_models(is_premium)
+    primary_model = models[0]
+    load_fiscal_knowledge_robust()  # Aggiorna la knowledge base prima di calcolare la chiave
+    cache_key = ResponseCache.make_key(
+        "q", question_id, "premium" if is_premium else "free",
+        primary_model, max_tokens, fiscal_kb.fingerprint
+    )
+    
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    fiscal_context = get_question_context(question_id, question)
+    enhanced_prompt = f"{question['prompt']}\n\nContesto normativo:\n{fiscal_context}" if fiscal_context else question['prompt']
+    
+    ai_response = generate_ai_response_robust(enhanced_prompt, is_premium, max_tokens, stream, models)
+    if not is_ai_fallback_message(ai_response):
+        response_cache.put(cache_key, ai_response)
+    return ai_response
+
+_semantic_cache_kb = None
+
+def get_free_text_answer(text, is_premium=False, stream=None):
+    """Risposta a una domanda libera, riusando quella di una domanda simile se presente"""
+    global _semantic_cache_kb
+    max_tokens = 600 if is_premium else 400
+    models = select_models(is_premium)
+    namespace = f"{'premium' if is_premium else 'free'}:{models[0]}"
+    
+    # Le risposte dipendono dal contesto normativo: nuova knowledge base, cache vuota
+    load_fiscal_knowledge_robust()
+    if _semantic_cache_kb != fiscal_kb.fingerprint:
+        semantic_cache.clear()
+        _semantic_cache_kb = fiscal_kb.fingerprint
+    
+    # Con OpenAI non disponibile vale la stessa soglia: una risposta a una domanda
+    # solo vagamente simile ("chiudo" invece di "apro") è peggio di "riprova più tardi"
+    cached, similarity = semantic_cache.lookup(namespace, text)
+    if cached is not None:
+        logger.info(f"Semantic cache hit ({similarity:.2f}) per: {text[:50]}")
+        return cached
+    if not openai_breaker.available():
+        return AI_UNAVAILABLE_MESSAGE
+    
+    fiscal_context = search_fiscal_content_robust(text)
+    enhanced_prompt = f"Domanda fiscale: {text}\n\nContesto normativo:\n{fiscal_context}" if fiscal_context else f"Domanda fiscale: {text}"
+    
+    ai_response = generate_ai_response_robust(enhanced_prompt, is_premium, max_tokens, stream, models)
+    if not is_ai_fallback_message(ai_response):
+        semantic_cache.add(namespace, text, ai_response)
+    return ai_response
+
+CONTACTS_FOOTER = "\n\n📞 **Studio Di Sabato e Partners**\n🏢 Borgomanero (NO) | ☎️ 0322.340513 | 📱 338.457.2198"
+
+def create_answer_stream(chat_id):
+    """Messaggio progressivo per la risposta AI (None se lo streaming è disattivato)"""
+    if not STREAMING_ENABLED:
+        return None
+    return StreamingMessage(telegram, chat_id, STREAM_PLACEHOLDER, STREAM_EDIT_INTERVAL)
+
+def deliver_answer(chat_id, text, reply_markup, stream=None):
+    """Invia la risposta finale, sostituendo il placeholder dello streaming se presente"""
+    if stream is not None and stream.message_id is not None:
+        if edit_message_robust(chat_id, stream.message_id, text, reply_markup):
+            return
+    send_message_robust(chat_id, text, reply_markup)
+
+def build_answer_footer(user_id, is_premium):
+    """Footer con le domande gratuite rimaste e i contatti dello studio"""
+    if is_premium:
+        footer = "\n\n👑 Premium: Domande illimitate attive"
+    else:
+        remaining = max(0, FREE_QUESTIONS_PER_DAY - check_user_limits_robust(user_id))
+        footer = f"\n\n🆓 Ti rimangono {remaining} domande gratuite oggi"
+        if remaining <= 1:
+            footer += "\n💎 Upgrade Premium per domande illimitate!"
+    return footer + CONTACTS_FOOTER
+
+def warm_canned_answers():
+    """Pre-genera le risposte di tutte le domande del menu (da lanciare al deploy)"""
+    generated = 0
+    targets = [(q_id, q, False) for q_id, q in DOMANDE_FREE.items()]
+    targets += [(q_id, q, True) for q_id, q in ALL_QUESTIONS.items()]
+    
+    for q_id, question, is_premium in targets:
+        answer = get_canned_answer(q_id, question, is_premium)
+        if is_ai_fallback_message(answer):
+            logger.warning(f"Warm-up fallito per domanda {q_id} ({'premium' if is_premium else 'free'})")
+        else:
+            generated += 1
+    
+    logger.info(f"✅ Response cache pronta: {generated}/{len(targets)} risposte")
+    return generated
+
 # Business logic functions (stessa logica, ma più robuste)
 def save_lead_robust(user):
     """Salva lead in modo robusto"""
     try:
-        leads = safe_file_operation(LEADS_FILE, 'read', [])
-        
-        user_id = str(user.get('id'))
-        existing_lead = next((l for l in leads if l.get('id') == user_id), None)
-        
-        if not existing_lead:
-            lead = {
-                "id": user_id,
-                "username": user.get('username', ''),
-                "first_name": user.get('first_name', ''),
-                "last_name": user.get('last_name', ''),
-                "timestamp": datetime.now().isoformat(),
-                "interactions": 1
-            }
-            leads.append(lead)
-        else:
-            existing_lead['interactions'] = existing_lead.get('interactions', 0) + 1
-            existing_lead['last_interaction'] = datetime.now().isoformat()
-        
-        safe_file_operation(LEADS_FILE, 'write', leads)
-        logger.info(f"Lead salvato: {user.get('first_name')} ({user_id})")
+        lead_registry.record_interaction(user)
+        logger.info(f"Lead salvato: {user.get('first_name')} ({user.get('id')})")
         
     except Exception as e:
         log_error("SAVE_LEAD", str(e), {"user": user})
@@ -398,10 +840,7 @@ def save_lead_robust(user):
 def check_user_limits_robust(user_id):
     """Controllo limiti utente robusto"""
     try:
-        limits = safe_file_operation(USER_LIMITS_FILE, 'read', {})
-        today = date.today().isoformat()
-        user_data = limits.get(str(user_id), {})
-        return user_data.get(today, 0)
+        return usage_counters.get(user_id)
     except Exception as e:
         log_error("CHECK_USER_LIMITS", str(e), {"user_id": user_id})
         return 0  # Fallback sicuro
@@ -409,130 +848,135 @@ def check_user_limits_robust(user_id):
 def increment_user_usage_robust(user_id):
     """Incrementa usage utente in modo robusto"""
     try:
-        limits = safe_file_operation(USER_LIMITS_FILE, 'read', {})
-        today = date.today().isoformat()
-        user_key = str(user_id)
-        
-        if user_key not in limits:
-            limits[user_key] = {}
-        
-        limits[user_key][today] = limits[user_key].get(today, 0) + 1
-        
-        # Cleanup vecchie date (oltre 7 giorni)
-        cutoff_date = (date.today() - timedelta(days=7)).isoformat()
-        for user in limits.values():
-            old_dates = [d for d in user.keys() if d < cutoff_date]
-            for old_date in old_dates:
-                del user[old_date]
-        
-        safe_file_operation(USER_LIMITS_FILE, 'write', limits)
-        
+        usage_counters.increment(user_id)
     except Exception as e:
         log_error("INCREMENT_USER_USAGE", str(e), {"user_id": user_id})
 
+def try_consume_free_question(user_id):
+    """Verifica il limite giornaliero e scala una domanda in un'unica operazione"""
+    try:
+        allowed, _ = usage_counters.try_consume(user_id, FREE_QUESTIONS_PER_DAY)
+        return allowed
+    except Exception as e:
+        log_error("CONSUME_FREE_QUESTION", str(e), {"user_id": user_id})
+        return True  # Fallback sicuro, come check_user_limits_robust
+
 def load_fiscal_knowledge_robust():
-    """Carica knowledge base in modo robusto"""
+    """Restituisce la knowledge base condivisa (ricaricata solo se modificata)"""
     try:
-        if not os.path.exists(FISCAL_KB_PATH):
-            logger.warning("Database fiscale non trovato")
-            return {}
-        
-        knowledge = {}
-        for filename in os.listdir(FISCAL_KB_PATH):
-            if filename.endswith('.json'):
-                file_path = os.path.join(FISCAL_KB_PATH, filename)
-                data = safe_file_operation(file_path, 'read', [])
-                if data:
-                    knowledge[filename.replace('.json', '')] = data
-        
-        return knowledge
+        return fiscal_kb.get_knowledge()
     except Exception as e:
         log_error("LOAD_FISCAL_KNOWLEDGE", str(e))
         return {}
 
-def search_fiscal_content_robust(query, knowledge):
-    """Ricerca contenuti fiscali robusta"""
+_fiscal_index = None
+_fiscal_index_lock = threading.Lock()
+
+def get_fiscal_index():
+    """Indice BM25 della knowledge base, ricostruito quando cambia la versione"""
+    global _fiscal_index
+    knowledge = load_fiscal_knowledge_robust()
+    index = _fiscal_index
+    if index is not None and index.version == fiscal_kb.version:
+        return index
+    
+    with _fiscal_index_lock:
+        if _fiscal_index is None or _fiscal_index.version != fiscal_kb.version:
+            started = time.time()
+            index = FiscalSearchIndex(knowledge, version=fiscal_kb.version)
+            # Contesti delle domande del menu calcolati una volta per versione
+            index.precompute_contexts({
+                q_id: question['prompt']
+                for q_id, question in ALL_QUESTIONS.items()
+            })
+            _fiscal_index = index
+            logger.info(f"Indice fiscale costruito: {len(index)} articoli in {time.time() - started:.2f}s")
+        return _fiscal_index
+
+def search_fiscal_content_robust(query, knowledge=None):
+    """Ricerca BM25 sull'intera knowledge base (o su ``knowledge`` se fornita)"""
     try:
-        if not knowledge:
-            return ""
-        
-        query_words = query.lower().split()
-        relevant_content = []
-        
-        for section, articles in knowledge.items():
-            for article in articles[:3]:  # Limita per performance
-                title = article.get('title', '').lower()
-                if any(word in title for word in query_words):
-                    relevant_content.append(f"• {article.get('title', 'N/A')}")
-        
-        return "\n".join(relevant_content[:5]) if relevant_content else ""
+        index = get_fiscal_index() if knowledge is None else FiscalSearchIndex(knowledge)
+        with metrics.timer("kb_search_seconds"):
+            return index.format_context(query)
     except Exception as e:
         log_error("SEARCH_FISCAL_CONTENT", str(e), {"query": query})
         return ""
 
-# Menu creation (stesso codice ma con error handling)
-def create_main_menu_robust(is_premium=False):
-    """Crea menu principale in modo robusto"""
+def get_question_context(question_id, question):
+    """Contesto normativo precalcolato per una domanda del menu"""
     try:
-        keyboard = {"inline_keyboard": []}
+        context = get_fiscal_index().get_context(question_id)
+        if context is not None:
+            return context
+    except Exception as e:
+        log_error("SEARCH_FISCAL_CONTENT", str(e), {"question_id": question_id})
+    return search_fiscal_content_robust(question['prompt'])
+
+# Menu creation (stesso codice ma con error handling)
+def build_main_menu(is_premium=False):
+    """Menu principale: domande gratuite, sezione premium e bottoni finali"""
+    keyboard = {"inline_keyboard": []}
+    
+    # Domande gratuite
+    for q_id, question in DOMANDE_FREE.items():
+        keyboard["inline_keyboard"].append([{
+            "text": f"{q_id}. {question['titolo']}",
+            "callback_data": f"question_{q_id}"
+        }])
+    
+    # Domande premium
+    if is_premium:
+        keyboard["inline_keyboard"].append([{
+            "text": "--- 💎 SEZIONE PREMIUM ---",
+            "callback_data": "noop"
+        }])
         
-        # Domande gratuite
-        for q_id, question in DOMANDE_FREE.items():
+        for q_id, question in DOMANDE_PREMIUM.items():
             keyboard["inline_keyboard"].append([{
-                "text": f"{q_id}. {question['titolo']}",
+                "text": f"{q_id}. {question['titolo']} 💎",
                 "callback_data": f"question_{q_id}"
             }])
-        
-        # Domande premium
-        if is_premium:
-            keyboard["inline_keyboard"].append([{
-                "text": "--- 💎 SEZIONE PREMIUM ---",
-                "callback_data": "noop"
-            }])
-            
-            for q_id, question in DOMANDE_PREMIUM.items():
-                keyboard["inline_keyboard"].append([{
-                    "text": f"{q_id}. {question['titolo']} 💎",
-                    "callback_data": f"question_{q_id}"
-                }])
-        
-        # Bottoni finali
-        if not is_premium:
-            keyboard["inline_keyboard"].append([
-                {"text": "💎 UPGRADE PREMIUM", "callback_data": "premium"},
-                {"text": "ℹ️ Contatti", "callback_data": "contacts"}
-            ])
-        else:
-            keyboard["inline_keyboard"].append([
-                {"text": "👑 STATUS PREMIUM", "callback_data": "premium_status"},
-                {"text": "ℹ️ Contatti", "callback_data": "contacts"}
-            ])
-        
-        return keyboard
-        
-    except Exception as e:
-        log_error("CREATE_MAIN_MENU", str(e), {"is_premium": is_premium})
-        # Fallback menu minimale
-        return {
-            "inline_keyboard": [
-                [{"text": "ℹ️ Contatti", "callback_data": "contacts"}],
-                [{"text": "🔄 Riprova", "callback_data": "main_menu"}]
-            ]
-        }
+    
+    # Bottoni finali
+    if not is_premium:
+        keyboard["inline_keyboard"].append([
+            {"text": "💎 UPGRADE PREMIUM", "callback_data": "premium"},
+            {"text": "ℹ️ Contatti", "callback_data": "contacts"}
+        ])
+    else:
+        keyboard["inline_keyboard"].append([
+            {"text": "👑 STATUS PREMIUM", "callback_data": "premium_status"},
+            {"text": "ℹ️ Contatti", "callback_data": "contacts"}
+        ])
+    
+    return keyboard
 
-# Handler functions robuste
-def handle_start_robust(chat_id, user):
-    """Gestisce /start in modo robusto"""
-    try:
-        save_lead_robust(user)
-        
-        user_id = user.get('id')
-        is_premium = premium_manager.is_premium_user(user_id) if premium_manager else False
-        
-        if is_premium:
-            welcome_text = f"""👑 **Benvenuto su TAXAMI PREMIUM!** 
+# Tastiere e testi fissi: serializzati e validati una volta all'avvio
+renderer = MessageRenderer()
+renderer.add_keyboard("main_menu_free", build_main_menu(False))
+renderer.add_keyboard("main_menu_premium", build_main_menu(True))
+MAIN_MENU_KEYBOARD = renderer.add_keyboard(
+    "main_menu", {"inline_keyboard": [[{"text": "📋 Menu Principale", "callback_data": "main_menu"}]]}
+)
+QUESTIONS_MENU_KEYBOARD = renderer.add_keyboard(
+    "questions_menu", {"inline_keyboard": [[{"text": "📋 Menu Domande", "callback_data": "main_menu"}]]}
+)
+LIMIT_REACHED_KEYBOARD = renderer.add_keyboard("limit_reached", {"inline_keyboard": [
+    [{"text": "💎 Upgrade Premium", "callback_data": "premium"}],
+    [{"text": "📋 Menu Principale", "callback_data": "main_menu"}]
+]})
+START_RETRY_KEYBOARD = renderer.add_keyboard(
+    "start_retry", {"inline_keyboard": [[{"text": "🔄 Riprova", "callback_data": "start_retry"}]]}
+)
 
-Ciao {user.get('first_name', 'utente')}, hai accesso completo a tutte le funzionalità premium!
+def create_main_menu_robust(is_premium=False):
+    """Menu principale pre-serializzato per il tier dell'utente"""
+    return renderer.keyboard("main_menu_premium" if is_premium else "main_menu_free")
+
+renderer.add_template("welcome_premium", """👑 **Benvenuto su TAXAMI PREMIUM!** 
+
+Ciao {name}, hai accesso completo a tutte le funzionalità premium!
 
 💎 **PREMIUM ATTIVO:**
 • Consulenze fiscali illimitate
@@ -542,14 +986,11 @@ Ciao {user.get('first_name', 'utente')}, hai accesso completo a tutte le funzion
 
 Scegli una domanda dal menu o scrivi liberamente!
 
-👇 **SELEZIONA UNA DOMANDA:**"""
-        else:
-            usage_today = check_user_limits_robust(user_id)
-            remaining = max(0, FREE_QUESTIONS_PER_DAY - usage_today)
-            
-            welcome_text = f"""🏛️ **Benvenuto su TAXAMI SMART!** 
+👇 **SELEZIONA UNA DOMANDA:**""")
+
+renderer.add_template("welcome_free", """🏛️ **Benvenuto su TAXAMI SMART!** 
 
-Ciao {user.get('first_name', 'utente')}, sono il tuo assistente fiscale intelligente con database normativo sempre aggiornato!
+Ciao {name}, sono il tuo assistente fiscale intelligente con database normativo sempre aggiornato!
 
 🆓 **VERSIONE GRATUITA:**
 • 7 domande fiscali essenziali  
@@ -561,7 +1002,24 @@ Ciao {user.get('first_name', 'utente')}, sono il tuo assistente fiscale intellig
 
 Scegli una domanda dal menu o scrivi liberamente!
 
-👇 **SELEZIONA UNA DOMANDA:**"""
+👇 **SELEZIONA UNA DOMANDA:**""")
+
+# Handler functions robuste
+def handle_start_robust(chat_id, user):
+    """Gestisce /start in modo robusto"""
+    try:
+        save_lead_robust(user)
+        
+        user_id = user.get('id')
+        is_premium = premium_manager.is_premium_user(user_id) if premium_manager else False
+        
+        name = user.get('first_name', 'utente')
+        if is_premium:
+            welcome_text = renderer.render("welcome_premium", name=name)
+        else:
+            usage_today = check_user_limits_robust(user_id)
+            remaining = max(0, FREE_QUESTIONS_PER_DAY - usage_today)
+            welcome_text = renderer.render("welcome_free", name=name, remaining=remaining)
         
         send_message_robust(chat_id, welcome_text, create_main_menu_robust(is_premium))
         
@@ -570,9 +1028,47 @@ Scegli una domanda dal menu o scrivi liberamente!
         send_message_robust(
             chat_id, 
             "🏛️ **Benvenuto su TAXAMI!**\n\nSto avendo un piccolo problema tecnico. Riprova tra qualche secondo!",
-            {"inline_keyboard": [[{"text": "🔄 Riprova", "callback_data": "start_retry"}]]}
+            START_RETRY_KEYBOARD
         )
 
+UPSELL_KEYBOARD = MAIN_MENU_KEYBOARD
+UPSELL_TEXT = """💎 **FUNZIONALITÀ PREMIUM RICHIESTA**
+
+Questa domanda è disponibile solo nella versione Premium.
+
+🚀 **TAXAMI PREMIUM - €9.99/mese:**
+• Consulenze fiscali illimitate
+• 8 domande specialistiche avanzate
+• Database normativo completo
+
+👇 **ATTIVA SUBITO:**
+"""
+UPSELL_LINK_PENDING = "⏳ Sto preparando il link di pagamento..."
+UPSELL_LINK_FAILED = "⚠️ Link di pagamento non disponibile, riprova tra qualche minuto."
+
+def send_premium_upsell(chat_id, user_id):
+    """Invia subito l'upsell premium; il link Stripe viene aggiunto appena pronto"""
+    payment_link = payment_manager.cached_payment_link(user_id)
+    if payment_link:
+        send_message_robust(chat_id, UPSELL_TEXT + f"[💳 PAGA CON STRIPE]({payment_link})", UPSELL_KEYBOARD)
+        return
+    
+    sent = send_message_robust(chat_id, UPSELL_TEXT + UPSELL_LINK_PENDING, UPSELL_KEYBOARD)
+    message_id = sent.get("result", {}).get("message_id") if sent else None
+    
+    def _on_link(future):
+        try:
+            payment_link = future.result()
+            text = UPSELL_TEXT + (f"[💳 PAGA CON STRIPE]({payment_link})" if payment_link else UPSELL_LINK_FAILED)
+            if message_id:
+                edit_message_robust(chat_id, message_id, text, UPSELL_KEYBOARD)
+            else:
+                send_message_robust(chat_id, text, UPSELL_KEYBOARD)
+        except Exception as e:
+            log_error("PAYMENT_LINK", str(e), {"chat_id": chat_id, "user_id": user_id})
+    
+    payment_manager.create_payment_link_async(user_id).add_done_callback(_on_link)
+
 def handle_callback_robust(callback_data, chat_id, message_id, user):
     """Gestisce callback in modo robusto"""
     try:
@@ -601,86 +1097,46 @@ def handle_callback_robust(callback_data, chat_id, message_id, user):
             # Check premium required
             if question_id in DOMANDE_PREMIUM and not is_premium:
                 if payment_manager:
-                    payment_link = payment_manager.create_payment_link(user_id)
-                    upgrade_text = f"""💎 **FUNZIONALITÀ PREMIUM RICHIESTA**
-
-Questa domanda è disponibile solo nella versione Premium.
-
-🚀 **TAXAMI PREMIUM - €9.99/mese:**
-• Consulenze fiscali illimitate
-• 8 domande specialistiche avanzate
-• Database normativo completo
-
-👇 **ATTIVA SUBITO:**
-[💳 PAGA CON STRIPE]({payment_link})"""
+                    send_premium_upsell(chat_id, user_id)
                 else:
-                    upgrade_text = "💎 **FUNZIONALITÀ PREMIUM RICHIESTA**\n\nServizio premium temporaneamente non disponibile."
-                
-                send_message_robust(
-                    chat_id, 
-                    upgrade_text,
-                    {"inline_keyboard": [[{"text": "📋 Menu Principale", "callback_data": "main_menu"}]]}
-                )
-                return
-            
-            # Check limits per utenti free
-            if not is_premium:
-                usage_today = check_user_limits_robust(user_id)
-                if usage_today >= FREE_QUESTIONS_PER_DAY:
                     send_message_robust(
                         chat_id,
-                        f"⏰ **Limite raggiunto!**\n\nHai esaurito le {FREE_QUESTIONS_PER_DAY} domande gratuite oggi.",
-                        {"inline_keyboard": [
-                            [{"text": "💎 Upgrade Premium", "callback_data": "premium"}],
-                            [{"text": "📋 Menu Principale", "callback_data": "main_menu"}]
-                        ]}
+                        "💎 **FUNZIONALITÀ PREMIUM RICHIESTA**\n\nServizio premium temporaneamente non disponibile.",
+                        UPSELL_KEYBOARD
                     )
-                    return
+                return
             
             # Process question
-            all_questions = {**DOMANDE_FREE, **DOMANDE_PREMIUM}
-            question = all_questions.get(question_id)
+            question = ALL_QUESTIONS.get(question_id)
             
             if question:
-                if not is_premium and question_id in DOMANDE_FREE:
-                    increment_user_usage_robust(user_id)
-                
-                # Load knowledge and generate response
-                knowledge = load_fiscal_knowledge_robust()
-                fiscal_context = search_fiscal_content_robust(question['prompt'], knowledge)
-                
-                enhanced_prompt = f"{question['prompt']}\n\nContesto normativo:\n{fiscal_context}" if fiscal_context else question['prompt']
-                
-                ai_response = generate_ai_response_robust(
-                    enhanced_prompt, 
-                    is_premium,
-                    600 if is_premium else 400
-                )
-                
-                # Footer
-                if is_premium:
-                    footer = "\n\n👑 Premium: Domande illimitate attive"
-                else:
-                    remaining = max(0, FREE_QUESTIONS_PER_DAY - check_user_limits_robust(user_id))
-                    footer = f"\n\n🆓 Ti rimangono {remaining} domande gratuite oggi"
-                    if remaining <= 1:
-                        footer += "\n💎 Upgrade Premium per domande illimitate!"
+                # Check e scalo limite per utenti free (atomico)
+                if not is_premium and question_id in DOMANDE_FREE and not try_consume_free_question(user_id):
+                    send_message_robust(
+                        chat_id,
+                        f"⏰ **Limite raggiunto!**\n\nHai esaurito le {FREE_QUESTIONS_PER_DAY} domande gratuite oggi.",
+                        LIMIT_REACHED_KEYBOARD
+                    )
+                    return
                 
-                # Contatti
-                contacts = "\n\n📞 **Studio Di Sabato e Partners**\n🏢 Borgomanero (NO) | ☎️ 0322.340513 | 📱 338.457.2198"
+                # Risposta dalla cache o generata (in streaming) con il contesto precalcolato
+                stream = create_answer_stream(chat_id)
+                ai_response = get_canned_answer(question_id, question, is_premium, stream)
                 
-                final_response = ai_response + footer + contacts
+                # Footer e contatti
+                final_response = render_ai_markdown(ai_response) + build_answer_footer(user_id, is_premium)
                 
-                send_message_robust(
+                deliver_answer(
                     chat_id, 
                     final_response,
-                    {"inline_keyboard": [[{"text": "📋 Menu Domande", "callback_data": "main_menu"}]]}
+                    QUESTIONS_MENU_KEYBOARD,
+                    stream
                 )
             else:
                 send_message_robust(
                     chat_id,
                     "❌ Domanda non trovata. Torna al menu principale.",
-                    {"inline_keyboard": [[{"text": "📋 Menu Principale", "callback_data": "main_menu"}]]}
+                    MAIN_MENU_KEYBOARD
                 )
         
         elif data == "contacts":
@@ -704,7 +1160,7 @@ Partner dello Studio specializzato in innovazione digitale"""
             send_message_robust(
                 chat_id,
                 contacts_text,
-                {"inline_keyboard": [[{"text": "📋 Menu Principale", "callback_data": "main_menu"}]]}
+                MAIN_MENU_KEYBOARD
             )
         
         # Altri callback handlers...
@@ -718,35 +1174,94 @@ Partner dello Studio specializzato in innovazione digitale"""
         send_message_robust(
             chat_id,
             "⚠️ Si è verificato un errore. Riprova dal menu principale.",
-            {"inline_keyboard": [[{"text": "📋 Menu Principale", "callback_data": "main_menu"}]]}
+            MAIN_MENU_KEYBOARD
+        )
+
+def format_error_report(top=5, recent=5):
+    """Riepilogo errori per l'admin: tipi più frequenti e ultimi errori"""
+    lines = [f"🔧 ERRORI ({error_log.total} dall'avvio, {error_log.dropped} non salvati)", ""]
+    aggregates = error_log.top(top)
+    if not aggregates:
+        lines.append("✅ Nessun errore registrato")
+        return "\n".join(lines)
+    
+    lines.append("📊 Più frequenti:")
+    for aggregate in aggregates:
+        lines.append(
+            f"• {aggregate['type']} ×{aggregate['count']} "
+            f"(ultimo {aggregate['last_seen'][11:19]}): {aggregate['message'][:120]}"
         )
+    lines.append("")
+    lines.append("🕒 Ultimi:")
+    for entry in error_log.recent(recent):
+        lines.append(f"• {entry['timestamp'][11:19]} {entry['type']}: {entry['message'][:120]}")
+    return "\n".join(lines)
 
 def handle_text_robust(chat_id, text, user):
     """Gestisce messaggi di testo in modo robusto"""
     try:
+        # Export lead admin (CSV generato in streaming)
+        if text.startswith("/export_leads") and user.get("id") == ADMIN_USER_ID:
+            try:
+                with tempfile.TemporaryFile(mode='w+b') as raw:
+                    stream = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+                    rows = lead_registry.export_csv(stream)
+                    stream.flush()
+                    raw.seek(0)
+                    telegram.send_document(chat_id, f"taxami_leads_{date.today().isoformat()}.csv", raw, f"👥 {rows} lead")
+                    stream.detach()
+            except Exception as e:
+                log_error("EXPORT_LEADS", str(e))
+                send_message_robust(chat_id, f"❌ Export lead fallito: {e}", parse_mode=None)
+            return
+        
+        # Errori recenti admin (dalla memoria, senza leggere il disco)
+        if text.startswith("/errors") and user.get("id") == ADMIN_USER_ID:
+            send_message_robust(chat_id, format_error_report(), parse_mode=None)
+            return
+        
         # Stats admin
         if text.startswith("/stats") and user.get("id") == ADMIN_USER_ID:
             try:
-                leads = safe_file_operation(LEADS_FILE, 'read', [])
+                total_leads = lead_registry.count()
                 premium_stats = premium_manager.get_premium_stats() if premium_manager else {
                     "active_premium_users": 0, "monthly_revenue": 0, "total_users": 0
                 }
                 
-                limits = safe_file_operation(USER_LIMITS_FILE, 'read', {})
-                today = date.today().isoformat()
-                active_users = sum(1 for user_data in limits.values() if today in user_data and user_data[today] > 0)
+                active_users = usage_counters.active_users()
+                menu_cache = response_cache.stats()
+                semantic_stats = semantic_cache.stats().values()
+                semantic_lookups = sum(ns['lookups'] for ns in semantic_stats)
+                semantic_hits = sum(ns['hits'] for ns in semantic_stats)
+                semantic_ratio = semantic_hits / semantic_lookups if semantic_lookups else 0.0
+                send_stats = send_scheduler.stats()
+                ai_flight = ai_requests.stats()
+                workers_line = format_worker_health()
+                ai_costs = cost_optimizer.stats()
+                routing_line = ", ".join(f"{tier} → {model}" for tier, model in sorted(ai_costs['routing'].items())) or "-"
+                budget_line = f" / ${ai_costs['daily_budget']:.2f}" if ai_costs['daily_budget'] else ""
+                breakers_line = " ".join(
+                    f"{name} {'✅' if breaker.state == 'closed' else '⚠️' if breaker.state == 'half_open' else '❌'}"
+                    for name, breaker in circuit_breakers.items()
+                )
                 
                 stats_text = f"""📊 **STATISTICHE TAXAMI BOT**
 
-👥 **Lead totali:** {len(leads)}
+👥 **Lead totali:** {total_leads}
 💎 **Utenti Premium attivi:** {premium_stats['active_premium_users']}
 💰 **Revenue mensile:** €{premium_stats['monthly_revenue']:.2f}
 👤 **Utenti Premium totali:** {premium_stats['total_users']}
 📈 **Utenti attivi oggi:** {active_users}
-🔧 **Errori totali:** {error_count}"""
+🔧 **Errori totali:** {error_count}
+🗂️ **Cache menu:** {menu_cache['hit_ratio']:.0%} hit ({menu_cache['entries']} risposte)
+🧠 **Cache domande simili:** {semantic_ratio:.0%} hit ({semantic_hits}/{semantic_lookups})
+🔗 **Richieste deduplicate:** {ai_flight['deduplicated']} AI, {callback_debouncer.suppressed} tap ripetuti
+📤 **Coda invii Telegram:** {send_stats['queued']} in coda, {send_stats['throttled_429']} rallentati (429)
+🤖 **Spesa AI oggi:** ${ai_costs['spent_today']:.2f}{budget_line} | routing: {routing_line}
+🔌 **Circuiti:** {breakers_line}{workers_line}"""
                     
             except Exception as e:
-                stats_text = f"📊 **STATISTICHE TAXAMI BOT**\n\n❌ Errore: {e}"
+                stats_text = f"📊 **STATISTICHE TAXAMI BOT**\n\n❌ Errore: {escape_markdown(e)}"
             
             send_message_robust(chat_id, stats_text)
             return
@@ -756,9 +1271,7 @@ def handle_text_robust(chat_id, text, user):
         
         # Check limits per free users
         if not is_premium:
-            usage_today = check_user_limits_robust(user_id)
-            
-            if usage_today >= FREE_QUESTIONS_PER_DAY:
+            if not try_consume_free_question(user_id):
                 send_message_robust(
                     chat_id,
                     f"""⏰ **Limite giornaliero raggiunto!**
@@ -766,61 +1279,30 @@ def handle_text_robust(chat_id, text, user):
 Hai esaurito le {FREE_QUESTIONS_PER_DAY} domande gratuite.
 
 💎 **UPGRADE PREMIUM per domande illimitate!**""",
-                    {"inline_keyboard": [
-                        [{"text": "💎 Upgrade Premium", "callback_data": "premium"}],
-                        [{"text": "📋 Menu Principale", "callback_data": "main_menu"}]
-                    ]}
+                    LIMIT_REACHED_KEYBOARD
                 )
                 return
-            
-            increment_user_usage_robust(user_id)
-        
-        # Trova domanda correlata
-        user_words = text.lower().split()
-        best_match = None
-        max_matches = 0
         
-        all_questions = {**DOMANDE_FREE}
-        if is_premium:
-            all_questions.update(DOMANDE_PREMIUM)
-        
-        for q_id, question in all_questions.items():
-            keywords = question["keywords"]
-            matches = sum(1 for keyword in keywords if any(keyword in word for word in user_words))
-            
-            if matches > max_matches:
-                max_matches = matches
-                best_match = q_id
-        
-        # Genera risposta AI
-        knowledge = load_fiscal_knowledge_robust()
-        fiscal_context = search_fiscal_content_robust(text, knowledge)
-        
-        enhanced_prompt = f"Domanda fiscale: {text}\n\nContesto normativo:\n{fiscal_context}" if fiscal_context else f"Domanda fiscale: {text}"
-        
-        ai_response = generate_ai_response_robust(
-            enhanced_prompt,
-            is_premium,
-            600 if is_premium else 400
+        # Domanda del menu riconosciuta con sicurezza: risposta canned (dalla cache), altrimenti AI
+        question_id, confidence = intent_matcher.match(
+            text, None if is_premium else DOMANDE_FREE, INTENT_MIN_SCORE, INTENT_THRESHOLD
         )
-        
-        # Footer e contatti
-        if is_premium:
-            footer = "\n\n👑 Premium: Domande illimitate attive"
+        stream = create_answer_stream(chat_id)
+        if question_id:
+            logger.info(f"Intent {question_id} riconosciuto ({confidence:.2f}) per: {text[:50]}")
+            ai_response = get_canned_answer(question_id, ALL_QUESTIONS[question_id], is_premium, stream)
         else:
-            remaining = max(0, FREE_QUESTIONS_PER_DAY - check_user_limits_robust(user_id))
-            footer = f"\n\n🆓 Ti rimangono {remaining} domande gratuite oggi"
-            if remaining <= 1:
-                footer += "\n💎 Upgrade Premium per domande illimitate!"
+            # Risposta AI in streaming (o risposta a una domanda simile già data)
+            ai_response = get_free_text_answer(text, is_premium, stream)
         
-        contacts = "\n\n📞 **Studio Di Sabato e Partners**\n🏢 Borgomanero (NO) | ☎️ 0322.340513 | 📱 338.457.2198"
-        
-        final_response = ai_response + footer + contacts
+        # Footer e contatti
+        final_response = render_ai_markdown(ai_response) + build_answer_footer(user_id, is_premium)
         
-        send_message_robust(
+        deliver_answer(
             chat_id,
             final_response,
-            {"inline_keyboard": [[{"text": "📋 Menu Domande", "callback_data": "main_menu"}]]}
+            QUESTIONS_MENU_KEYBOARD,
+            stream
         )
         
     except Exception as e:
@@ -828,19 +1310,160 @@ Hai esaurito le {FREE_QUESTIONS_PER_DAY} domande gratuite.
         send_message_robust(
             chat_id,
             "⚠️ Si è verificato un errore nell'elaborazione. Riprova o contatta il supporto.",
-            {"inline_keyboard": [[{"text": "📋 Menu Principale", "callback_data": "main_menu"}]]}
+            MAIN_MENU_KEYBOARD
         )
 
-# Main loop super robusta
-def main_loop():
-    """Loop principale con gestione crash avanzata"""
-    logger.info("🚀 Taxami Bot Premium Robust - Avvio...")
+# Dispatch degli update
+def get_update_chat_id(update):
+    """Estrae il chat_id usato per serializzare gli update della stessa chat"""
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return None
+
+def get_update_handler(update):
+    """Nome dell'handler che gestirà l'update (etichetta delle metriche)"""
+    if "message" in update:
+        return "start" if update["message"].get("text") == "/start" else "text"
+    if "callback_query" in update:
+        return "callback"
+    return "other"
+
+def process_update(update):
+    """Instrada un singolo update Telegram all'handler corretto"""
+    _request_state.failed = False
+    start = time.perf_counter()
+    handler = "other"
+    try:
+        handler = get_update_handler(update)
+        
+        # Messaggio testo
+        if "message" in update:
+            message = update["message"]
+            chat_id = message["chat"]["id"]
+            user = message["from"]
+            
+            if message.get("text"):
+                if message["text"] == "/start":
+                    handle_start_robust(chat_id, user)
+                else:
+                    handle_text_robust(chat_id, message["text"], user)
+        
+        # Callback query
+        elif "callback_query" in update:
+            callback = update["callback_query"]
+            chat_id = callback["message"]["chat"]["id"]
+            message_id = callback["message"]["message_id"]
+            user = callback["from"]
+            
+            handle_callback_robust(callback, chat_id, message_id, user)
+    
+    except Exception as e:
+        log_error("UPDATE_PROCESSING", str(e), {"update": update})
+        logger.error(f"Errore processamento update: {e}")
+    
+    finally:
+        # Gli handler gestiscono le proprie eccezioni: l'esito è "error" se hanno loggato errori
+        metrics.observe("update_seconds", time.perf_counter() - start, handler=handler)
+        metrics.inc("updates_total", handler=handler, outcome="error" if _request_state.failed else "ok")
+
+def dispatch_update(dispatcher, update):
+    """Accoda l'update sul dispatcher mantenendo l'ordine per chat"""
+    try:
+        chat_id = get_update_chat_id(update)
+    except (KeyError, TypeError) as e:
+        log_error("UPDATE_PROCESSING", str(e), {"update": update})
+        return
+    
+    if chat_id is None:
+        return
+    
+    # Doppio tap: l'update ripetuto non entra in coda, basta togliere lo spinner al bottone
+    callback = update.get("callback_query")
+    if callback and not callback_debouncer.allow((chat_id, callback.get("data"))):
+        send_scheduler.submit(None, PRIORITY_CALLBACK, telegram_client.answer_callback_query, callback["id"])
+        return
+    
+    dispatcher.submit(chat_id, process_update, update)
+
+# Metriche
+def register_metrics():
+    """Gauge letti al momento dello scrape: cache, code, circuiti, stato in memoria"""
+    def _semantic_ratio():
+        stats = semantic_cache.stats().values()
+        lookups = sum(ns['lookups'] for ns in stats)
+        return sum(ns['hits'] for ns in stats) / lookups if lookups else 0.0
+    
+    def _breaker_stats(field):
+        return lambda: [({"dependency": name}, breaker.stats()[field]) for name, breaker in circuit_breakers.items()]
+    
+    def _breaker_transitions():
+        return [
+            ({"dependency": name, "transition": transition}, count)
+            for name, breaker in circuit_breakers.items()
+            for transition, count in breaker.stats()["transitions"].items()
+        ]
+    
+    metrics.gauge("response_cache_hit_ratio", lambda: response_cache.stats()["hit_ratio"], "Hit ratio cache risposte menu")
+    metrics.gauge("response_cache_entries", lambda: response_cache.stats()["entries"])
+    metrics.gauge("semantic_cache_hit_ratio", _semantic_ratio, "Hit ratio cache domande simili")
+    metrics.gauge("send_queue_depth", lambda: [({"lane": lane}, depth) for lane, depth in send_scheduler.stats()["queue_depth"].items()],
+                  "Invii Telegram in coda per lane")
+    metrics.gauge("send_in_flight", lambda: send_scheduler.stats()["in_flight"])
+    metrics.gauge("send_throttled_429", lambda: send_scheduler.stats()["throttled_429"])
+    metrics.gauge("circuit_breaker_state", _breaker_stats("state_code"), "0=closed 1=half_open 2=open")
+    metrics.gauge("circuit_breaker_rejected", _breaker_stats("rejected"))
+    metrics.gauge("circuit_breaker_transitions", _breaker_transitions, "Cambi di stato dei circuit breaker")
+    metrics.gauge("error_log_pending", error_log.pending)
+    metrics.gauge("openai_latency_p95_seconds", lambda: [
+        ({"model": model}, stats["p95"]) for model, stats in cost_optimizer.stats()["models"].items()
+        if stats["p95"] is not None
+    ], "p95 latenza OpenAI sulle ultime chiamate (usato dal routing)")
+    metrics.gauge("intent_matches", lambda: [
+        ({"outcome": "canned"}, intent_matcher.matched), ({"outcome": "ai"}, intent_matcher.unmatched)
+    ], "Messaggi di testo risolti con una domanda del menu o inviati all'AI")
+    metrics.gauge("openai_spend_today_usd", cost_optimizer.spent_today, "Spesa OpenAI stimata del giorno")
+    metrics.gauge("leads", lead_registry.count)
+    metrics.gauge("premium_active_users", lambda: premium_manager.get_premium_stats()["active_premium_users"])
+
+register_metrics()
+
+def start_metrics_server(port=METRICS_PORT):
+    """Espone /metrics su una porta dedicata (disattivato con TAXAMI_METRICS_PORT=0)"""
+    if not port:
+        return
+    try:
+        metrics.start(METRICS_HOST, port)
+    except OSError as e:
+        logger.error(f"❌ Server metriche non avviato sulla porta {port}: {e}")
+
+# Avvio
+def startup_checks():
+    """Import dati legacy e health check di knowledge base, Stripe e OpenAI"""
+    # Import una tantum dei vecchi file JSON nello state store
+    try:
+        if state_store.import_legacy_json(
+            leads_file=LEADS_FILE,
+            limits_file=USER_LIMITS_FILE,
+            errors_file=ERROR_LOG_FILE,
+            analytics_file=ANALYTICS_FILE,
+            premium_file=PREMIUM_USERS_FILE
+        ):
+            premium_manager.reload()
+            lead_registry.load()
+            usage_counters.load()
+            logger.info(f"✅ Dati JSON importati in {state_store.path}")
+    except Exception as e:
+        logger.error(f"❌ Errore import dati JSON: {e}")
     
     # Health checks
     try:
+        fiscal_kb.refresh(force=True)
         knowledge = load_fiscal_knowledge_robust()
         if knowledge:
-            logger.info(f"✅ Database fiscale caricato: {len(knowledge)} sezioni")
+            index = get_fiscal_index()
+            logger.info(f"✅ Database fiscale caricato: {len(knowledge)} sezioni, {len(index)} articoli indicizzati")
         else:
             logger.warning("⚠️ Database fiscale non trovato - funziona solo con AI base")
     except Exception as e:
@@ -848,6 +1471,8 @@ def main_loop():
     
     # Test Stripe
     try:
+        if payment_manager.warm_up():
+            logger.info("✅ Prezzo Stripe premium risolto")
         if premium_manager:
             premium_stats = premium_manager.get_premium_stats()
             logger.info(f"✅ Stripe connesso: {premium_stats['active_premium_users']} utenti premium attivi")
@@ -861,12 +1486,190 @@ def main_loop():
         logger.info("✅ OpenAI client inizializzato")
     else:
         logger.error("❌ OpenAI client fallito")
+
+def shutdown_services():
+    """Scrive lo stato in memoria sullo store e ferma i thread di servizio"""
+    try:
+        usage_counters.stop()
+    except Exception as e:
+        logger.error(f"Errore flush contatori: {e}")
+    lead_registry.stop()
+    error_log.stop()
+    payment_manager.shutdown(wait=True)
+    openai_hedger.shutdown(wait=False)
+    send_scheduler.shutdown(wait=True)
+    metrics.stop()
+
+def shutdown(dispatcher):
+    """Arresto pulito: completa gli update in coda, poi ferma i servizi"""
+    dispatcher.shutdown(wait=True)
+    shutdown_services()
+
+# Worker mode (multi-processo)
+def configure_worker(worker_id, workers):
+    """Inizializzazione di un processo worker (chiamata dal WorkerPool)"""
+    # Lo stato è condiviso con gli altri worker tramite lo store
+    lead_registry.shared = True
+    usage_counters.shared = True
+    # Il limite globale di Telegram vale per il bot, non per processo
+    send_scheduler.global_bucket.rate = TELEGRAM_GLOBAL_RATE / workers
+    send_scheduler.global_bucket.capacity = max(1.0, TELEGRAM_GLOBAL_RATE / workers)
+    fiscal_kb.refresh(force=True)
+    get_fiscal_index()
+    # Ogni worker espone le proprie metriche sulla porta successiva a quella principale
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + 1 + worker_id)
+    logger.info(f"✅ Worker {worker_id}/{workers} pronto (pid {os.getpid()})")
+
+def worker_periodic():
+    """Eseguita a ogni heartbeat: allinea gli utenti premium modificati da altri processi"""
+    if premium_manager.refresh_if_changed():
+        logger.info("🔄 Utenti premium ricaricati")
+
+def record_worker_health(report):
+    """Pubblica l'heartbeat nello store, leggibile da /stats in qualsiasi worker"""
+    state_store.set_meta(f"worker_health:{report['worker']}", json.dumps(report))
+    if report["state"] == "stopped":
+        logger.info(f"🛑 Worker {report['worker']} fermato ({report['processed']} update)")
+
+def format_worker_health():
+    """Riga /stats con lo stato dei worker (vuota in modalità singolo processo)"""
+    if not WORKER_PROCESSES:
+        return ""
+    now = time.time()
+    parts = []
+    for worker_id in range(WORKER_PROCESSES):
+        raw = state_store.get_meta(f"worker_health:{worker_id}")
+        report = json.loads(raw) if raw else {}
+        stale = now - report.get("timestamp", 0) > 3 * WORKER_HEARTBEAT_INTERVAL
+        parts.append(f"{worker_id}:{'❌' if stale else '✅'}{report.get('processed', 0)}")
+    return f"\n⚙️ **Worker:** {' '.join(parts)}"
+
+def create_dispatcher(workers=WORKER_PROCESSES):
+    """UpdateDispatcher nel processo o, con ``workers`` > 0, pool di processi sharded per chat"""
+    if workers <= 0:
+        dispatcher = UpdateDispatcher(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES)
+        metrics.gauge("dispatcher_pending", dispatcher.pending, "Update accodati o in esecuzione")
+        return dispatcher
+    pool = WorkerPool(
+        workers,
+        initializer=configure_worker,
+        periodic=worker_periodic,
+        finalizer=shutdown_services,
+        max_concurrency=MAX_CONCURRENT_UPDATES,
+        max_pending=MAX_PENDING_UPDATES,
+        heartbeat_interval=WORKER_HEARTBEAT_INTERVAL,
+        on_report=record_worker_health
+    )
+    pool.start()
+    metrics.gauge("dispatcher_pending", pool.pending, "Update accodati o in esecuzione")
+    metrics.gauge("workers_alive", lambda: sum(1 for report in pool.health() if report["alive"]))
+    return pool
+
+# Webhook mode
+def handle_telegram_webhook(dispatcher, body, headers, secret):
+    """Riceve un update Telegram via webhook e lo accoda sul dispatcher"""
+    # Senza secret chiunque potrebbe fingersi l'admin (/export_leads): nessun update accettato
+    token = headers.get("x-telegram-bot-api-secret-token") or ""
+    if not secret or not hmac.compare_digest(token.encode(), secret.encode()):
+        return 401, {"ok": False}
+    try:
+        update = json.loads(body)
+    except ValueError:
+        return 400, {"ok": False}
+    dispatch_update(dispatcher, update)
+    return 200, {"ok": True}
+
+def handle_stripe_webhook(dispatcher, body, headers):
+    """Verifica un evento Stripe e lo applica in background"""
+    if not payment_manager:
+        return 404, {"ok": False}
+    event = payment_manager.verify_webhook(body, headers.get("stripe-signature"))
+    if event is None:
+        return 400, {"ok": False}
+    # Eventi Stripe serializzati su una coda dedicata del dispatcher
+    dispatcher.submit("stripe", payment_manager.process_event, event)
+    return 200, {"received": True}
+
+def create_webhook_server(dispatcher, secret, host="0.0.0.0", port=8080, stripe_dispatcher=None):
+    """Server HTTP con le route dei webhook Telegram e Stripe.
+
+    Le metriche non sono esposte qui: restano sulla porta interna di
+    ``start_metrics_server``.
+    """
+    stripe_dispatcher = stripe_dispatcher or dispatcher
+    server = WebhookServer(host, port)
+    server.add_route(TELEGRAM_WEBHOOK_PATH, lambda body, headers: handle_telegram_webhook(dispatcher, body, headers, secret))
+    # Senza secret la firma degli eventi non è verificabile: la route Stripe non viene esposta
+    if STRIPE_WEBHOOK_SECRET:
+        server.add_route(STRIPE_WEBHOOK_PATH, lambda body, headers: handle_stripe_webhook(stripe_dispatcher, body, headers))
+    else:
+        logger.warning(f"⚠️ STRIPE_WEBHOOK_SECRET non configurato: route {STRIPE_WEBHOOK_PATH} disattivata")
+    return server
+
+def run_webhook_server(host="0.0.0.0", port=8080, public_url=None, workers=WORKER_PROCESSES):
+    """Avvia il bot in webhook mode (alternativa a main_loop)"""
+    logger.info("🚀 Taxami Bot Premium Webhook - Avvio...")
+    secret = TELEGRAM_WEBHOOK_SECRET
+    if not secret:
+        if not public_url:
+            # Webhook registrato altrove: senza secret non si possono autenticare gli update
+            logger.error("❌ TAXAMI_WEBHOOK_SECRET non configurato: webhook mode non avviato")
+            return
+        # Token casuale valido per questo avvio, registrato con setWebhook
+        secret = secrets.token_urlsafe(32)
+        logger.warning("⚠️ TAXAMI_WEBHOOK_SECRET non configurato: generato un secret casuale per setWebhook")
+    startup_checks()
+    start_metrics_server()
+    
+    dispatcher = create_dispatcher(workers)
+    # Con i worker gli eventi Stripe restano in questo processo: i worker vedono
+    # le modifiche tramite la revisione premium nello store
+    stripe_dispatcher = UpdateDispatcher(1, MAX_PENDING_UPDATES) if workers > 0 else None
+    server = create_webhook_server(dispatcher, secret, host, port, stripe_dispatcher)
+    
+    def _on_shutdown():
+        if stripe_dispatcher:
+            stripe_dispatcher.shutdown(wait=True)
+        shutdown(dispatcher)
+    
+    if public_url:
+        try:
+            telegram.set_webhook(public_url.rstrip('/') + TELEGRAM_WEBHOOK_PATH, secret)
+            logger.info(f"✅ Webhook Telegram registrato su {public_url}")
+        except Exception as e:
+            logger.error(f"❌ Registrazione webhook fallita: {e}")
+            if secret != TELEGRAM_WEBHOOK_SECRET:
+                # Telegram non conosce il secret generato: nessun update verrebbe accettato
+                _on_shutdown()
+                return
+    
+    logger.info(f"✅ Taxami Bot Premium Webhook AVVIATO su {host}:{port}")
+    server.serve_forever(on_shutdown=_on_shutdown)
+    logger.info("🛑 Webhook server fermato.")
+
+# Main loop super robusta
+def main_loop(workers=WORKER_PROCESSES):
+    """Loop principale con gestione crash avanzata"""
+    logger.info("🚀 Taxami Bot Premium Robust - Avvio...")
+    startup_checks()
+    start_metrics_server()
+    
+    # getUpdates non funziona con un webhook attivo
+    try:
+        telegram.delete_webhook()
+    except Exception as e:
+        logger.warning(f"⚠️ deleteWebhook fallito: {e}")
     
     offset = None
     consecutive_errors = 0
     max_consecutive_errors = 5
+    dispatcher = create_dispatcher(workers)
     
-    logger.info("✅ Taxami Bot Premium Robust AVVIATO! Premi Ctrl+C per fermare.")
+    logger.info(
+        f"✅ Taxami Bot Premium Robust AVVIATO ({max(workers, 1)} processi × {MAX_CONCURRENT_UPDATES} worker)! "
+        "Premi Ctrl+C per fermare."
+    )
     
     while True:
         try:
@@ -880,38 +1683,12 @@ def main_loop():
             consecutive_errors = 0
             
             for update in updates.get("result", []):
-                try:
-                    offset = update["update_id"] + 1
-                    
-                    # Messaggio testo
-                    if "message" in update:
-                        message = update["message"]
-                        chat_id = message["chat"]["id"]
-                        user = message["from"]
-                        
-                        if message.get("text"):
-                            if message["text"] == "/start":
-                                handle_start_robust(chat_id, user)
-                            else:
-                                handle_text_robust(chat_id, message["text"], user)
-                    
-                    # Callback query
-                    elif "callback_query" in update:
-                        callback = update["callback_query"]
-                        chat_id = callback["message"]["chat"]["id"]
-                        message_id = callback["message"]["message_id"]
-                        user = callback["from"]
-                        
-                        handle_callback_robust(callback, chat_id, message_id, user)
-                
-                except Exception as e:
-                    log_error("UPDATE_PROCESSING", str(e), {"update": update})
-                    logger.error(f"Errore processamento update: {e}")
-                    # Continua con prossimo update invece di crashare
-                    continue
+                offset = update["update_id"] + 1
+                dispatch_update(dispatcher, update)
                     
         except KeyboardInterrupt:
             logger.info("🛑 Bot fermato dall'utente.")
+            shutdown(dispatcher)
             break
             
         except Exception as e:
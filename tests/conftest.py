@@ -0,0 +1,14 @@
+"""
+Configurazione comune dei test: store e metriche isolati dall'ambiente
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Prima di importare i moduli che creano lo store condiviso all'import (premium_system)
+os.environ.setdefault("TAXAMI_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="taxami-tests-"), "state.db"))
+os.environ.setdefault("TAXAMI_METRICS_PORT", "0")
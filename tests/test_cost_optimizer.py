@@ -0,0 +1,40 @@
+from datetime import date
+
+import pytest
+
+from services.cost_optimizer import CostOptimizer
+from services.state_store import StateStore
+
+@pytest.fixture
+def store(tmp_path):
+    store = StateStore(str(tmp_path / "cost.db"))
+    yield store
+    store.close()
+
+def test_spend_is_shared_between_processes(store):
+    first = CostOptimizer(daily_budget=1.0, store=store)
+    second = CostOptimizer(daily_budget=1.0, store=store)
+    first.record("gpt-4", 1.0, prompt_tokens=10000, completion_tokens=0)  # 0.30 USD
+    second.record("gpt-4", 1.0, prompt_tokens=10000, completion_tokens=0)
+
+    assert second.spent_today() == pytest.approx(0.6)
+    assert store.get_openai_spend(date.today().isoformat()) == pytest.approx(0.6)
+
+def test_budget_survives_a_restart(store):
+    CostOptimizer(daily_budget=0.5, store=store).record("gpt-4", 1.0, prompt_tokens=20000)  # 0.60 USD
+    restarted = CostOptimizer(daily_budget=0.5, store=store)
+
+    assert restarted.choose_models("premium") == ("gpt-3.5-turbo", "gpt-3.5-turbo")
+
+def test_under_budget_keeps_the_preferred_model(store):
+    optimizer = CostOptimizer(daily_budget=5.0, store=store)
+    optimizer.record("gpt-4", 1.0, prompt_tokens=1000, completion_tokens=1000)
+
+    assert optimizer.choose_models("premium") == ("gpt-4", "gpt-3.5-turbo")
+    assert optimizer.stats()["spent_today"] == pytest.approx(0.09)
+
+def test_without_store_spend_is_per_process():
+    optimizer = CostOptimizer(daily_budget=1.0)
+    optimizer.record("gpt-3.5-turbo", 1.0, prompt_tokens=2000, completion_tokens=2000)
+
+    assert optimizer.spent_today() == pytest.approx(0.004)
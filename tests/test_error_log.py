@@ -0,0 +1,54 @@
+import pytest
+
+from services.error_log import ErrorLog
+
+class FlakyStore:
+    """Store in memoria che fallisce le prime ``failures`` scritture del metodo indicato"""
+
+    def __init__(self, fail_on="add_errors", failures=1):
+        self.fail_on = fail_on
+        self.failures = failures
+        self.errors = []
+        self.aggregates = {}
+
+    def _maybe_fail(self, method):
+        if method == self.fail_on and self.failures:
+            self.failures -= 1
+            raise OSError("database is locked")
+
+    def add_errors(self, entries, keep_last=100):
+        self._maybe_fail("add_errors")
+        self.errors.extend(entries)
+
+    def upsert_error_aggregates(self, rows):
+        self._maybe_fail("upsert_error_aggregates")
+        for error_type, fp, _, delta, _, _ in rows:
+            self.aggregates[(error_type, fp)] = self.aggregates.get((error_type, fp), 0) + delta
+
+@pytest.mark.parametrize("fail_on", ["add_errors", "upsert_error_aggregates"])
+def test_failed_flush_is_retried(fail_on):
+    store = FlakyStore(fail_on)
+    log = ErrorLog(store)
+    log.record("API", "timeout 1")
+    log.record("API", "timeout 2")
+
+    log.flush()
+    log.record("API", "timeout 3")
+    log.flush()
+
+    assert [entry["message"] for entry in store.errors] == ["timeout 1", "timeout 2", "timeout 3"]
+    assert sum(store.aggregates.values()) == 3
+    assert log.pending() == 0
+
+def test_requeue_respects_max_pending():
+    store = FlakyStore()
+    log = ErrorLog(store, max_pending=3)
+    for i in range(3):
+        log.record("API", f"errore {i}")
+    log.flush()
+    log.record("API", "errore 3")
+
+    assert log.pending() == 3
+    assert log.dropped == 1
+    log.flush()
+    assert [entry["message"] for entry in store.errors] == ["errore 1", "errore 2", "errore 3"]
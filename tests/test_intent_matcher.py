@@ -0,0 +1,55 @@
+import pytest
+
+from services.intent_matcher import IntentMatcher
+
+# Sottoinsieme delle domande del bot (ALL_QUESTIONS) con le stesse keyword
+INTENTS = {
+    "1": ["aprire", "partita", "iva", "nuova", "iniziare", "attivare"],
+    "2": ["forfettario", "ordinario", "regime", "conviene", "confronto"],
+    "4": ["srl", "ditta", "individuale", "società", "responsabilità", "limitata"],
+    "6": ["snc", "sas", "società", "persone", "accomandita", "collettiva"],
+    "102": ["controlli", "verifiche", "guardia di finanza", "accertamento", "difesa"],
+    "103": ["fusioni", "acquisizioni", "ma", "operazioni", "straordinarie", "conferimenti"],
+    "106": ["due", "diligence", "fiscale", "acquisizioni", "rischi", "analisi"],
+}
+GENERIC = ("partita", "iva", "fiscale", "società", "nuova", "due", "analisi", "rischi")
+EXCLUDE = {"1": ["chiud", "chius", "cess"], "4": ["sciogl", "sciolt", "liquidaz"], "6": ["sciogl", "sciolt", "liquidaz"]}
+
+@pytest.fixture(scope="module")
+def matcher():
+    return IntentMatcher(INTENTS, generic=GENERIC, exclude=EXCLUDE)
+
+@pytest.mark.parametrize("text, expected", [
+    ("Come aprire la partita IVA?", "1"),
+    ("Mi conviene il regime forfettario o l'ordinario?", "2"),
+    ("Ho un accertamento, come preparo la difesa?", "102"),
+    ("Due diligence fiscale per acquisizioni", "106"),
+])
+def test_routes_to_question(matcher, text, expected):
+    assert matcher.match(text)[0] == expected
+
+@pytest.mark.parametrize("text", [
+    "Voglio chiudere la partita IVA",
+    "Come si scioglie una società?",
+    "Come sciogliere una srl",
+])
+def test_exclusions_block_the_question(matcher, text):
+    assert matcher.match(text)[0] is None
+
+def test_generic_keywords_alone_are_not_enough(matcher):
+    intent_id, confidence = matcher.match("partita iva")
+    assert intent_id is None
+    assert confidence == 1.0
+
+def test_stopword_keywords_are_ignored(matcher):
+    # "ma" (fusioni e acquisizioni) non deve scattare su una congiunzione
+    assert matcher.scores("ma quando") == {}
+
+def test_allowed_limits_the_candidates(matcher):
+    assert matcher.match("Come aprire la partita IVA?", allowed={"2"})[0] is None
+
+def test_match_counters(matcher):
+    local = IntentMatcher(INTENTS, generic=GENERIC, exclude=EXCLUDE)
+    local.match("Come aprire la partita IVA?")
+    local.match("buongiorno")
+    assert (local.matched, local.unmatched) == (1, 1)
@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+
+from services.knowledge_base import FiscalKnowledgeBase
+
+def write(path, content):
+    path.write_text(content, encoding="utf-8")
+    # mtime distinto anche su filesystem a bassa risoluzione
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+@pytest.fixture
+def kb_dir(tmp_path):
+    write(tmp_path / "iva.json", json.dumps([{"titolo": "IVA"}]))
+    return tmp_path
+
+def test_loads_sections(kb_dir):
+    kb = FiscalKnowledgeBase(str(kb_dir), check_interval=0)
+    assert kb.refresh(force=True)
+    assert kb.get_knowledge() == {"iva": [{"titolo": "IVA"}]}
+
+def test_failed_read_keeps_the_section_and_is_retried(kb_dir):
+    kb = FiscalKnowledgeBase(str(kb_dir), check_interval=0)
+    kb.refresh(force=True)
+    version = kb.version
+
+    write(kb_dir / "iva.json", '[{"titolo": "IVA 2"}')  # file a metà scrittura
+    assert not kb.refresh(force=True)
+    assert kb.get_knowledge() == {"iva": [{"titolo": "IVA"}]}
+    assert kb.version == version
+
+    # Completato con stessa dimensione e mtime: la firma non cambia ma viene riletto
+    path = kb_dir / "iva.json"
+    stat = path.stat()
+    path.write_text('[{"titolo": "IVA2"}]', encoding="utf-8")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert kb.refresh(force=True)
+    assert kb.get_knowledge() == {"iva": [{"titolo": "IVA2"}]}
+
+def test_new_file_that_fails_is_retried(kb_dir):
+    kb = FiscalKnowledgeBase(str(kb_dir), check_interval=0)
+    kb.refresh(force=True)
+
+    write(kb_dir / "irpef.json", '[{"titolo": "IRPEF"}')
+    kb.refresh(force=True)
+    assert "irpef" not in kb.get_knowledge()
+
+    path = kb_dir / "irpef.json"
+    stat = path.stat()
+    path.write_text('[{"titolo":"IRPEF"}]', encoding="utf-8")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert kb.refresh(force=True)
+    assert kb.get_knowledge()["irpef"] == [{"titolo": "IRPEF"}]
+
+def test_removed_file_drops_the_section(kb_dir):
+    kb = FiscalKnowledgeBase(str(kb_dir), check_interval=0)
+    kb.refresh(force=True)
+    (kb_dir / "iva.json").unlink()
+    assert kb.refresh(force=True)
+    assert kb.get_knowledge() == {}
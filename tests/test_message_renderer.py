@@ -0,0 +1,64 @@
+import pytest
+
+from services.message_renderer import MessageRenderer, escape_markdown, is_valid_markdown, sanitize_markdown
+
+@pytest.mark.parametrize("text", [
+    "*grassetto",
+    "testo con _corsivo aperto",
+    "`codice senza chiusura",
+    "```\nblocco non chiuso",
+    "[link rotto(https://taxami.it)",
+    "a*b_c`d[e",
+])
+def test_unclosed_markers_are_escaped(text):
+    sanitized = sanitize_markdown(text)
+    assert not is_valid_markdown(text)
+    assert is_valid_markdown(sanitized)
+    assert sanitized.replace("\\", "") == text
+
+@pytest.mark.parametrize("text", [
+    "*grassetto* e _corsivo_",
+    "[sito](https://taxami.it/a_b)",
+    "```\ncodice * _\n```",
+    "testo semplice",
+])
+def test_valid_markdown_is_unchanged(text):
+    assert is_valid_markdown(text)
+    assert sanitize_markdown(text) == text
+
+def test_sanitize_is_idempotent():
+    text = "*aperto _e [non chiuso ` https://x.it/a_b"
+    once = sanitize_markdown(text)
+    assert sanitize_markdown(once) == once
+
+def test_underscores_in_urls_do_not_open_entities():
+    sanitized = sanitize_markdown("Vedi https://agenziaentrate.gov.it/regime_forfettario oggi")
+    assert "regime\\_forfettario" in sanitized
+    assert is_valid_markdown(sanitized)
+
+def test_sanitize_drops_a_marker_cut_at_the_limit():
+    # Troncato resterebbe "*" aperto: l'escape porterebbe il testo a 4097 caratteri
+    assert sanitize_markdown("a" * 4095 + "*chiuso*") == "a" * 4095
+
+@pytest.mark.parametrize("text", [
+    "[" * 4096,
+    "testo_" * 682 + "fine",
+    ("a" * 10 + "*") * 372 + "b" * 4,
+])
+def test_sanitize_never_exceeds_the_limit(text):
+    assert len(text) == 4096
+    sanitized = sanitize_markdown(text)
+    assert len(sanitized) <= 4096
+    assert is_valid_markdown(sanitized)
+    assert len(sanitized) > 2000
+
+def test_escape_markdown_makes_user_text_literal():
+    assert escape_markdown("mario_rossi*") == "mario\\_rossi\\*"
+    assert is_valid_markdown("Ciao *" + escape_markdown("_[utente") + "*")
+
+def test_template_rejects_invalid_markdown():
+    renderer = MessageRenderer()
+    renderer.add_template("ok", "Ciao *{nome}*")
+    assert renderer.render("ok", nome="a_b") == "Ciao *a\\_b*"
+    with pytest.raises(ValueError):
+        renderer.add_template("rotto", "Ciao *{nome}")
@@ -0,0 +1,78 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from premium_system import PremiumManager
+from services.state_store import StateStore
+
+def make_users(count, start_id=100000):
+    """{user_id: dati} attivi nel formato di PremiumManager"""
+    expires = (datetime.now() + timedelta(days=30)).isoformat()
+    return {
+        str(user_id): {
+            "user_id": user_id,
+            "subscription_id": f"sub_{user_id}",
+            "activated_at": datetime.now().isoformat(),
+            "expires_at": expires,
+            "status": "active",
+        }
+        for user_id in range(start_id, start_id + count)
+    }
+
+@pytest.fixture
+def store(tmp_path):
+    store = StateStore(str(tmp_path / "premium.db"))
+    yield store
+    store.close()
+
+def test_active_users_are_premium(store):
+    users = make_users(20)
+    store.save_premium_users(users)
+    manager = PremiumManager(store)
+
+    assert all(manager.is_premium_user(user_id) for user_id in users)
+    assert manager.find_user_by_subscription("sub_100000") == 100000
+    assert manager.get_premium_stats()["active_premium_users"] == 20
+
+def test_cancelled_user_keeps_access_until_expiry(store):
+    manager = PremiumManager(store)
+    manager.add_premium_user(1, "sub_1")
+    manager.remove_premium_user(1)
+
+    assert manager.is_premium_user(1)
+    assert manager.get_premium_stats()["active_premium_users"] == 0
+
+def test_reload_never_exposes_partial_indexes(store):
+    users = make_users(2000)
+    store.save_premium_users(users)
+    manager = PremiumManager(store)
+    stop = threading.Event()
+    misses = []
+
+    def reader():
+        while not stop.is_set():
+            misses.extend(user_id for user_id in ("100000", "101999") if not manager.is_premium_user(user_id))
+            if manager.find_user_by_subscription("sub_101999") != 101999:
+                misses.append("sub_101999")
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        for _ in range(10):
+            manager.reload()
+    finally:
+        stop.set()
+        thread.join()
+
+    assert misses == []
+
+def test_refresh_picks_up_changes_from_another_process(store):
+    manager = PremiumManager(store)
+    other = PremiumManager(store)
+    other.add_premium_user(5, "sub_5")
+
+    assert not manager.is_premium_user(5)
+    assert manager.refresh_if_changed()
+    assert manager.is_premium_user(5)
+    assert not manager.refresh_if_changed()
@@ -0,0 +1,36 @@
+import pytest
+
+from services.semantic_cache import SemanticCache, normalize
+
+QUESTION = "Come posso dedurre le spese dell'auto aziendale?"
+LIMIT_QUESTION = "Qual è il limite di 85.000 euro per il forfettario?"
+
+@pytest.fixture
+def cache():
+    cache = SemanticCache()
+    cache.add("free", QUESTION, "risposta auto")
+    cache.add("free", LIMIT_QUESTION, "risposta limite")
+    return cache
+
+def test_paraphrase_hits(cache):
+    answer, similarity = cache.lookup("free", "Come posso dedurre le spese per l'auto aziendale?")
+    assert answer == "risposta auto"
+    assert similarity >= cache.threshold
+
+def test_negation_misses_even_with_same_terms(cache):
+    answer, similarity = cache.lookup("free", "Non posso dedurre le spese dell'auto aziendale?")
+    assert answer is None
+    assert similarity >= cache.threshold
+
+def test_different_number_misses(cache):
+    assert cache.lookup("free", "Qual è il limite di 65.000 euro per il forfettario?")[0] is None
+
+def test_number_formatting_is_ignored(cache):
+    assert cache.lookup("free", "Qual è il limite di 85000 euro per il forfettario?")[0] == "risposta limite"
+
+def test_namespaces_are_separate(cache):
+    assert cache.lookup("premium", QUESTION)[0] is None
+
+def test_normalize_guard():
+    assert normalize("limite di 85.000 euro")[1] == (frozenset({"85000"}), False)
+    assert normalize("non conviene")[1] == (frozenset(), True)
@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+
+from services.send_scheduler import PRIORITY_MESSAGE, SendScheduler, SendTimeout
+
+def test_call_returns_result():
+    scheduler = SendScheduler(global_rate=100, workers=2)
+    try:
+        assert scheduler.call(1, PRIORITY_MESSAGE, lambda: "ok", timeout=5) == "ok"
+        assert scheduler.stats()["sent"] == 1
+    finally:
+        scheduler.shutdown()
+
+def test_timeout_in_queue_cancels_the_send():
+    # Un solo invio per chat ogni 10s: il secondo resta in coda oltre il timeout
+    scheduler = SendScheduler(global_rate=100, per_chat_rate=0.1, per_chat_burst=1, workers=2)
+    sent = []
+    try:
+        scheduler.call(1, PRIORITY_MESSAGE, sent.append, "primo", timeout=5)
+        with pytest.raises(SendTimeout):
+            scheduler.call(1, PRIORITY_MESSAGE, sent.append, "secondo", timeout=0.2)
+    finally:
+        scheduler.shutdown(wait=True)
+
+    assert sent == ["primo"]
+    stats = scheduler.stats()
+    assert stats["cancelled"] == 1
+    assert stats["sent"] == 1
+
+def test_started_job_is_awaited_not_cancelled():
+    scheduler = SendScheduler(global_rate=100, workers=2)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "inviato"
+
+    try:
+        timer = threading.Timer(0.3, release.set)
+        timer.start()
+        # Il job parte subito: superato il timeout si attende il suo esito invece di annullarlo
+        assert scheduler.call(1, PRIORITY_MESSAGE, slow, timeout=0.1) == "inviato"
+        assert started.is_set()
+        assert scheduler.stats()["cancelled"] == 0
+    finally:
+        release.set()
+        scheduler.shutdown()
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from services.update_dispatcher import UpdateDispatcher
+
+def test_same_chat_runs_in_order_one_at_a_time():
+    dispatcher = UpdateDispatcher(max_workers=4)
+    seen = []
+    running = {"now": 0, "max": 0}
+    lock = threading.Lock()
+
+    def handler(value):
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        time.sleep(0.002)
+        seen.append(value)
+        with lock:
+            running["now"] -= 1
+
+    for value in range(50):
+        dispatcher.submit(42, handler, value)
+    assert dispatcher.wait_idle(timeout=10)
+    dispatcher.shutdown()
+
+    assert seen == list(range(50))
+    assert running["max"] == 1
+
+def test_different_chats_run_in_parallel():
+    dispatcher = UpdateDispatcher(max_workers=4)
+    barrier = threading.Barrier(4, timeout=5)
+
+    for chat_id in range(4):
+        dispatcher.submit(chat_id, barrier.wait)
+    assert dispatcher.wait_idle(timeout=10)
+    dispatcher.shutdown()
+
+    assert not barrier.broken
+
+def test_handler_error_does_not_block_the_chat():
+    dispatcher = UpdateDispatcher(max_workers=2)
+    seen = []
+
+    def failing():
+        raise ValueError("boom")
+
+    dispatcher.submit(7, failing)
+    dispatcher.submit(7, seen.append, "dopo")
+    assert dispatcher.wait_idle(timeout=10)
+    dispatcher.shutdown()
+
+    assert seen == ["dopo"]
+    assert dispatcher.pending() == 0
+    assert dispatcher.active_chats() == 0
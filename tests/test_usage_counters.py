@@ -0,0 +1,41 @@
+from datetime import date
+
+import pytest
+
+from services.state_store import StateStore
+from services.usage_counters import DailyUsageCounters
+
+@pytest.fixture
+def store(tmp_path):
+    store = StateStore(str(tmp_path / "usage.db"))
+    yield store
+    store.close()
+
+def test_try_consume_stops_at_limit(store):
+    counters = DailyUsageCounters(store)
+    results = [counters.try_consume(1, 3) for _ in range(5)]
+
+    assert results == [(True, 1), (True, 2), (True, 3), (False, 3), (False, 3)]
+    assert counters.get(1) == 3
+
+def test_flush_adds_deltas_to_the_store(store):
+    today = date.today().isoformat()
+    first = DailyUsageCounters(store)
+    second = DailyUsageCounters(store)
+    first.increment(1, 2)
+    second.increment(1, 3)
+
+    assert first.flush() == 1
+    assert second.flush() == 1
+    assert first.flush() == 0
+    assert store.get_usage("1", today) == 5
+
+def test_shared_counters_share_the_limit(store):
+    workers = [DailyUsageCounters(store), DailyUsageCounters(store)]
+    for counters in workers:
+        counters.shared = True
+
+    allowed = [workers[i % 2].try_consume(1, 3)[0] for i in range(6)]
+
+    assert allowed.count(True) == 3
+    assert workers[0].get(1) == workers[1].get(1) == 3